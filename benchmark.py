@@ -0,0 +1,869 @@
+import argparse
+import base64
+import contextlib
+import gc
+import io
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+from file_system import FileAllocationTable, BlockExtents, chunk_hashes, inode_index_blocks, POINTER_SIZE
+from compaction import CompactionEngine
+from workload import SIZE_DISTRIBUTIONS, METHODS, generate_trace, read_trace, run_workload
+from metric_history import MetricHistory
+from shared_state import SharedState
+from storage_pool import PLACEMENTS, StoragePool
+
+def measure(build):
+    gc.collect()
+    start=time.perf_counter()
+    result=build()
+    elapsed=time.perf_counter()-start
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result=build()
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return elapsed, peak
+
+def bench_fat_memory(args):
+    print("{:>10} {:>9} {:>12} {:>12}".format("blocks", "storage", "build (s)", "memory (MB)"))
+    for total_blocks in args.blocks:
+        for compact in (False, True):
+            if not compact and total_blocks>args.max_object_blocks:
+                print("{:>10} {:>9} {:>12} {:>12}".format(total_blocks, "objects", "skipped", "-"))
+                continue
+            elapsed, peak=measure(lambda: FileAllocationTable(total_blocks, compact=compact))
+            print("{:>10} {:>9} {:>12.3f} {:>12.1f}".format(
+                total_blocks, "compact" if compact else "objects", elapsed, peak/(1024*1024)))
+
+def churn(fat, operations, seed, max_blocks, fill=0.9):
+    # random allocate/free mix that holds the disk around `fill` utilization
+    rng=random.Random(seed)
+    live=[]
+    failures=0
+    allocations=0
+    used_target=fat.total_blocks*fill
+    start=time.perf_counter()
+    for op in range(operations):
+        used=fat.get_fragmentation_info()['used_blocks']
+        if live and rng.random()<(0.7 if used>used_target else 0.3):
+            fat.deallocate_file(live.pop(rng.randrange(len(live))))
+            continue
+        allocations+=1
+        filename="file"+str(op)
+        if fat.allocate_file(filename, rng.randint(1, max_blocks)*fat.block_size)[0]:
+            live.append(filename)
+        else:
+            failures+=1
+    return time.perf_counter()-start, allocations, failures
+
+def hole_placement(policy, dedup):
+    # first block of a 2-block file passed `policy` per call, on a table left at first-fit with
+    # a 4-block hole at 0, a 2-block hole at 14 and free space from 56
+    fat=FileAllocationTable(64, compact=True)
+    for filename, blocks in [("a", 4), ("b", 10), ("c", 2), ("d", 40)]:
+        fat.allocate_file(filename, blocks*fat.block_size, method="continuous")
+    fat.deallocate_file("a")
+    fat.deallocate_file("c")
+    fat.allocate_file("file", 2*fat.block_size, method="continuous", policy=policy,
+                      block_hashes=[b"1", b"2"] if dedup else None, dedup=dedup)
+    return fat.file_blocks("file")[0]
+
+def bench_placement(args):
+    # after the churn every policy must still place a zero-byte file, which needs no free extent,
+    # and a deduplicated file must land where the same policy puts a plain one
+    failed=False
+    print("{:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>11} {:>11}".format(
+        "policy", "ops/s", "failed %", "frag %", "segments", "largest", "empty file", "dedup"))
+    for policy in ["first-fit", "best-fit", "worst-fit", "next-fit"]:
+        fat=FileAllocationTable(args.blocks, compact=True)
+        fat.set_placement_policy(policy)
+        elapsed, allocations, failures=churn(fat, args.operations, args.seed, args.max_file_blocks, args.fill)
+        info=fat.get_fragmentation_info()
+        empty=fat.allocate_file("empty", 0)[0] and fat.deallocate_file("empty")
+        plain, dedup=hole_placement(policy, False), hole_placement(policy, True)
+        failed|=not empty or plain!=dedup
+        print("{:>10} {:>10.0f} {:>10.2f} {:>10.1f} {:>10} {:>10} {:>11} {:>11}".format(
+            policy, args.operations/elapsed, failures*100/max(1, allocations),
+            info['fragmentation_percentage'], info['free_segments'], info['largest_free_segment'],
+            "ok" if empty else "FAILED", "ok" if plain==dedup else "{} vs {}".format(dedup, plain)))
+    return failed
+
+def bench_methods(args):
+    print("{:>11} {:>10} {:>10} {:>12} {:>12}".format("method", "ops/s", "failed %", "external %", "internal %"))
+    for method in METHODS:
+        fat=FileAllocationTable(args.blocks, compact=True)
+        fat.set_allocation_method(method)
+        elapsed, allocations, failures=churn(fat, args.operations, args.seed, args.max_file_blocks, args.fill)
+        info=fat.get_fragmentation_info()
+        print("{:>11} {:>10.0f} {:>10.2f} {:>12.1f} {:>12.1f}".format(
+            method, args.operations/elapsed, failures*100/max(1, allocations),
+            info['external_fragmentation_percentage'], info['internal_fragmentation_percentage']))
+
+def fill_disk(fat, seed, fill=0.7, max_blocks=512):
+    rng=random.Random(seed)
+    methods=["continuous", "linked", "indexed"]
+    live=[]
+    while fat.get_fragmentation_info()['used_blocks']<fat.total_blocks*fill:
+        fat.set_allocation_method(rng.choice(methods))
+        filename="file"+str(len(live))
+        if not fat.allocate_file(filename, rng.randint(1, max_blocks)*fat.block_size)[0]:
+            break
+        live.append(filename)
+    for filename in rng.sample(live, len(live)//3):
+        fat.deallocate_file(filename)
+
+def bench_disk_view(args):
+    import plotly.io as pio
+    from complete_project import disk_block_figure, MAX_OVERVIEW_POINTS
+    print("{:>10} {:>12} {:>14}".format("blocks", "render (s)", "payload (KB)"))
+    for total_blocks in args.blocks:
+        fat=FileAllocationTable(total_blocks, compact=True)
+        fill_disk(fat, args.seed)
+        start=time.perf_counter()
+        payload=pio.to_json(disk_block_figure(fat, 0, total_blocks, MAX_OVERVIEW_POINTS))
+        elapsed=time.perf_counter()-start
+        print("{:>10} {:>12.3f} {:>14.1f}".format(total_blocks, elapsed, len(payload)/1024))
+
+def make_synthetic_proc(root, processes, seed):
+    # minimal /proc tree: /proc/stat, /proc/meminfo and stat/statm per pid
+    rng=random.Random(seed)
+    with open(os.path.join(root, 'stat'), 'w') as f:
+        f.write("cpu  {} 0 {} {} 0 0 0 0 0 0\n".format(rng.randint(10**6, 10**7), rng.randint(10**5, 10**6), 10**8))
+        for cpu in range(8):
+            f.write("cpu{} 1000 0 1000 100000 0 0 0 0 0 0\n".format(cpu))
+        f.write("btime 1700000000\n")
+    with open(os.path.join(root, 'meminfo'), 'w') as f:
+        for field, kb in [("MemTotal", 16384000), ("MemFree", 8192000), ("MemAvailable", 10240000), ("Buffers", 102400),
+                          ("Cached", 2048000), ("Shmem", 10240), ("Active", 4096000), ("Inactive", 2048000)]:
+            f.write("{}: {} kB\n".format(field, kb))
+    for pid in range(1, processes+1):
+        os.mkdir(os.path.join(root, str(pid)))
+        rss=rng.randint(100, 100000)
+        with open(os.path.join(root, str(pid), 'stat'), 'w') as f:
+            f.write("{} (worker {}) S 1 {} {} 0 -1 4194560 100 0 0 0 {} {} 0 0 20 0 1 0 {} {} {} ".format(
+                pid, pid%97, pid, pid, rng.randint(0, 10**5), rng.randint(0, 10**4), rng.randint(0, 10**6), rss*4096*4, rss)
+                +" ".join("0" for _ in range(28))+"\n")
+        with open(os.path.join(root, str(pid), 'statm'), 'w') as f:
+            f.write("{} {} 100 10 0 {} 0\n".format(rss*4, rss, rss))
+
+def time_scans(scan, repeat):
+    scan()
+    start=time.perf_counter()
+    for _ in range(repeat):
+        scan()
+    return (time.perf_counter()-start)/repeat
+
+def psutil_scan():
+    from system_monitor import SystemProcessMonitor
+    monitor=SystemProcessMonitor(process_ttl=0, collector="psutil")
+    return lambda: monitor._scan_processes()
+
+def bench_proc_collector(args):
+    import psutil
+    from proc_collector import ProcCollector
+    print("{:>10} {:>12} {:>12} {:>10}".format("processes", "psutil (ms)", "/proc (ms)", "speedup"))
+    default_procfs=psutil.PROCFS_PATH
+    for processes in args.processes:
+        root=tempfile.mkdtemp(prefix="synthetic-proc-")
+        try:
+            make_synthetic_proc(root, processes, args.seed)
+            psutil.PROCFS_PATH=root
+            psutil_time=time_scans(psutil_scan(), args.repeat)
+            psutil.PROCFS_PATH=default_procfs
+            proc_time=time_scans(ProcCollector(root).scan, args.repeat)
+        finally:
+            psutil.PROCFS_PATH=default_procfs
+            shutil.rmtree(root)
+        print("{:>10} {:>12.1f} {:>12.1f} {:>9.1f}x".format(
+            processes, psutil_time*1000, proc_time*1000, psutil_time/proc_time))
+
+def bench_dedup(args):
+    rng=random.Random(args.seed)
+    data=rng.randbytes(args.megabytes*1024*1024)
+    print("{:>12} {:>14}".format("chunk (B)", "hash (MB/s)"))
+    for chunk_size in args.chunk_sizes:
+        start=time.perf_counter()
+        chunk_hashes(data, chunk_size)
+        elapsed=time.perf_counter()-start
+        print("{:>12} {:>14.0f}".format(chunk_size, args.megabytes/elapsed))
+
+    print("\n{:>12} {:>14} {:>14}".format("index size", "hit (ns)", "miss (ns)"))
+    probes=chunk_hashes(rng.randbytes(args.lookups*64), 64)
+    for entries in args.index_sizes:
+        fat=FileAllocationTable(entries, compact=True, dedup=True)
+        fat.allocate_file("seed", entries*fat.block_size, block_hashes=[rng.randbytes(16) for _ in range(entries)])
+        stored=list(fat.block_index)
+        hits=[stored[rng.randrange(len(stored))] for _ in range(args.lookups)]
+        index=fat.block_index
+        timings=[]
+        for keys in (hits, probes):
+            start=time.perf_counter()
+            for key in keys:
+                index.get(key)
+            timings.append((time.perf_counter()-start)*1e9/len(keys))
+        print("{:>12} {:>14.0f} {:>14.0f}".format(entries, timings[0], timings[1]))
+
+def bench_compaction(args):
+    # every step must stay within moves_per_step and leave a consistent table
+    failed=False
+    print("{:>10} {:>8} {:>8} {:>10} {:>10} {:>12} {:>14} {:>10}".format(
+        "blocks", "steps", "moves", "time (s)", "frag %", "largest", "gain/move %", "max/step"))
+    for total_blocks in args.blocks:
+        fat=FileAllocationTable(total_blocks, compact=True)
+        fill_disk(fat, args.seed)
+        engine=CompactionEngine(fat, args.moves_per_step)
+        largest_step=0
+        start=time.perf_counter()
+        while not engine.done:
+            largest_step=max(largest_step, engine.step())
+        elapsed=time.perf_counter()-start
+        report=engine.report()
+        problems=table_problems(fat, list(fat.file_table))
+        if largest_step>args.moves_per_step:
+            problems.append("a step moved {} blocks".format(largest_step))
+        failed|=bool(problems)
+        print("{:>10} {:>8} {:>8} {:>10.3f} {:>4.1f}->{:<5.1f} {:>5}->{:<6} {:>14.4f} {:>10}  {}".format(
+            total_blocks, report['steps'], report['moves'], elapsed,
+            report['fragmentation_before'], report['fragmentation_now'],
+            report['largest_free_before'], report['largest_free_now'], report['fragmentation_gain_per_move'],
+            largest_step, "; ".join(problems) or "ok"))
+    return failed
+
+def bench_workload(args):
+    # the timed pass runs without tracemalloc; a second pass on a fresh table measures peak memory
+    print("{:>10} {:>11} {:>10} {:>9} {:>12} {:>12} {:>12}".format(
+        "sizes", "method", "ops/s", "failed %", "frag % mean", "frag % max", "peak (MB)"))
+    workloads=[("trace", list(read_trace(args.trace)))] if args.trace else [
+        (distribution, list(generate_trace(args.operations, distribution, args.seed, max_blocks=args.max_file_blocks,
+                                           arrival_rate=args.arrival_rate, mean_lifetime=args.mean_lifetime)))
+        for distribution in args.distributions]
+    for name, trace in workloads:
+        blocks=args.blocks
+        if blocks is None:
+            # size the disk so the average live set (arrival rate x lifetime files) fills `fill` of it
+            sizes=[size for op, _, size in trace if op=='alloc']
+            blocks=int(args.arrival_rate*args.mean_lifetime*sum(sizes)/len(sizes)/1024/args.fill)
+        for method in METHODS:
+            result=run_workload(trace, method, blocks, sample_every=args.sample_every)
+            peak=run_workload(trace, method, blocks, sample_every=args.sample_every, track_memory=True)['peak_memory']
+            fragmentation=[sample[1] for sample in result['timeline']] or [0.0]
+            print("{:>10} {:>11} {:>10.0f} {:>9.2f} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+                name, method, result['ops_per_sec'], result['failure_rate'],
+                sum(fragmentation)/len(fragmentation), max(fragmentation), peak/(1024*1024)))
+
+def bench_inode(args):
+    # flat index: one index block holding every pointer; inode: direct pointers plus bounded indirect blocks
+    print("{:>10} {:>16} {:>14} {:>12} {:>14} {:>15}".format(
+        "file size", "flat index (KB)", "inode blocks", "overhead %", "flat (ns/op)", "inode (ns/op)"))
+    sizes=[int(size*1024) for size in args.sizes_kb]
+    fat=FileAllocationTable(max(sizes)//1024+inode_index_blocks(max(sizes)//1024, 256)+1, compact=True)
+    rng=random.Random(args.seed)
+    for size in sizes:
+        offsets=[rng.randrange(size) for _ in range(args.lookups)]
+        timings=[]
+        for method in ("indexed", "inode"):
+            fat.set_allocation_method(method)
+            fat.allocate_file(method, size)
+            start=time.perf_counter()
+            for offset in offsets:
+                fat.block_for_offset(method, offset)
+            timings.append((time.perf_counter()-start)*1e9/len(offsets))
+            if method=="inode":
+                index_blocks=len(fat.file_table[method]['metadata_blocks'])
+            fat.deallocate_file(method)
+        data_blocks=fat._blocks_needed(size)
+        print("{:>10} {:>16.1f} {:>14} {:>12.3f} {:>14.0f} {:>15.0f}".format(
+            format_size(size), data_blocks*POINTER_SIZE/1024, index_blocks,
+            index_blocks*100/data_blocks, timings[0], timings[1]))
+
+def table_problems(fat, expected):
+    # invariants after concurrent use: exactly the expected files, every block held by its
+    # files alone unless deduplicated, used flags matching the files, consistent free space
+    problems=[]
+    if set(fat.file_table)!=set(expected):
+        problems.append("{} files in the table, {} expected".format(len(fat.file_table), len(expected)))
+    holders=np.zeros(fat.total_blocks, dtype=np.int64)
+    for filename, info in fat.file_table.items():
+        if info['method']=='buddy':
+            runs=[(info['buddy_block'], 1<<info['order'])] if info['buddy_block'] is not None else []
+        else:
+            runs=BlockExtents.from_blocks(sorted(set(fat.file_blocks(filename)))).runs()
+            if info['method']=='indexed':
+                runs.append((info['index_block'], 1))
+            elif info['method']=='inode':
+                runs+=info['metadata_blocks'].runs()
+        for start, length in runs:
+            holders[start:start+length]+=1
+            if any(filename not in fat.block_owners(block) for block in range(start, start+length)):
+                problems.append(filename+" does not own its blocks")
+                break
+    shared=np.flatnonzero(holders>1)
+    if any(fat.block_refs.get(int(block), 0)!=holders[block] for block in shared):
+        problems.append("{} blocks double-booked".format(len(shared)))
+    if not np.array_equal(holders>0, fat._used_flags()>0):
+        problems.append("used flags differ from the files' blocks")
+    try:
+        fat.check_consistency()
+    except Exception as e:
+        problems.append(str(e))
+    return problems
+
+def thread_churn(fat, worker, operations, max_blocks, seed, live, near=None):
+    # mixed methods, some deduplicated against a small pool of chunk hashes so files share blocks;
+    # with near, only the methods that honour it, so the worker stays in its own region
+    rng=random.Random(seed*1000+worker)
+    methods=METHODS if near is None else [method for method in METHODS if method!="buddy"]
+    for op in range(operations):
+        if live and rng.random()<0.5:
+            fat.deallocate_file(live.pop(rng.randrange(len(live))))
+            continue
+        filename="t{}-{}".format(worker, op)
+        method=rng.choice(methods)
+        blocks=rng.randint(1, max_blocks)
+        hashes=None
+        if near is None and method in ("continuous", "linked", "indexed") and rng.random()<0.3:
+            hashes=[str(rng.randrange(64)).encode() for _ in range(blocks)]
+        if fat.allocate_file(filename, blocks*fat.block_size, method=method, block_hashes=hashes,
+                             dedup=hashes is not None, near=near)[0]:
+            live.append(filename)
+
+def run_threads(fat, threads, operations, max_blocks, seed, regions=False):
+    # returns (elapsed, names of the files left allocated)
+    kept=[[] for _ in range(threads)]
+    workers=[threading.Thread(target=thread_churn, args=(fat, worker, operations//threads, max_blocks, seed, kept[worker],
+                                                         worker*fat.total_blocks//threads if regions else None))
+             for worker in range(threads)]
+    start=time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter()-start, [name for names in kept for name in names]
+
+def bench_threads(args):
+    # the same total work split over more threads: first everything mixed over the whole table,
+    # then each thread allocating in its own region, where threads only meet on the short
+    # allocator hold. Invariants are checked after every run and any violation fails the command;
+    # so does region throughput falling more than --tolerance below the best with fewer threads.
+    failed=False
+    print("{:>8} {:>8} {:>10} {:>10} {:>8}  {}".format("layout", "threads", "ops/s", "time (s)", "files", "invariants"))
+    for regions in (False, True):
+        best=0
+        for threads in args.threads:
+            fat=FileAllocationTable(args.blocks, compact=True)
+            elapsed, expected=run_threads(fat, threads, args.operations, args.max_file_blocks, args.seed, regions)
+            rate=threads*(args.operations//threads)/elapsed
+            problems=table_problems(fat, expected)
+            if regions and rate<best*(1-args.tolerance):
+                problems.append("throughput {:.0f}% below fewer threads".format((1-rate/best)*100))
+            best=max(best, rate)
+            failed|=bool(problems)
+            print("{:>8} {:>8} {:>10.0f} {:>10.3f} {:>8}  {}".format(
+                "regions" if regions else "mixed", threads, rate, elapsed, len(expected), "; ".join(problems) or "ok"))
+    return failed
+
+class NoLock:
+    def acquire(self, *args):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+def bench_race_check(args):
+    # the threads benchmark with the table's locks taken out: the invariant checks must catch the
+    # races that follow, or they would not catch them with the locks in either
+    interval=sys.getswitchinterval()
+    hook=threading.excepthook
+    sys.setswitchinterval(1e-6)
+    errors=[]
+    # a worker that trips over a race counts as a caught race, not a traceback
+    threading.excepthook=lambda failure: errors.append(failure.exc_value)
+    caught=0
+    try:
+        print("{:>6} {:>8}  {}".format("run", "threads", "invariants"))
+        for run in range(args.runs):
+            fat=FileAllocationTable(args.blocks, compact=True)
+            fat.dedup_lock=fat.lock=fat.log_lock=fat.names_lock=NoLock()
+            fat.stripes=[NoLock() for _ in fat.stripes]
+            del errors[:]
+            elapsed, expected=run_threads(fat, args.threads, args.operations, args.max_file_blocks, args.seed+run)
+            problems=table_problems(fat, expected)
+            if errors:
+                problems.append("{} workers failed, first with: {}".format(len(errors), errors[0]))
+            caught+=bool(problems)
+            print("{:>6} {:>8}  {}".format(run, args.threads, "; ".join(problems) or "no race found"))
+    finally:
+        sys.setswitchinterval(interval)
+        threading.excepthook=hook
+    return caught==0
+
+def bench_layout_mirror(args):
+    # a reader follows the threads churn through get_layout_changes only, the way the disk view
+    # does; once the writers stop, its mirror must equal the full layout block for block
+    failed=False
+    print("{:>8} {:>8} {:>10} {:>8} {:>8}".format("table", "threads", "versions", "polls", "stale"))
+    for compact in (True, False):
+        fat=FileAllocationTable(args.blocks, compact=compact)
+        mirror={block['block_num']: block for block in fat.get_file_layout()}
+        state={'version': fat.layout_version, 'polls': 0}
+        stop=threading.Event()
+
+        def follow():
+            changes=fat.get_layout_changes(state['version'])
+            if changes['full']:
+                mirror.clear()
+            for block in changes['blocks']:
+                mirror[block['block_num']]=block
+            state['version']=changes['version']
+            state['polls']+=1
+
+        def reader():
+            while not stop.is_set():
+                follow()
+
+        follower=threading.Thread(target=reader)
+        follower.start()
+        try:
+            run_threads(fat, args.threads, args.operations, args.max_file_blocks, args.seed)
+        finally:
+            stop.set()
+            follower.join()
+        follow()
+        stale=sum(mirror.get(block['block_num'])!=block for block in fat.get_file_layout())
+        failed|=stale>0
+        print("{:>8} {:>8} {:>10} {:>8} {:>8}".format(
+            "compact" if compact else "objects", args.threads, fat.layout_version, state['polls'], stale))
+    return failed
+
+HISTORY_WINDOWS=[("10 minutes", 600), ("1 hour", 3600), ("1 day", 86400), ("2 days", 172800)]
+
+def bench_history(args):
+    # 1s samples over --days, then the dashboard's range queries: each must come from the finest
+    # ring that holds the whole window, regrouped to fit max_points, never a coarser one. Then a
+    # sampler stopped and started again (and started twice) must keep the samples it had.
+    failed=False
+    history=MetricHistory(['cpu', 'mem'])
+    end=1000000.0+args.days*86400
+    start=time.perf_counter()
+    for t in np.arange(1000000.0, end):
+        history.add(t, t%100, 50.0)
+    elapsed=time.perf_counter()-start
+    print("{} samples: {:.0f} samples/s, {:.0f} KB of rings".format(
+        args.days*86400, args.days*86400/elapsed, len(history.buffer)/1024))
+    print("{:>12} {:>10} {:>8} {:>12}".format("window", "res (s)", "points", "finest (s)"))
+    for label, window in HISTORY_WINDOWS:
+        if window>args.days*86400:
+            continue
+        result=history.query(end-window, end, args.max_points)
+        ring=next((ring for ring in history.levels if ring.resolution*ring.capacity>=window), history.levels[-1])
+        finest=ring.resolution*-(-(window//ring.resolution+1)//args.max_points)
+        ok=result['resolution']<=finest and len(result['time'])<=args.max_points
+        failed|=not ok
+        print("{:>12} {:>10} {:>8} {:>12}  {}".format(
+            label, result['resolution'], len(result['time']), finest, "ok" if ok else "TOO COARSE"))
+
+    from system_monitor import SystemProcessMonitor
+    monitor=SystemProcessMonitor(sample_interval=args.sample_interval)
+    samples=lambda: int(monitor.history.levels[0].count.sum())
+    monitor.start_sampler()
+    time.sleep(args.sample_interval*10)
+    monitor.stop_sampler()
+    before=samples()
+    monitor.start_sampler()
+    restarted=monitor.start_sampler()
+    time.sleep(args.sample_interval*10)
+    monitor.stop_sampler()
+    after=samples()
+    kept=not restarted and after>before>0
+    failed|=not kept
+    print("sampler restart: {} samples before, {} after{}".format(
+        before, after, "" if kept else ", history LOST"))
+    return failed
+
+def upload_problems(project, expected):
+    # the dashboard's file records against its table: the same files, the used space their sum,
+    # and each file still holding the content it was uploaded with
+    problems=[]
+    manager=project.file_manager
+    if set(manager.uploaded_files)!=set(expected) or set(project.file_system.file_table)!=set(expected):
+        problems.append("files {} / table {}, expected {}".format(
+            sorted(manager.uploaded_files), sorted(project.file_system.file_table), sorted(expected)))
+    if manager.used_space!=sum(info['allocated_space'] for info in manager.uploaded_files.values()):
+        problems.append("used_space {} does not match the files".format(manager.used_space))
+    for filename, content in expected.items():
+        if filename in manager.uploaded_files and bytes(manager.get_content(filename))!=content:
+            problems.append(filename+" content changed")
+    return problems
+
+def bench_uploads(args):
+    # uploads through the dashboard's own routes: a failed allocation and a second streamed
+    # session for a name that is already taken must leave the stored files as they were
+    import complete_project as project
+    client=project.server.test_client()
+    outputs=[('disk-blocks-visual', 'figure'), ('files-table', 'data'), ('file-system-metrics', 'children'),
+             ('file-upload-output', 'children'), ('file-store', 'data')]
+
+    def upload(filename, content):
+        inputs=[('upload-file', 'contents', "data:text/plain;base64,"+base64.b64encode(content).decode()),
+                ('upload-file', 'filename', filename), ('allocation-method', 'value', args.method),
+                ('placement-policy', 'value', "first-fit"), ('dedup-toggle', 'value', [])]
+        client.post('/_dash-update-component', json={
+            'output': "..{}..".format("...".join(component+"."+prop for component, prop in outputs)),
+            'outputs': [{'id': component, 'property': prop} for component, prop in outputs],
+            'inputs': [{'id': component, 'property': prop, 'value': value} for component, prop, value in inputs],
+            'changedPropIds': ["upload-file.contents"], 'state': []})
+        return filename in project.file_system.file_table
+
+    def stream(filename, content):
+        upload_id=client.post('/upload/session', json={'filename': filename}).get_json()['upload_id']
+        client.put('/upload/session/'+upload_id, data=content)
+        return upload_id
+
+    def finish(upload_id):
+        return client.post('/upload/session/{}/finish'.format(upload_id)).status_code==200
+
+    disk=project.file_system.total_blocks*project.file_system.block_size
+    first, second=b"A"*args.size, b"B"*(args.size*2)
+    expected={}
+    failed=False
+    print("{:>28} {:>9}  {}".format("upload", "stored", "invariants"))
+    # the dashboard logs every upload; only the results are printed here
+    with contextlib.redirect_stdout(io.StringIO()):
+        cases=[]
+        stored=upload("upload.txt", first)
+        expected["upload.txt"]=first
+        cases.append(("dashboard upload", stored, stored, upload_problems(project, expected)))
+        stored=upload("too-large.txt", b"x"*(disk+1))
+        cases.append(("larger than the disk", stored, False, upload_problems(project, expected)))
+        sessions=[stream("streamed.txt", first), stream("streamed.txt", second)]
+        stored=finish(sessions[0])
+        expected["streamed.txt"]=first
+        cases.append(("streamed", stored, True, upload_problems(project, expected)))
+        stored=finish(sessions[1])
+        cases.append(("second session, same name", stored, False, upload_problems(project, expected)))
+    for label, stored, wanted, problems in cases:
+        if stored!=wanted:
+            problems.insert(0, "stored" if stored else "not stored")
+        failed|=bool(problems)
+        print("{:>28} {:>9}  {}".format(label, "yes" if stored else "no", "; ".join(problems) or "ok"))
+    return failed
+
+def bench_pool(args):
+    # every placement policy under the same churn, then one bulk load done file by file vs
+    # with a thread or process per volume
+    print("{:>17} {:>7} {:>9} {:>9} {:>8} {:>12}".format("placement", "stripe", "time (s)", "failed %", "frag %", "spread (pp)"))
+    for placement in PLACEMENTS:
+        for width in args.stripe_widths:
+            pool=StoragePool(args.volumes, args.blocks_per_volume, placement=placement, stripe_width=width)
+            elapsed, allocations, failures=churn(pool, args.operations, args.seed, args.max_file_blocks)
+            info=pool.get_fragmentation_info()
+            pool.check_consistency()
+            print("{:>17} {:>7} {:>9.3f} {:>9.2f} {:>8.1f} {:>12.1f}".format(
+                placement, width, elapsed, failures*100/max(1, allocations),
+                info['mean_volume_fragmentation'], info['utilization_spread']))
+
+    rng=random.Random(args.seed)
+    files=[("bulk"+str(i), rng.randint(1, args.max_file_blocks)*1024) for i in range(args.bulk_files)]
+    print("{:>17} {:>9} {:>9}".format("bulk load", "time (s)", "placed"))
+    for mode in ("sequential", "thread", "process"):
+        pool=StoragePool(args.volumes, args.blocks_per_volume*2)
+        start=time.perf_counter()
+        if mode=="sequential":
+            placed=sum(pool.allocate_file(name, size)[0] for name, size in files)
+        else:
+            placed=sum(ok for ok, _ in pool.bulk_allocate(files, executor=mode).values())
+        elapsed=time.perf_counter()-start
+        pool.check_consistency()
+        print("{:>17} {:>9.3f} {:>9}".format(mode, elapsed, placed))
+
+def open_shared_fat(path, total_blocks):
+    # what each dashboard worker does at import: build a table, then adopt the published one
+    fat=FileAllocationTable(total_blocks, compact=True)
+    state=SharedState(path)
+    state.register('file_system', fat)
+    return fat, state.open()
+
+def shared_writer(path, total_blocks, worker, operations, max_blocks, seed):
+    # allocate/free churn on this worker's own files, each operation one write transaction
+    fat, state=open_shared_fat(path, total_blocks)
+    rng=random.Random(seed+worker)
+    live=[]
+    for op in range(operations):
+        with state.write():
+            if live and rng.random()<0.5:
+                fat.deallocate_file(live.pop(rng.randrange(len(live))))
+            else:
+                filename="w{}-{}".format(worker, op)
+                if fat.allocate_file(filename, rng.randint(1, max_blocks)*fat.block_size)[0]:
+                    live.append(filename)
+    return live
+
+def shared_reader(path, total_blocks, reads):
+    fat, state=open_shared_fat(path, total_blocks)
+    start=time.perf_counter()
+    for _ in range(reads):
+        with state.read():
+            fat.get_fragmentation_info()
+    return reads, time.perf_counter()-start
+
+def shared_sampler(path, samples):
+    history=MetricHistory(['cpu', 'mem'], path=path)
+    for i in range(samples):
+        history.add(1000.0+i, i%100, 50.0)
+
+def bench_shared_state(args):
+    # worker processes mutate one shared table; afterwards it must hold exactly the files they
+    # kept, with consistent free-space statistics and owners, then shared reads are timed.
+    # Returns True when the table or the shared metric history came out wrong.
+    context=multiprocessing.get_context("spawn")
+    directory=tempfile.mkdtemp(prefix="shared-state-")
+    try:
+        path=os.path.join(directory, "state.bin")
+        fat, state=open_shared_fat(path, args.blocks)
+        start=time.perf_counter()
+        with context.Pool(args.writers) as pool:
+            kept=pool.starmap(shared_writer, [(path, args.blocks, worker, args.operations, args.max_file_blocks, args.seed)
+                                              for worker in range(args.writers)])
+        elapsed=time.perf_counter()-start
+        with state.read():
+            expected=set(name for names in kept for name in names)
+            problems=table_problems(fat, expected)
+        print("{} writers x {} ops: {:.0f} writes/s, {} files kept, version {}, {}".format(
+            args.writers, args.operations, args.writers*args.operations/elapsed, len(expected), state.version,
+            "; ".join(problems) or "consistent"))
+
+        print("{:>8} {:>14}".format("readers", "reads/s"))
+        for readers in args.readers:
+            with context.Pool(readers) as pool:
+                results=pool.starmap(shared_reader, [(path, args.blocks, args.reads)]*readers)
+            print("{:>8} {:>14.0f}".format(readers, sum(reads for reads, _ in results)/max(elapsed for _, elapsed in results)))
+
+        history_path=os.path.join(directory, "metrics.bin")
+        history=MetricHistory(['cpu', 'mem'], path=history_path)
+        process=context.Process(target=shared_sampler, args=(history_path, args.samples))
+        process.start()
+        process.join()
+        seen=len(history.since(None)['time'])
+        print("metric history: {} samples written by another process, {} visible here".format(
+            args.samples, seen))
+        return bool(problems) or seen!=min(args.samples, history.levels[0].capacity)
+    finally:
+        shutil.rmtree(directory)
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size<1024 or unit=="GB":
+            return "{:g} {}".format(size, unit)
+        size/=1024
+
+UI_MODULES=('dash', 'plotly', 'pandas', 'dash_bootstrap_components')
+
+def import_times(module):
+    # one fresh interpreter under -X importtime: (wall seconds, {module: cumulative us}, the
+    # module's direct imports). The output is post-order, children indented under their importer.
+    start=time.perf_counter()
+    result=subprocess.run([sys.executable, "-X", "importtime", "-c", "import "+module],
+                          capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    elapsed=time.perf_counter()-start
+    if result.returncode!=0:
+        return None
+    cumulative={}
+    children=[]
+    direct=[]
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, total, name=line[len("import time:"):].split("|")
+        depth=(len(name)-len(name.lstrip())-1)//2
+        cumulative[name.strip()]=int(total)
+        if depth==1:
+            children.append(name.strip())
+        elif depth==0:
+            if name.strip()==module:
+                direct=children
+            children=[]
+    return elapsed, cumulative, direct
+
+def bench_startup(args):
+    # cold start of each entry point in a fresh interpreter; the collector path must stay
+    # clear of the UI libraries to meet the target
+    baseline=statistics.median(import_times("sys")[0] for _ in range(args.runs))
+    print("interpreter start: {:.1f} ms".format(baseline*1000))
+    print("{:>17} {:>10} {:>12} {:>8}  {}".format("module", "wall (ms)", "import (ms)", "UI libs", "heaviest imports (ms)"))
+    for module in args.modules:
+        runs=[import_times(module) for _ in range(args.runs)]
+        if runs[0] is None:
+            print("{:>17}  not importable here".format(module))
+            continue
+        wall=statistics.median(run[0] for run in runs)
+        imported=statistics.median(run[1][module] for run in runs)/1000
+        cumulative, direct=runs[-1][1], runs[-1][2]
+        heaviest=sorted(direct, key=lambda name: -cumulative[name])[:3]
+        print("{:>17} {:>10.1f} {:>12.1f} {:>8}  {}".format(
+            module, wall*1000, imported, "yes" if any(name in cumulative for name in UI_MODULES) else "no",
+            ", ".join("{} {:.0f}".format(name, cumulative[name]/1000) for name in heaviest)))
+        if module=="collector":
+            print("{:>17} collector import {} the {:.0f} ms target".format(
+                "", "meets" if imported<=args.target_ms else "misses", args.target_ms))
+
+def main():
+    parser=argparse.ArgumentParser(description="Benchmarks for the OS dashboard simulator")
+    commands=parser.add_subparsers(dest="command", required=True)
+
+    fat_memory=commands.add_parser("fat-memory", help="FileAllocationTable construction time and memory")
+    fat_memory.add_argument("--blocks", type=int, nargs="+", default=[10**6, 10**7])
+    fat_memory.add_argument("--max-object-blocks", type=int, default=10**6,
+                            help="largest table to build with one Block object per block")
+    fat_memory.set_defaults(run=bench_fat_memory)
+
+    placement=commands.add_parser("placement", help="contiguous placement policies under allocate/free churn")
+    placement.add_argument("--blocks", type=int, default=2**16)
+    placement.add_argument("--operations", type=int, default=100000)
+    placement.add_argument("--max-file-blocks", type=int, default=64)
+    placement.add_argument("--fill", type=float, default=0.9, help="target disk utilization")
+    placement.add_argument("--seed", type=int, default=1)
+    placement.set_defaults(run=bench_placement)
+
+    methods=commands.add_parser("methods", help="every allocation method, including buddy, under allocate/free churn")
+    methods.add_argument("--blocks", type=int, default=2**16)
+    methods.add_argument("--operations", type=int, default=100000)
+    methods.add_argument("--max-file-blocks", type=int, default=64)
+    methods.add_argument("--fill", type=float, default=0.9, help="target disk utilization")
+    methods.add_argument("--seed", type=int, default=1)
+    methods.set_defaults(run=bench_methods)
+
+    disk_view=commands.add_parser("disk-view", help="whole-disk block figure render time and payload size")
+    disk_view.add_argument("--blocks", type=int, nargs="+", default=[10**4, 10**5, 10**6])
+    disk_view.add_argument("--seed", type=int, default=1)
+    disk_view.set_defaults(run=bench_disk_view)
+
+    proc_collector=commands.add_parser("proc-collector", help="psutil vs bulk /proc process scans on a synthetic /proc")
+    proc_collector.add_argument("--processes", type=int, nargs="+", default=[1000, 5000, 20000])
+    proc_collector.add_argument("--repeat", type=int, default=3)
+    proc_collector.add_argument("--seed", type=int, default=1)
+    proc_collector.set_defaults(run=bench_proc_collector)
+
+    dedup=commands.add_parser("dedup", help="block hashing throughput and hash index lookup cost")
+    dedup.add_argument("--megabytes", type=int, default=64)
+    dedup.add_argument("--chunk-sizes", type=int, nargs="+", default=[1024, 4096, 65536])
+    dedup.add_argument("--index-sizes", type=int, nargs="+", default=[10**4, 10**5, 10**6])
+    dedup.add_argument("--lookups", type=int, default=100000)
+    dedup.add_argument("--seed", type=int, default=1)
+    dedup.set_defaults(run=bench_dedup)
+
+    compaction=commands.add_parser("compaction", help="online compaction moves and time on a fragmented disk")
+    compaction.add_argument("--blocks", type=int, nargs="+", default=[10**4, 10**5, 10**6])
+    compaction.add_argument("--moves-per-step", type=int, default=64)
+    compaction.add_argument("--seed", type=int, default=1)
+    compaction.set_defaults(run=bench_compaction)
+
+    workload=commands.add_parser("workload", help="replay generated or recorded allocate/free traces against each method")
+    workload.add_argument("--trace", help="trace file to replay instead of the generated workloads")
+    workload.add_argument("--distributions", nargs="+", choices=SIZE_DISTRIBUTIONS, default=SIZE_DISTRIBUTIONS)
+    workload.add_argument("--operations", type=int, default=50000)
+    workload.add_argument("--max-file-blocks", type=int, default=256)
+    workload.add_argument("--blocks", type=int, help="disk size; by default sized from the trace to --fill")
+    workload.add_argument("--fill", type=float, default=0.8, help="average utilization when sizing the disk")
+    workload.add_argument("--arrival-rate", type=float, default=1.0)
+    workload.add_argument("--mean-lifetime", type=float, default=100.0)
+    workload.add_argument("--sample-every", type=int, default=1000)
+    workload.add_argument("--seed", type=int, default=1)
+    workload.set_defaults(run=bench_workload)
+
+    inode=commands.add_parser("inode", help="flat index vs inode-style indirect blocks: metadata and offset lookup")
+    inode.add_argument("--sizes-kb", type=float, nargs="+", default=[1, 64, 1024, 100*1024, 1024**2, 10*1024**2],
+                       help="file sizes in KB (default 1 KB to 10 GB)")
+    inode.add_argument("--lookups", type=int, default=100000)
+    inode.add_argument("--seed", type=int, default=1)
+    inode.set_defaults(run=bench_inode)
+
+    pool=commands.add_parser("pool", help="multi-volume placement policies, striping and parallel bulk load")
+    pool.add_argument("--volumes", type=int, default=4)
+    pool.add_argument("--blocks-per-volume", type=int, default=2**14)
+    pool.add_argument("--stripe-widths", type=int, nargs="+", default=[1, 2, 4])
+    pool.add_argument("--operations", type=int, default=20000)
+    pool.add_argument("--max-file-blocks", type=int, default=256)
+    pool.add_argument("--bulk-files", type=int, default=20000)
+    pool.add_argument("--seed", type=int, default=1)
+    pool.set_defaults(run=bench_pool)
+
+    threads=commands.add_parser("threads", help="concurrent allocate/free from 1-16 threads with invariant checks")
+    threads.add_argument("--blocks", type=int, default=2**16)
+    threads.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    threads.add_argument("--operations", type=int, default=40000, help="total operations, split across threads")
+    threads.add_argument("--max-file-blocks", type=int, default=64)
+    threads.add_argument("--seed", type=int, default=1)
+    threads.add_argument("--tolerance", type=float, default=0.2,
+                         help="allowed drop in region throughput below the best with fewer threads")
+    threads.set_defaults(run=bench_threads)
+
+    race_check=commands.add_parser("race-check", help="threads churn with the table's locks removed: the invariant checks must report races")
+    race_check.add_argument("--blocks", type=int, default=4096)
+    race_check.add_argument("--threads", type=int, default=8)
+    race_check.add_argument("--operations", type=int, default=20000, help="total operations, split across threads")
+    race_check.add_argument("--max-file-blocks", type=int, default=64)
+    race_check.add_argument("--runs", type=int, default=3)
+    race_check.add_argument("--seed", type=int, default=1)
+    race_check.set_defaults(run=bench_race_check)
+
+    layout_mirror=commands.add_parser("layout-mirror", help="follow concurrent churn through layout deltas: the mirror must match the full layout")
+    layout_mirror.add_argument("--blocks", type=int, default=2048)
+    layout_mirror.add_argument("--threads", type=int, default=4)
+    layout_mirror.add_argument("--operations", type=int, default=12000, help="total operations, split across threads")
+    layout_mirror.add_argument("--max-file-blocks", type=int, default=40)
+    layout_mirror.add_argument("--seed", type=int, default=1)
+    layout_mirror.set_defaults(run=bench_layout_mirror)
+
+    history=commands.add_parser("history", help="metric history ingest and the resolution each dashboard range is queried at")
+    history.add_argument("--days", type=int, default=2, help="days of 1s samples to load")
+    history.add_argument("--max-points", type=int, default=300)
+    history.add_argument("--sample-interval", type=float, default=0.02, help="sampler interval for the restart check")
+    history.set_defaults(run=bench_history)
+
+    uploads=commands.add_parser("uploads", help="failed and duplicate uploads through the dashboard routes must leave the stored files intact")
+    uploads.add_argument("--size", type=int, default=5000, help="bytes per uploaded file")
+    uploads.add_argument("--method", choices=METHODS, default="continuous")
+    uploads.set_defaults(run=bench_uploads)
+
+    shared=commands.add_parser("shared-state", help="multi-process consistency and read scaling of the shared state file")
+    shared.add_argument("--blocks", type=int, default=2**14)
+    shared.add_argument("--writers", type=int, default=4)
+    shared.add_argument("--operations", type=int, default=500, help="allocate/free operations per writer")
+    shared.add_argument("--max-file-blocks", type=int, default=64)
+    shared.add_argument("--readers", type=int, nargs="+", default=[1, 2, 4, 8])
+    shared.add_argument("--reads", type=int, default=20000, help="read transactions per reader")
+    shared.add_argument("--samples", type=int, default=300, help="metric samples written by another process")
+    shared.add_argument("--seed", type=int, default=1)
+    shared.set_defaults(run=bench_shared_state)
+
+    startup=commands.add_parser("startup", help="cold import time of the headless collector vs the dashboard")
+    startup.add_argument("--modules", nargs="+", default=["collector", "system_monitor", "file_system", "complete_project"])
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--target-ms", type=float, default=150.0, help="import time budget for the collector")
+    startup.set_defaults(run=bench_startup)
+
+    args=parser.parse_args()
+    # benchmarks that check invariants return True when one was violated
+    if args.run(args):
+        sys.exit(1)
+
+if __name__=='__main__':
+    main()
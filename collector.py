@@ -0,0 +1,96 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from system_monitor import SystemProcessMonitor
+
+# Headless metrics collection: the same sampler and history as the dashboard without importing
+# dash, plotly or pandas, so it starts in a fraction of the time.
+
+SAMPLE_FIELDS=['time','cpu','mem']
+HISTORY_FIELDS=['time','resolution','cpu','cpu_min','cpu_max','mem','mem_min','mem_max']
+
+class CsvExporter:
+    def __init__(self, stream, fields):
+        self.stream=stream
+        self.fields=fields
+        self.writer=csv.writer(stream)
+        self.writer.writerow(fields)
+
+    def write(self, record):
+        self.writer.writerow([record[field] for field in self.fields])
+
+class JsonLinesExporter:
+    def __init__(self, stream, fields=None):
+        self.stream=stream
+
+    def write(self, record):
+        self.stream.write(json.dumps(record)+"\n")
+
+EXPORTERS={'csv': CsvExporter, 'jsonl': JsonLinesExporter}
+
+def collect(monitor, exporter, duration=None, processes=0):
+    # exports each 1s sample once as it lands in the history; with a shared state_dir another
+    # process may be the one sampling, and this one just follows the history file
+    cursor=monitor.history.since(None, 1)['cursor']
+    monitor.start_sampler()
+    end=time.monotonic()+duration if duration else None
+    try:
+        while end is None or time.monotonic()<end:
+            time.sleep(monitor.sample_interval)
+            samples=monitor.get_samples_since(cursor)
+            cursor=samples['cursor']
+            for t, cpu, mem in zip(samples['time'], samples['cpu'], samples['mem']):
+                record={'time': t, 'cpu': round(cpu, 2), 'mem': round(mem, 2)}
+                if processes:
+                    record['processes']=monitor.get_top_processes(processes)
+                exporter.write(record)
+            exporter.stream.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.stop_sampler()
+
+def export_history(monitor, exporter, seconds, max_points):
+    # min/avg/max rollups already in the history (of a state_dir shared with the dashboard)
+    end=time.time()
+    history=monitor.history.query(end-seconds, end, max_points)
+    for i, t in enumerate(history['time'].tolist()):
+        record={'time': t, 'resolution': history['resolution']}
+        for name in ('cpu','mem'):
+            record[name]=round(float(history[name]['avg'][i]), 2)
+            record[name+'_min']=round(float(history[name]['min'][i]), 2)
+            record[name+'_max']=round(float(history[name]['max'][i]), 2)
+        exporter.write(record)
+
+def main():
+    parser=argparse.ArgumentParser(description="Sample CPU and memory without the dashboard and export the samples")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between samples")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds (default: until interrupted)")
+    parser.add_argument("--state-dir", help="share the metric history with dashboard workers using this DASHBOARD_STATE_DIR")
+    parser.add_argument("--collector", choices=['psutil','proc'], default='psutil', help="process scanner for --processes")
+    parser.add_argument("--processes", type=int, default=0, help="add the top N processes by CPU to each sample (jsonl only)")
+    parser.add_argument("--history", type=float, help="export this many seconds of stored rollups and exit")
+    parser.add_argument("--max-points", type=int, default=300, help="point budget for --history")
+    parser.add_argument("--format", choices=EXPORTERS, default='csv')
+    parser.add_argument("--output", help="file to write (default: stdout)")
+    args=parser.parse_args()
+    if args.processes and args.format!='jsonl':
+        parser.error("--processes needs --format jsonl")
+
+    monitor=SystemProcessMonitor(sample_interval=args.interval, state_dir=args.state_dir)
+    if not monitor.set_collector(args.collector):
+        parser.error("the proc collector needs a Linux /proc")
+    stream=open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.history is not None:
+            export_history(monitor, EXPORTERS[args.format](stream, HISTORY_FIELDS), args.history, args.max_points)
+        else:
+            collect(monitor, EXPORTERS[args.format](stream, SAMPLE_FIELDS), args.duration, args.processes)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+
+if __name__=='__main__':
+    main()
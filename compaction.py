@@ -0,0 +1,228 @@
+import numpy as np
+
+class CompactionEngine:
+    # Incremental defragmenter for a FileAllocationTable. The target is the window of
+    # free_blocks length that already holds the most free blocks, so the fewest used
+    # blocks have to leave it; each step evacuates at most moves_per_step of them.
+    def __init__(self, fat, moves_per_step=64):
+        self.fat=fat
+        self.moves_per_step=moves_per_step
+        self.reset()
+
+    def reset(self):
+        # start a new run from the table as it is now
+        if getattr(self, 'relocation', None):
+            with self.fat.exclusive():
+                self._drop_relocation()
+        self.relocation=None
+        self.window=None
+        self.cursor=0
+        self.moves=0
+        self.steps=0
+        self.pinned=set()
+        self.done=False
+        self.before=self.fat.get_fragmentation_info()
+
+    def plan(self):
+        with self.fat.exclusive():
+            return self._plan()
+
+    def _plan(self):
+        info=self.fat.get_fragmentation_info()
+        free=info['free_blocks']
+        self.window=None
+        if free==0 or info['free_segments']<=1:
+            return None
+        cost=self.fat._used_flags().astype(np.int64)
+        for filename in self.pinned:
+            # pinned files stay put, so the window must avoid them
+            if filename in self.fat.file_table:
+                for start, length in self._pinned_runs(self.fat.file_table[filename]):
+                    cost[start:start+length]=self.fat.total_blocks+1
+        counts=np.concatenate(([0], np.cumsum(cost)))
+        in_window=counts[free:]-counts[:-free]
+        start=int(np.argmin(in_window))
+        if in_window[start]>self.fat.total_blocks:
+            return None
+        self.window=(start, start+free)
+        self.cursor=start
+        return {'window':self.window, 'moves_needed':int(in_window[start])}
+
+    def _pinned_runs(self, info):
+        if info['method']=='buddy':
+            # a buddy block only stays a buddy at its aligned address
+            return [(info['buddy_block'], 1<<info['order'])]
+        return info['blocks'].runs()
+
+    def _free_run_outside(self, length):
+        # lowest free run of `length` blocks that does not touch the target window
+        start, end=self.window
+        index=self.fat.free_extents
+        pos=0
+        while True:
+            s=index.find_from(pos, length)
+            if s is None:
+                return None
+            e=s+index.by_start[s]
+            if s>=end or min(e, start)-s>=length:
+                return s
+            if e-max(s, end)>=length:
+                return max(s, end)
+            pos=s+1
+
+    def _free_outside(self):
+        # free blocks outside the target window, lowest first
+        start, end=self.window
+        index=self.fat.free_extents
+        s=index.find_from(0, 1)
+        while s is not None:
+            e=s+index.by_start[s]
+            yield from range(s, min(e, start))
+            yield from range(max(s, end), e)
+            s=index.find_from(e, 1)
+
+    def _file_move(self, filename):
+        # a continuous file moves whole into one free run, or is pinned where it is
+        blocks=self.fat.file_table[filename]['blocks']
+        dst=self._free_run_outside(len(blocks))
+        if dst is None:
+            self.pinned.add(filename)
+            return []
+        return list(zip(blocks, range(dst, dst+len(blocks))))
+
+    def _start_relocation(self, filename, moves):
+        # a continuous file too big for one step keeps its destination run marked as its own
+        # (so no allocation takes it) and moves into it over the following steps
+        size=self.fat.file_table[filename]['size']
+        self.fat._mark_used([dst for src, dst in moves], filename, size)
+        self.relocation={'file':filename, 'moves':moves, 'done':0}
+
+    def _relocate(self, budget):
+        # the next budget blocks of the file in flight; in between, its blocks sit in two runs
+        filename, moves, done=self.relocation['file'], self.relocation['moves'], self.relocation['done']
+        expected=[dst for src, dst in moves[:done]]+[src for src, dst in moves[done:]]
+        if filename not in self.fat.file_table or list(self.fat.file_table[filename]['blocks'])!=expected:
+            # freed or replaced since the last step: hand the rest of the destination back
+            self._drop_relocation()
+            return 0
+        chunk=moves[done:done+budget]
+        self.fat._mark_free([dst for src, dst in chunk], filename)
+        moved=self.fat.move_blocks(chunk)
+        self.relocation['done']+=len(chunk)
+        if self.relocation['done']==len(moves):
+            self.relocation=None
+        return moved
+
+    def _drop_relocation(self):
+        filename, moves, done=self.relocation['file'], self.relocation['moves'], self.relocation['done']
+        self.fat._mark_free([dst for src, dst in moves[done:]], filename)
+        self.relocation=None
+
+    def _used_in_window(self, chunk=4096):
+        # used blocks left in the window, scanned forward from the cursor a chunk at a time
+        start, end=self.window
+        while self.cursor<end:
+            chunk_end=min(self.cursor+chunk, end)
+            for block_num in (np.flatnonzero(self.fat._used_flags(self.cursor, chunk_end))+self.cursor).tolist():
+                yield block_num
+            self.cursor=chunk_end
+
+    def step(self, max_moves=None):
+        # one bounded critical section: allocations wait for at most moves_per_step moves
+        with self.fat.exclusive():
+            return self._step(max_moves)
+
+    def _step(self, max_moves=None):
+        if self.done:
+            return 0
+        budget=max_moves or self.moves_per_step
+        if self.relocation:
+            # finish moving the file in flight before scanning on
+            self.steps+=1
+            moved=self._relocate(budget)
+            self.moves+=moved
+            return moved
+        if self.fat.get_fragmentation_info()['free_segments']<=1:
+            self.done=True
+            return 0
+        if self.window is None and self.plan() is None:
+            self.done=True
+            return 0
+        self.steps+=1
+        moved=0
+        pending=[]
+        free=self._free_outside()
+        stuck=False
+        pinned=len(self.pinned)
+        scan_start=self.cursor
+        for block_num in self._used_in_window():
+            if moved+len(pending)>=budget:
+                self.cursor=block_num
+                break
+            owners=self.fat.block_owners(block_num)
+            if not owners or any(name not in self.fat.file_table for name in owners):
+                # free, or owned by a file that is still being allocated or freed
+                continue
+            info=self.fat.file_table[owners[0]]
+            if info['method']=='buddy':
+                self.pinned.add(owners[0])
+                continue
+            if len(owners)==1 and info['method']=='continuous' and not info.get('dedup'):
+                if owners[0] in self.pinned:
+                    continue
+                if len(info['blocks'])<=budget and moved+len(pending)+len(info['blocks'])>budget and moved+len(pending):
+                    self.cursor=block_num
+                    break
+                if pending:
+                    moved+=self.fat.move_blocks(pending)
+                    pending=[]
+                moves=self._file_move(owners[0])
+                if len(moves)>budget-moved:
+                    self._start_relocation(owners[0], moves)
+                    moved+=self._relocate(budget-moved)
+                    self.cursor=block_num
+                    break
+                if moves:
+                    moved+=self.fat.move_blocks(moves)
+                free=self._free_outside()
+                continue
+            # single blocks are batched so each file's references are rewritten once per step
+            dst=next(free, None)
+            if dst is None:
+                self.cursor=block_num
+                stuck=True
+                break
+            pending.append((block_num, dst))
+        if pending:
+            moved+=self.fat.move_blocks(pending)
+        self.moves+=moved
+        if len(self.pinned)>pinned:
+            self.window=None
+        elif moved==0:
+            # allocations since planning may have landed behind the cursor or used up the space outside
+            if scan_start>self.window[0] and not stuck:
+                self.cursor=self.window[0]
+                return 0
+            if stuck and self.plan() is not None:
+                return 0
+            self.done=True
+        return moved
+
+    def run(self, max_steps=None):
+        while not self.done and (max_steps is None or self.steps<max_steps):
+            self.step()
+        return self.report()
+
+    def report(self):
+        now=self.fat.get_fragmentation_info()
+        gained=self.before['fragmentation_percentage']-now['fragmentation_percentage']
+        return {
+            'steps': self.steps,
+            'moves': self.moves,
+            'done': self.done,
+            'fragmentation_before': self.before['fragmentation_percentage'],
+            'fragmentation_now': now['fragmentation_percentage'],
+            'largest_free_before': self.before['largest_free_segment'],
+            'largest_free_now': now['largest_free_segment'],
+            'fragmentation_gain_per_move': gained/self.moves if self.moves else 0.0
+        }
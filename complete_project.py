@@ -1,22 +1,49 @@
 import dash
 from dash import html, dcc, dash_table
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 import plotly.graph_objs as go
-import plotly.express as px
 import dash_bootstrap_components as dbc
 import base64
 import os
-import pandas as pd
+import time
 import numpy as np
-from file_system import FileAllocationTable
+from file_system import FileAllocationTable, BlockHasher
+from compaction import CompactionEngine
+from io_model import DEVICES, io_costs
+from storage_pool import StoragePool
+from workload import block_counts
 from system_monitor import SystemProcessMonitor, RealFileManager
+from content_store import ContentStore
+from shared_state import SharedState
+from upload_stream import validate_file_header, register_upload_routes, SNIFF_BYTES, CHUNK_SIZE
 
 # Initialize components
 app=dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP,
     'https://use.fontawesome.com/releases/v5.15.4/css/all.css'],suppress_callback_exceptions=True)
-process_monitor=SystemProcessMonitor()
-file_manager=RealFileManager()
+server=app.server
+# With DASHBOARD_STATE_DIR set, worker processes (e.g. gunicorn -w N complete_project:server)
+# share the disk, file metadata and metric history through files in that directory.
+STATE_DIR=os.environ.get("DASHBOARD_STATE_DIR")
+if STATE_DIR:
+    os.makedirs(STATE_DIR, exist_ok=True)
+process_monitor=SystemProcessMonitor(sample_interval=1.0, process_ttl=1.0, state_dir=STATE_DIR)
+process_monitor.start_sampler()
+file_manager=RealFileManager(ContentStore(os.path.join(STATE_DIR, "spill")) if STATE_DIR else None)
 file_system=FileAllocationTable()
+state=SharedState(os.path.join(STATE_DIR, "state.bin") if STATE_DIR else None)
+state.register('file_system', file_system)
+state.register('file_manager', file_manager, ['uploaded_files', 'used_space'])
+state.register('content_store', file_manager.content_store, ['files'])
+storage_pool=StoragePool(volumes=4, blocks_per_volume=1024)
+state.register('storage_pool', storage_pool)
+# the run state is shared too, so whichever worker serves a compaction tick continues the run
+compaction_engine=CompactionEngine(file_system)
+compaction_engine.done=True
+state.register('compaction_engine', compaction_engine, ['window', 'cursor', 'moves', 'steps', 'pinned', 'done', 'before', 'relocation'])
+state.open()
+PROCESS_PAGE_SIZE=25
+POOL_BULK_FILES=100
+TOP_N=10
 
 app.layout=html.Div([
     dcc.Store(id="file-store",storage_type="memory"),
@@ -24,7 +51,8 @@ app.layout=html.Div([
     dcc.Tabs(id="tabs",value='tab-process',children=[
         dcc.Tab(label='Process Management',value='tab-process'),
         dcc.Tab(label='File Management',value='tab-file'),
-        dcc.Tab(label='Disk Fragmentation',value='tab-disk')
+        dcc.Tab(label='Disk Fragmentation',value='tab-disk'),
+        dcc.Tab(label='Storage Pool',value='tab-pool')
     ]),
     html.Div(id='tabs-content')
 ])
@@ -36,16 +64,50 @@ app.layout=html.Div([
 def render_content(tab):
     if tab=='tab-process':
         return html.Div([
+            dcc.Dropdown(
+                id='history-range',
+                options=[
+                    {'label':'Last minute','value':60},
+                    {'label':'Last 10 minutes','value':600},
+                    {'label':'Last hour','value':3600},
+                    {'label':'Last day','value':86400},
+                    {'label':'Last week','value':7*86400},
+                    {'label':'Last 30 days','value':30*86400}
+                ],
+                value=60,
+                clearable=False,
+                style={'width':'200px'}
+            ),
             dcc.Graph(id='cpu-mem-graph'),
+            dcc.Store(id='cpu-mem-cursor',storage_type='memory'),
             html.H2("Running Processes"),
+            dcc.Dropdown(
+                id='process-view',
+                options=[
+                    {'label':'All processes','value':'all'},
+                    {'label':'Top '+str(TOP_N)+' by CPU','value':'cpu'},
+                    {'label':'Top '+str(TOP_N)+' by memory','value':'memory'}
+                ],
+                value='all',
+                clearable=False,
+                style={'width':'200px'}
+            ),
             dash_table.DataTable(
                 id='process-table',
                 columns=[
-                    {"name":"PID","id":"pid"},
-                    {"name":"Name","id":"name"},
-                    {"name":"CPU %","id":"cpu"},
-                    {"name":"Memory %","id":"memory"}
+                    {"name":"PID","id":"pid","type":"numeric"},
+                    {"name":"Name","id":"name","type":"text"},
+                    {"name":"CPU %","id":"cpu","type":"numeric"},
+                    {"name":"Memory %","id":"memory","type":"numeric"}
                 ],
+                page_action='custom',
+                page_current=0,
+                page_size=PROCESS_PAGE_SIZE,
+                sort_action='custom',
+                sort_mode='single',
+                sort_by=[],
+                filter_action='custom',
+                filter_query='',
                 style_cell={'textAlign':'left','padding':'5px'},
                 style_header={'backgroundColor':'lightgrey','fontWeight':'bold'},
                 style_table={'height':'400px','overflowY':'auto'},
@@ -84,11 +146,34 @@ def render_content(tab):
                         options=[
                             {'label':'Continuous','value':'continuous'},
                             {'label':'Linked','value':'linked'},
-                            {'label':'Indexed','value':'indexed'}
+                            {'label':'Indexed','value':'indexed'},
+                            {'label':'Inode (multi-level)','value':'inode'},
+                            {'label':'Buddy','value':'buddy'}
                         ],
                         value='continuous',
                         className="mb-2"
                     ),
+                    dcc.Dropdown(
+                        id='placement-policy',
+                        options=[
+                            {'label':'First Fit','value':'first-fit'},
+                            {'label':'Best Fit','value':'best-fit'},
+                            {'label':'Worst Fit','value':'worst-fit'},
+                            {'label':'Next Fit','value':'next-fit'}
+                        ],
+                        value='first-fit',
+                        clearable=False,
+                        className="mb-2"
+                    ),
+                    dcc.Checklist(
+                        id='dedup-toggle',
+                        options=[{'label':' Deduplicate identical blocks','value':'dedup'}],
+                        value=[],
+                        className="mb-2"
+                    ),
+                    dbc.Button("Compact Disk", id='compact-button', color="secondary", size="sm", className="mb-2"),
+                    dcc.Interval(id='compaction-interval', interval=500, n_intervals=0, disabled=True),
+                    html.Div(id='compaction-status'),
                     html.Div(id='file-upload-output'),
                     html.H4("File System Status",className="mt-3"),
                     html.Div(id='file-system-metrics')
@@ -101,6 +186,12 @@ def render_content(tab):
                         style={'height': '250px'},
                         config={'displayModeBar':False,'scrollZoom':True}
                     ),
+                    html.H4("Whole Disk"),
+                    dcc.Graph(
+                        id='disk-overview',
+                        style={'height': '150px'},
+                        config={'displayModeBar':False}
+                    ),
                     html.H4("Files Table"),
                     dash_table.DataTable(
                         id='files-table',
@@ -139,28 +230,122 @@ def render_content(tab):
                         id='block-distribution',
                         style={'height':'250px'},
                         config={'displayModeBar':False}
+                    ),
+                    dcc.Graph(
+                        id='io-cost',
+                        style={'height':'250px'},
+                        config={'displayModeBar':False}
                     )
                 ], width=8)
             ])
         ])
+    elif tab=='tab-pool':
+        return html.Div([
+            dbc.Row([
+                dbc.Col([
+                    html.H3("Storage Pool",className="mt-3"),
+                    html.Label("Placement"),
+                    dcc.Dropdown(
+                        id='pool-placement',
+                        options=[
+                            {'label':'Round robin','value':'round-robin'},
+                            {'label':'Most free','value':'most-free'},
+                            {'label':'Least fragmented','value':'least-fragmented'},
+                            {'label':'Hash by filename','value':'hash'}
+                        ],
+                        value='round-robin',
+                        clearable=False
+                    ),
+                    html.Label("Stripe width (volumes per file)",className="mt-2"),
+                    dcc.Input(id='pool-stripe-width',type='number',min=1,max=len(storage_pool.volumes),step=1,value=1),
+                    html.Div([
+                        dbc.Button("Bulk Load "+str(POOL_BULK_FILES)+" Files",id='pool-load',color="primary",size="sm",n_clicks=0),
+                        dbc.Button("Free Random Third",id='pool-free',color="secondary",size="sm",n_clicks=0,style={'marginLeft':'10px'})
+                    ],className="mt-3"),
+                    html.Div(id='pool-metrics',className="mt-3")
+                ], width=4),
+                dbc.Col([
+                    html.H3("Volumes"),
+                    dcc.Graph(id='pool-volumes',config={'displayModeBar':False})
+                ], width=8)
+            ])
+        ])
 
 # PROCESS MANAGEMENT
-@app.callback(Output('cpu-mem-graph','figure'),Input('interval-process','n_intervals'))
-def update_cpu_mem_graph(n):
-    times, cpu, mem=process_monitor.get_live_cpu_mem()
+def local_ms(times):
+    # epoch seconds to wall-clock milliseconds, which a plotly date axis takes as plain numbers
+    times=np.asarray(times, dtype=np.float64)
+    if len(times)==0:
+        return []
+    offset=time.localtime(times[-1]).tm_gmtoff
+    return np.round((times+offset)*1000).tolist()
+
+def cpu_mem_figure(seconds):
+    history=process_monitor.get_cpu_mem_history(seconds, max_points=300)
+    times=local_ms(history['time'])
     fig=go.Figure()
-    fig.add_trace(go.Scatter(x=times,y=cpu,mode='lines+markers',name='CPU %'))
-    fig.add_trace(go.Scatter(x=times,y=mem,mode='lines+markers',name='Memory %'))
+    # the avg traces come first so extendData can always target traces 0 and 1
+    for key, name, color in [('cpu','CPU %','rgb(31,119,180)'), ('mem','Memory %','rgb(255,127,14)')]:
+        fig.add_trace(go.Scatter(x=times,y=history[key]['avg'],mode='lines+markers',name=name,line=dict(color=color)))
+    if history['resolution']>1:
+        for key, name, color in [('cpu','CPU %','rgb(31,119,180)'), ('mem','Memory %','rgb(255,127,14)')]:
+            series=history[key]
+            fig.add_trace(go.Scatter(x=times,y=series['max'],mode='lines',line=dict(width=0,color=color),
+                                     showlegend=False,hoverinfo='skip'))
+            fig.add_trace(go.Scatter(x=times,y=series['min'],mode='lines',line=dict(width=0,color=color),
+                                     fill='tonexty',opacity=0.2,name=name+' min/max',hoverinfo='skip'))
     fig.update_layout(
         xaxis_title='Time', yaxis_title='Usage %',yaxis=dict(range=[0,100]),
         margin=dict(l=40,r=40,t=40,b=40),
-        xaxis=dict(tickformat="%H:%M:%S",tickangle=45,nticks=20)
+        xaxis=dict(type='date',tickformat="%H:%M:%S" if seconds<=86400 else "%m-%d %H:%M",tickangle=45,nticks=20)
     )
-    return fig
+    last=float(history['time'][-1]) if len(history['time']) else None
+    return fig, history['resolution'], last
 
-@app.callback(Output('process-table','data'), Input('interval-process','n_intervals'))
-def update_process_table(n):
-    return process_monitor.get_all_processes()
+@app.callback([Output('cpu-mem-graph','figure'), Output('cpu-mem-graph','extendData'), Output('cpu-mem-cursor','data')],
+              [Input('interval-process','n_intervals'),
+               Input('history-range','value')],
+              [State('cpu-mem-cursor','data')])
+def update_cpu_mem_graph(n, seconds, cursor):
+    # The figure is sent once per range change; after that a 1s-resolution view only receives
+    # the samples past this client's cursor through extendData, capped to the window length.
+    # Coarser views are redrawn when a new bucket at their resolution starts.
+    seconds=seconds or 60
+    triggered=[t['prop_id'] for t in dash.callback_context.triggered]
+    redraw=not cursor or cursor.get('seconds')!=seconds or 'history-range.value' in triggered
+    if not redraw and cursor['resolution']>1:
+        bucket=int(time.time()//cursor['resolution'])
+        if bucket==cursor['bucket']:
+            return dash.no_update, dash.no_update, dash.no_update
+        redraw=True
+    if not redraw:
+        samples=process_monitor.get_samples_since(cursor['cursor'])
+        if not samples['gap']:
+            cursor=dict(cursor, cursor=samples['cursor'])
+            if not samples['time']:
+                return dash.no_update, dash.no_update, cursor
+            times=local_ms(samples['time'])
+            max_points=int(seconds/process_monitor.sample_interval)
+            return dash.no_update, (dict(x=[times, times], y=[samples['cpu'], samples['mem']]), [0, 1], max_points), cursor
+    # streaming continues from the last sample the figure holds
+    fig, resolution, last=cpu_mem_figure(seconds)
+    cursor={'seconds': seconds, 'resolution': resolution, 'cursor': last, 'bucket': int(time.time()//resolution)}
+    return fig, dash.no_update, cursor
+
+@app.callback([Output('process-table','data'), Output('process-table','page_count')],
+              [Input('interval-process','n_intervals'),
+               Input('process-table','page_current'),
+               Input('process-table','page_size'),
+               Input('process-table','sort_by'),
+               Input('process-table','filter_query'),
+               Input('process-view','value')])
+def update_process_table(n, page, page_size, sort_by, filter_query, view):
+    # only the visible page (or the top-N rows) is serialized each tick
+    if view in ('cpu','memory'):
+        return process_monitor.get_top_processes(TOP_N, view), 1
+    page_size=page_size or PROCESS_PAGE_SIZE
+    rows, total=process_monitor.get_process_page(page or 0, page_size, sort_by, filter_query)
+    return rows, max(1, -(-total//page_size))
 
 @app.callback(Output('process-details','children'),
               [Input('process-table','selected_rows'),
@@ -173,6 +358,64 @@ def display_process_info(selected_rows,data):
     return process_monitor.get_process_details(pid)
 
 # FILE MANAGEMENT
+MAX_WINDOW_POINTS=100
+MAX_OVERVIEW_POINTS=1000
+# block state on one colour axis: 0 free, 1 used, 2 linked; buckets blend by their mix
+BLOCK_COLORSCALE=[[0,'lightgrey'],[0.5,'rgb(50,168,82)'],[1,'rgb(255,165,0)']]
+
+def disk_block_figure(fat, start, end, max_points):
+    summary=fat.get_block_summary(start, end, max_points)
+    starts=summary['start']
+    widths=summary['width']
+    state=(summary['used']+summary['linked'])/np.maximum(widths,1)
+    if summary['bucket_size']==1:
+        hover_text=[]
+        for block in fat.get_layout_range(start, end):
+            text="Block "+str(block['block_num'])+"<br>"
+            if block['files']:
+                text+="Files:"+", ".join(block['files'])+"<br>"
+            if block['next'] is not None:
+                text+="Next Block: "+str(block['next'])+"<br>"
+            if block['fragments']:
+                text+="Fragments:"+str(block['fragments'])
+            hover_text.append(text)
+        hover=dict(hovertext=hover_text, hoverinfo='text')
+    else:
+        used_pct=summary['used']*100/np.maximum(widths,1)
+        hover=dict(
+            customdata=np.stack([starts, starts+widths-1, used_pct], axis=-1),
+            hovertemplate='Blocks %{customdata[0]}-%{customdata[1]}<br>Used: %{customdata[2]:.1f}%<extra></extra>'
+        )
+    fig=go.Figure(go.Bar(
+        x=starts+(widths-1)/2,
+        y=np.ones(len(starts)),
+        width=widths,
+        marker=dict(color=state, colorscale=BLOCK_COLORSCALE, cmin=0, cmax=2, line=dict(width=0)),
+        showlegend=False,
+        **hover
+    ))
+    fig.update_layout(
+        xaxis_title='Block Number',
+        yaxis=dict(visible=False),
+        bargap=0,
+        margin=dict(l=20, r=20, t=40, b=20),
+        xaxis=dict(range=[start-0.5, end-0.5]),
+        uirevision='disk'
+    )
+    return fig
+
+def files_table_data(fat):
+    # block lists are shown as extents ("0-99, 150") rather than every block number
+    return [
+        {
+            'file_name':fname,
+            'size':info['size'],
+            'blocks':str(fat.file_blocks(fname)),
+            'method':info['method']
+        }
+        for fname, info in list(fat.file_table.items())
+    ]
+
 def parse_uploaded_file(contents, filename):
     try:
         if not contents:
@@ -207,56 +450,11 @@ def parse_uploaded_file(contents, filename):
             raise Exception(f"Failed to decode file content: {str(e)}")
         
         try:
-            mime_types={
-                '.csv':['text/csv','application/csv','text/plain'],
-                '.txt':['text/plain'],
-                '.pdf':['application/pdf'],
-                '.doc':['application/msword'],
-                '.docx':['application/vnd.openxmlformats-officedocument.wordprocessingml.document'],
-                '.xls':['application/vnd.ms-excel'],
-                '.xlsx':['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet']
-            }
-            file_ext=os.path.splitext(filename.lower())[1]
-            print("\nValidating file type: "+str(file_ext))
+            file_ext=validate_file_header(filename, decoded[:SNIFF_BYTES])
+            print("\nValidated file type: "+str(file_ext))
             print("Actual MIME type: "+str(mime_type))
+            return decoded
 
-            if file_ext not in mime_types:
-                print("Error: Unsupported file extension: " + str(file_ext))
-                raise Exception("Unsupported file type: {}. Supported types are: {}".format(file_ext, ", ".join(mime_types.keys())))
-            
-            if filename.lower().endswith('.csv'):
-                try:
-                    text_content=decoded.decode('utf-8')
-                except UnicodeDecodeError:
-                    print("UTF-8 decode failed trying Latin-1")
-                    text_content=decoded.decode('latin-1')
-                return decoded  
-                
-            elif filename.lower().endswith(('.xls','.xlsx')):
-                return decoded 
-                
-            elif filename.lower().endswith(('.txt', '.log')):
-                try:
-                    decoded.decode('utf-8') 
-                except UnicodeDecodeError:
-                    print("Warning: Text file contains non-UTF-8 characters")
-                return decoded
-                
-            elif filename.lower().endswith('.pdf'):
-                if not decoded.startswith(b'%PDF-'):
-                    raise Exception("Invalid PDF file format")
-                return decoded
-                
-            elif filename.lower().endswith(('.doc','.docx')):
-                doc_signatures=[b'\xD0\xCF\x11\xE0', b'PK\x03\x04']
-                if not any(decoded.startswith(sig) for sig in doc_signatures):
-                    raise Exception("Invalid Word document format")
-                return decoded
-                
-            else:
-                print("Treating "+str(filename)+" as binary file")
-                return decoded
-                
         except Exception as e:
             print("Error processing "+filename + ": "+str(e))
             raise Exception("Error processing "+filename +" : "+str(e))
@@ -265,6 +463,66 @@ def parse_uploaded_file(contents, filename):
         print("Error processing "+filename +": "+str(e))
         raise Exception("Could not process file " +filename+": "+str(e))
     
+@state.reading
+def start_streamed_upload(session):
+    if session.filename in file_system.file_table:
+        raise Exception("File already exists")
+    if session.declared_size is not None and not file_manager.can_accommodate_file(session.declared_size):
+        free_space_mb=file_manager.get_available_space()/(1024*1024)
+        raise Exception("Not enough space. Available space: "+"{:.2f}".format(free_space_mb)+" MB")
+    if file_system.dedup:
+        session.block_hasher=BlockHasher(file_system.block_size)
+        session.sinks.append(session.block_hasher.update)
+    # the payload streams to the spill store, never into the Python heap
+    session.spill=file_manager.content_store.writer(session.filename)
+    session.sinks.append(session.spill.write)
+    session.context={'spill':session.spill.path, 'dedup':file_system.dedup}
+
+def resume_streamed_upload(session):
+    # a chunked upload started by another worker: continue its spill file and rebuild the
+    # hashes from what is already in it
+    session.spill=file_manager.content_store.writer(session.filename, session.context['spill'])
+    if session.context['dedup']:
+        session.block_hasher=BlockHasher(file_system.block_size)
+    with open(session.spill.path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            session.replay(chunk)
+            if session.context['dedup']:
+                session.block_hasher.update(chunk)
+    if session.context['dedup']:
+        session.sinks.append(session.block_hasher.update)
+    session.sinks.append(session.spill.write)
+
+@state.writing
+def complete_streamed_upload(session, result):
+    # Another upload may have taken the name since this session started. allocate_file claims
+    # the name under the table lock and refuses a taken one, so the file's metadata is only
+    # registered once the blocks are ours; on any failure abort_streamed_upload drops this
+    # session's spill file and never the entry already stored under the name.
+    block_hasher=getattr(session, 'block_hasher', None)
+    success, msg=file_system.allocate_file(result['filename'], result['size'], method=result['method'],
+                                           block_hashes=block_hasher.digests() if block_hasher else None)
+    if not success:
+        raise Exception(msg)
+    try:
+        file_info=file_manager.register_file(result['filename'], result['size'])
+    except Exception:
+        file_system.deallocate_file(result['filename'])
+        raise
+    session.spill.close()
+    file_info['sha256']=result['sha256']
+    result['num_blocks']=file_info['num_blocks']
+    return result
+
+def abort_streamed_upload(session):
+    if not hasattr(session, 'spill'):
+        # an idle session swept by a worker that never resumed it
+        session.spill=file_manager.content_store.writer(session.filename, session.context['spill'])
+    session.spill.discard()
+
+upload_sessions=register_upload_routes(app.server, start_streamed_upload, complete_streamed_upload, abort_streamed_upload,
+                                       resume_streamed_upload, os.path.join(STATE_DIR, "uploads") if STATE_DIR else None)
+
 @app.callback(
     [
         Output('disk-blocks-visual','figure'),
@@ -276,10 +534,22 @@ def parse_uploaded_file(contents, filename):
     [
         Input('upload-file','contents'),
         Input('upload-file','filename'),
-        Input('allocation-method','value')
+        Input('allocation-method','value'),
+        Input('placement-policy','value'),
+        Input('dedup-toggle','value')
     ]
 )
-def update_file_system(contents, filename, method):
+@state.writing
+def update_file_system(contents, filename, method, policy, dedup):
+    # the table keeps the last settings (streamed uploads read dedup from it), so they are
+    # applied on every change; only a new upload-file value allocates, otherwise changing a
+    # setting would replay the last upload
+    file_system.set_allocation_method(method)
+    file_system.set_placement_policy(policy)
+    file_system.set_dedup('dedup' in (dedup or []))
+    triggered=[t['prop_id'] for t in dash.callback_context.triggered]
+    if contents is not None and not any(prop.startswith('upload-file.') for prop in triggered):
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
     file_list=list(file_system.file_table.keys())
     if contents is None:
         empty_fig=go.Figure()
@@ -298,12 +568,17 @@ def update_file_system(contents, filename, method):
     try:
         if not filename:
             raise Exception("No filename provided")
+        if filename in file_system.file_table:
+            raise Exception("File already exists")
         file_content=parse_uploaded_file(contents,filename)
         if file_content is None:
             raise Exception("Could not parse the file")
-        file_info=file_manager.analyze_file(filename,file_content)
-        file_system.set_allocation_method(method)
-        success, msg=file_system.allocate_file(filename, file_info['size'])
+        file_size=file_manager.analyze_file(filename,file_content)
+        # as for streamed uploads, the space is only registered once the blocks are ours, so a
+        # failed allocation leaves nothing to undo; this upload passes its own settings so a
+        # concurrent one cannot switch them in between
+        success, msg=file_system.allocate_file(filename, file_size, content=file_content,
+                                               method=method, policy=policy, dedup='dedup' in (dedup or []))
         if not success:
             empty_fig = go.Figure()
             empty_fig.add_annotation(
@@ -311,97 +586,53 @@ def update_file_system(contents, filename, method):
                 xref="paper", yref="paper",
                 x=0.5,y=0.5,showarrow=False
             )
-            files_data=[
-                {
-                    'file_name':fname,
-                    'size':info['size'],
-                    'blocks':str(info.get('blocks',info.get('data_blocks', []))),
-                    'method':info['method']
-                }
-                for fname, info in file_system.file_table.items()
-            ]
+            files_data=files_table_data(file_system)
             error_upload_output=html.Div([
                 html.P("Error: " +msg,style={'color':'red'}),
-                html.P("File size: "+str(file_info["size"])+" bytes"),
+                html.P("File size: "+str(file_size)+" bytes"),
                 html.P("Try a different allocation method or free up space")
             ])
             return empty_fig, files_data, "", error_upload_output, file_list
-        file_manager.uploaded_files[filename]=file_info
+        try:
+            file_info=file_manager.register_file(filename, file_size)
+        except Exception:
+            file_system.deallocate_file(filename)
+            raise
+        file_manager.store_content(filename, file_content)
+        file_content=None
         file_list=list(file_system.file_table.keys())
-        blocks=file_system.get_file_layout()
         WINDOW_SIZE=100
-        file_blocks=[]
+        bounds=None
         if filename in file_system.file_table:
-            info=file_system.file_table.get(filename, {})
-            if 'blocks' in info:
-                file_blocks=info.get('blocks',[])
-            elif 'data_blocks' in info:
-                file_blocks=info.get('data_blocks',[])
-
-        if file_blocks:
-            min_b=min(file_blocks)
-            max_b=max(file_blocks)
+            bounds=file_system.file_blocks(filename).bounds()
+
+        if bounds:
+            min_b, max_b=bounds
             center=(min_b+max_b)//2
             start_idx=max(0,center-WINDOW_SIZE//2)
         else:
             start_idx=0
         end_idx=start_idx+WINDOW_SIZE
-        total_blocks=len(blocks)
+        total_blocks=file_system.total_blocks
         if end_idx > total_blocks:
             end_idx=total_blocks
             start_idx=max(0,end_idx-WINDOW_SIZE)
 
-        fig=go.Figure()
-        colors={'free':'lightgrey','used':'rgb(50,168,82)','fragmented':'rgb(255,165,0)'}
-        x_vals=list(range(start_idx, end_idx))
-        for i in x_vals:
-            block=blocks[i]
-            color=colors['free']
-            if block['used']:
-                color=colors['fragmented'] if block['next'] is not None else colors['used']
-
-            hover_text="Block "+str(i)+"<br>"
-            if block['files']:
-                hover_text+="Files:"+", ".join(block['files'])+"<br>"
-            if block['next'] is not None:
-                hover_text+="Next Block: " + str(block['next'])+"<br>"
-            if block['fragments']:
-                hover_text+="Fragments:"+str(block['fragments'])
-            fig.add_trace(go.Bar(
-                x=[i],
-                y=[1],
-                marker_color=color,
-                hovertext=hover_text,
-                hoverinfo='text',
-                showlegend=False
-            ))
-
+        fig=disk_block_figure(file_system, start_idx, end_idx, MAX_WINDOW_POINTS)
         fig.update_layout(
             title=f'Storage Layout (blocks {start_idx}-{end_idx-1})-{filename}',
-            xaxis_title='Block Number',
-            yaxis_title='',
-            height=300,
-            bargap=0,
-            bargroupgap=0,
-            margin=dict(l=20, r=20, t=40, b=20),
-            xaxis=dict(range=[start_idx - 0.5, end_idx - 0.5])
+            height=300
         )
 
-        files_data=[
-            {
-                'file_name':fname,
-                'size':info['size'],
-                'blocks':str(info.get('blocks',info.get('data_blocks',[]))),
-                'method':info['method']
-            }
-            for fname, info in file_system.file_table.items()
-        ]
+        files_data=files_table_data(file_system)
 
         storage_info=file_manager.get_storage_info()
         total_gb=storage_info['total_size']/(1024**3)
         used_gb=storage_info['used_space']/(1024**3)
         free_gb=storage_info['available_space']/(1024**3)
         utilization=storage_info['utilization']
+        dedup_info=file_system.get_dedup_info()
+        fragmentation_info=file_system.get_fragmentation_info()
         metrics=html.Div([
             html.Div([html.I(className="fas fa-hdd",style={'marginRight': '10px'}),html.Strong("Storage Status")],
                      style={'fontSize':'1.2em','marginBottom':'15px'}),
@@ -414,7 +645,12 @@ def update_file_system(contents, filename, method):
                           dbc.Progress([dbc.Progress(value=utilization,
                                                      color="success" if utilization < 70 else "warning" if utilization < 90 else "danger",
                                                      bar=True, label=f"{utilization:.1f}%")], style={'height': '20px'})]),
-                html.P([html.Strong("Total Files: "), html.Span(f"{len(file_manager.get_all_files())}")])
+                html.P([html.Strong("Total Files: "), html.Span(f"{len(file_manager.get_all_files())}")]),
+                html.P([html.Strong("Dedup Ratio: "), html.Span(f"{dedup_info['dedup_ratio']:.2f}x"),
+                        html.Span(f" ({dedup_info['saved_blocks']} blocks shared)", style={'color':'#666'})]),
+                html.P([html.Strong("Fragmentation: "),
+                        html.Span(f"{fragmentation_info['external_fragmentation_percentage']:.1f}% external, "
+                                  f"{fragmentation_info['internal_fragmentation_percentage']:.1f}% internal")])
             ], style={'backgroundColor': '#f8f9fa', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,0.1)'})
         ])
 
@@ -440,17 +676,50 @@ def update_file_system(contents, filename, method):
         empty_fig=go.Figure()
         empty_fig.add_annotation(text="No data to display",xref="paper",yref="paper",x=0.5,y=0.5,showarrow=False)
         file_list=list(file_system.file_table.keys())
-        files_data=[
-            {
-                'file_name':fname,
-                'size':info['size'],
-                'blocks':str(info.get('blocks',info.get('data_blocks', []))),
-                'method':info['method']
-            }
-            for fname, info in file_system.file_table.items()
-        ]
+        files_data=files_table_data(file_system)
         return empty_fig, files_data, "", error_message, file_list
 
+@app.callback(
+    [Output('compaction-status','children'),
+     Output('compaction-interval','disabled')],
+    [Input('compact-button','n_clicks'),
+     Input('compaction-interval','n_intervals')]
+)
+@state.writing
+def run_compaction(n_clicks, n_intervals):
+    # one bounded step per tick, so uploads and allocations keep running between steps
+    triggered=[t['prop_id'] for t in dash.callback_context.triggered]
+    if 'compact-button.n_clicks' in triggered and n_clicks:
+        compaction_engine.reset()
+    elif compaction_engine.done and not compaction_engine.steps:
+        # no run started yet: leave the status as it is
+        return dash.no_update, True
+    compaction_engine.step()
+    report=compaction_engine.report()
+    status="Compaction {}: {} blocks moved in {} steps, fragmentation {:.1f}% -> {:.1f}%, largest free extent {} -> {} blocks".format(
+        "complete" if report['done'] else "running", report['moves'], report['steps'],
+        report['fragmentation_before'], report['fragmentation_now'],
+        report['largest_free_before'], report['largest_free_now'])
+    return html.Small(status), report['done']
+
+@app.callback(
+    Output('disk-overview','figure'),
+    [Input('file-store','data'),
+     Input('disk-overview','relayoutData'),
+     Input('compaction-interval','n_intervals')]
+)
+@state.reading
+def update_disk_overview(file_list, relayout, n_intervals):
+    start, end=0, file_system.total_blocks
+    if relayout and 'xaxis.range[0]' in relayout:
+        start=max(0, int(relayout['xaxis.range[0]']+0.5))
+        end=min(file_system.total_blocks, int(relayout['xaxis.range[1]']+0.5)+1)
+    if end<=start:
+        start, end=0, file_system.total_blocks
+    fig=disk_block_figure(file_system, start, end, MAX_OVERVIEW_POINTS)
+    fig.update_layout(height=150, margin=dict(l=20, r=20, t=10, b=30))
+    return fig
+
 @app.callback(
     Output('file-selector','options'),
     Input('file-store','data')
@@ -464,76 +733,61 @@ def update_file_list(file_list):
 @app.callback(
     [Output('fragmentation-visual', 'figure'),
      Output('block-distribution', 'figure'),
-     Output('fragmentation-metrics', 'children')],
+     Output('fragmentation-metrics', 'children'),
+     Output('io-cost', 'figure')],
     [Input('file-selector', 'value')]
 )
+@state.reading
 def update_fragmentation_analysis(filename):
     if not filename:
         raise dash.exceptions.PreventUpdate
 
-    file_info=file_manager.get_file_info(filename)
-    if not file_info:
-        return {}, {}, html.Div("No file information available")
-
-    fragments=pd.DataFrame(file_info.get('fragments', []))
-    frag_fig=go.Figure()
-    for idx, frag in fragments.iterrows():
-        start=frag.get('start',0)
-        size=frag.get('size',0)
-        blocks=frag.get('blocks',0)
-        frag_fig.add_trace(go.Bar(
-            x=[start],
-            y=[blocks],
-            width=[size],
-            name=f'Fragment {idx+1}',
-            hovertemplate=(
-                f'Fragment {idx+1}<br>' +
-                'Start: %{x}<br>' +
-                'Size: %{width} bytes<br>' +
-                'Blocks: %{y}<extra></extra>'
-            )
-        ))
+    fragments=file_system.get_file_fragments(filename)
+    if fragments is None:
+        return {}, {}, html.Div("No file information available"), {}
+
+    costs=[io_costs(file_system, device) for device in DEVICES]
+    count=len(fragments['blocks'])
+    numbers=np.arange(1, count+1)
+    frag_fig=go.Figure(go.Bar(
+        x=fragments['offset']+fragments['size']/2,
+        y=fragments['blocks'],
+        width=fragments['size'],
+        customdata=np.stack([numbers, fragments['disk_start'], fragments['offset'], fragments['size']], axis=-1),
+        hovertemplate=(
+            'Fragment %{customdata[0]}<br>' +
+            'Start: %{customdata[2]}<br>' +
+            'Size: %{customdata[3]} bytes<br>' +
+            'Disk block: %{customdata[1]}<br>' +
+            'Blocks: %{y}<extra></extra>'
+        )
+    ))
     frag_fig.update_layout(
         title = 'File Fragments Map - ' +str(filename),
         xaxis_title='File Position (bytes)',
         yaxis_title='Number of Blocks',
-        showlegend=True,
+        showlegend=False,
         height=200,
-        barmode='overlay',
         bargap=0,
         margin=dict(l=20, r=20, t=30, b=20),
         plot_bgcolor='white',
         paper_bgcolor='white',
         font=dict(size=10)
     )
+    file_size=file_system.file_table[filename]['size']
+    if file_size > 0:
+        frag_fig.update_xaxes(range=[0,file_size])
 
-    try:
-        file_size=int(file_info.get('size',0))
-        if file_size > 0:
-            frag_fig.update_xaxes(range=[0,file_size])
-    except Exception:
-        pass
-
-    block_sizes = pd.DataFrame({
-        "size": [
-            frag.get("size",0)
-            for frag in file_info.get("fragments",[])
-        ],
-        "fragment": [
-            "Fragment "+str(i+1)
-            for i in range(len(file_info.get("fragments", [])))
-        ]
-    })
-    dist_fig=px.bar(
-        block_sizes,
-        x='fragment',
-        y='size',
-        title='Fragment Size Distribution',
-        labels={'size': 'Size (bytes)', 'fragment': 'Fragment'},
-        height=200
-    )
-
+    dist_fig=go.Figure(go.Bar(
+        x=numbers,
+        y=fragments['size'],
+        hovertemplate='Fragment %{x}<br>Size: %{y} bytes<extra></extra>'
+    ))
     dist_fig.update_layout(
+        title='Fragment Size Distribution',
+        xaxis_title='Fragment',
+        yaxis_title='Size (bytes)',
+        height=200,
         margin=dict(l=20, r=20, t=30, b=20),
         plot_bgcolor='white',
         paper_bgcolor='white',
@@ -542,12 +796,102 @@ def update_fragmentation_analysis(filename):
     )
 
     metrics = html.Div([
-       html.P("File Size: "+str(file_info.get('size',0))+" bytes"),
-        html.P("Number of Blocks: "+str(file_info.get('num_blocks',0))),
-        html.P("Number of Fragments: "+str(len(file_info.get('fragments',[])))),
-        html.P("Fragmentation Score:{:.2f}%".format(file_info.get('fragmentation_score',0))),
+        html.P("File Size: "+str(file_size)+" bytes"),
+        html.P("Number of Blocks: "+str(fragments['num_blocks'])),
+        html.P("Number of Fragments: "+str(count)),
+        html.P("Fragmentation Score:{:.2f}%".format(fragments['fragmentation_score'])),
+    ]+io_cost_metrics(costs, filename), style={'padding':'10px','backgroundColor':'#f8f9fa','borderRadius': '5px'})
+    return frag_fig, dist_fig, metrics, io_cost_figure(costs)
+
+# STORAGE POOL
+@app.callback(
+    [Output('pool-volumes','figure'),
+     Output('pool-metrics','children')],
+    [Input('pool-load','n_clicks'),
+     Input('pool-free','n_clicks'),
+     Input('pool-placement','value'),
+     Input('pool-stripe-width','value')]
+)
+@state.writing
+def update_storage_pool(load_clicks, free_clicks, placement, stripe_width):
+    triggered=[t['prop_id'] for t in dash.callback_context.triggered]
+    storage_pool.set_placement_policy(placement)
+    rng=np.random.default_rng()
+    if 'pool-load.n_clicks' in triggered and load_clicks:
+        # log-normal sizes like the workload generator; volumes are filled in parallel
+        sizes=block_counts('lognormal', POOL_BULK_FILES, rng, max_blocks=64)*storage_pool.block_size
+        names=["bulk{}-{}".format(load_clicks, i) for i in range(POOL_BULK_FILES)]
+        storage_pool.bulk_allocate(zip(names, sizes.tolist()), stripe_width=int(stripe_width or 1))
+    elif 'pool-free.n_clicks' in triggered and free_clicks:
+        names=list(storage_pool.files)
+        for name in rng.choice(names, len(names)//3, replace=False) if names else []:
+            storage_pool.deallocate_file(name)
+    return pool_figure(storage_pool.volume_info()), pool_metrics(storage_pool.get_fragmentation_info())
+
+def pool_figure(volumes):
+    labels=["Volume "+str(v['volume']) for v in volumes]
+    fig=go.Figure([
+        go.Bar(x=labels, y=[v['used_blocks'] for v in volumes], name='Used blocks', marker_color='rgb(31,119,180)',
+               customdata=[[v['files'], v['utilization']] for v in volumes],
+               hovertemplate='%{x}<br>%{y} used blocks, %{customdata[0]} files (%{customdata[1]:.1f}%)<extra></extra>'),
+        go.Bar(x=labels, y=[v['free_blocks'] for v in volumes], name='Free blocks', marker_color='rgb(200,200,200)',
+               customdata=[v['largest_free_segment'] for v in volumes],
+               hovertemplate='%{x}<br>%{y} free blocks, largest run %{customdata}<extra></extra>'),
+        go.Scatter(x=labels, y=[v['fragmentation_percentage'] for v in volumes], name='External fragmentation %',
+                   mode='lines+markers', yaxis='y2', line=dict(color='rgb(214,39,40)'))
+    ])
+    fig.update_layout(
+        barmode='stack',
+        yaxis=dict(title='Blocks'),
+        yaxis2=dict(title='Fragmentation %', overlaying='y', side='right', range=[0,100]),
+        height=350,
+        margin=dict(l=40, r=40, t=30, b=30),
+        legend=dict(orientation='h', y=1.1),
+        plot_bgcolor='white',
+        paper_bgcolor='white'
+    )
+    return fig
+
+def pool_metrics(info):
+    return html.Div([
+        html.P([html.Strong("Files: "), html.Span(str(info['files']))]),
+        html.P([html.Strong("Used: "), html.Span("{} of {} blocks on {} volumes".format(
+            info['used_blocks'], info['total_blocks'], info['volumes']))]),
+        html.P([html.Strong("Largest free run: "), html.Span("{} blocks".format(info['largest_free_segment']))]),
+        html.P([html.Strong("Fragmentation: "), html.Span("{:.1f}% pool-wide, {:.1f}% mean per volume".format(
+            info['fragmentation_percentage'], info['mean_volume_fragmentation']))]),
+        html.P([html.Strong("Utilization spread: "), html.Span("{:.1f} percentage points".format(info['utilization_spread']))])
     ], style={'padding':'10px','backgroundColor':'#f8f9fa','borderRadius': '5px'})
-    return frag_fig, dist_fig, metrics
+
+def io_cost_metrics(costs, filename):
+    # read cost of the selected file on each simulated device
+    if filename not in costs[0]['file_name']:
+        return []
+    i=costs[0]['file_name'].index(filename)
+    items=[html.Strong("Estimated Read Cost")]
+    for cost in costs:
+        items.append(html.P("{}: sequential {:.2f} ms ({:.1f} MB/s, {} seeks), random {:.2f} ms/block ({:.0f} IOPS)".format(
+            cost['device'], cost['sequential_ms'][i], cost['sequential_mb_s'][i], cost['seeks'][i],
+            cost['random_ms'][i], cost['random_iops'][i])))
+    return items
+
+def io_cost_figure(costs):
+    fig=go.Figure([
+        go.Bar(x=cost['file_name'], y=cost['sequential_ms'], name=cost['device'],
+               customdata=np.stack([cost['sequential_mb_s'], cost['seeks']], axis=-1),
+               hovertemplate='%{x}<br>%{y:.2f} ms, %{customdata[0]:.1f} MB/s, %{customdata[1]} seeks<extra></extra>')
+        for cost in costs])
+    fig.update_layout(
+        title='Sequential Read Latency per File',
+        yaxis_title='ms',
+        barmode='group',
+        height=250,
+        margin=dict(l=20, r=20, t=30, b=20),
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        font=dict(size=10)
+    )
+    return fig
 
 if __name__=='__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,124 @@
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+class SpillWriter:
+    # streams one payload into its spill file; the store only lists it once closed. Each write
+    # is flushed, so another worker can pick up an unfinished file (append=True) where it ends.
+    def __init__(self, store, name, path, append=False):
+        self.store=store
+        self.name=name
+        self.path=path
+        self.file=open(path, 'ab' if append else 'wb')
+        self.size=self.file.tell()
+
+    def write(self, data):
+        self.file.write(data)
+        self.file.flush()
+        self.size+=len(data)
+
+    def close(self):
+        self.file.close()
+        self.store._add(self.name, self.path, self.size)
+        return self.size
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path)
+
+class ContentStore:
+    # Uploaded payloads live in a spill directory instead of the Python heap. Reads return
+    # memoryviews over an mmap of the spill file (no copy); the most recently read files stay
+    # mapped up to cache_bytes, colder ones are unmapped and remapped on their next read.
+    # Spill files are never rewritten in place and their names carry the writer's pid, so
+    # worker processes can share a spill_dir once they share `files` (see SharedState).
+    def __init__(self, spill_dir=None, cache_bytes=64*1024*1024):
+        self.spill_dir=spill_dir or tempfile.mkdtemp(prefix="dashboard-spill-")
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.cache_bytes=cache_bytes
+        self.files={}
+        self.mapped=OrderedDict()
+        self.mapped_bytes=0
+        self.hits=0
+        self.misses=0
+        self.sequence=0
+        self.lock=threading.Lock()
+
+    def _path(self):
+        with self.lock:
+            self.sequence+=1
+            return os.path.join(self.spill_dir, "{}-{:08d}.bin".format(os.getpid(), self.sequence))
+
+    def _add(self, name, path, size):
+        with self.lock:
+            old=self.files.get(name)
+            self.files[name]=(path, size)
+            if old is not None:
+                self._unmap(old[0])
+        if old is not None and old[0]!=path:
+            os.remove(old[0])
+
+    def _unmap(self, path):
+        # views handed out earlier keep the mapping alive until they are released
+        mapping=self.mapped.pop(path, None)
+        if mapping is not None:
+            self.mapped_bytes-=len(mapping)
+
+    def writer(self, name, path=None):
+        # path continues a spill file that an unfinished writer (maybe in another process) left
+        if path is not None:
+            return SpillWriter(self, name, path, append=True)
+        return SpillWriter(self, name, self._path())
+
+    def put(self, name, data):
+        writer=self.writer(name)
+        writer.write(data)
+        return writer.close()
+
+    def get(self, name):
+        with self.lock:
+            entry=self.files.get(name)
+            if entry is None:
+                return None
+            path, size=entry
+            if size==0:
+                return memoryview(b'')
+            mapping=self.mapped.get(path)
+            if mapping is not None:
+                self.hits+=1
+                self.mapped.move_to_end(path)
+                return memoryview(mapping)
+            self.misses+=1
+            with open(path, 'rb') as f:
+                mapping=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped[path]=mapping
+            self.mapped_bytes+=size
+            while self.mapped_bytes>self.cache_bytes and len(self.mapped)>1:
+                self._unmap(next(iter(self.mapped)))
+            return memoryview(mapping)
+
+    def remove(self, name):
+        with self.lock:
+            entry=self.files.pop(name, None)
+            if entry is not None:
+                self._unmap(entry[0])
+        if entry is None:
+            return False
+        os.remove(entry[0])
+        return True
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def stats(self):
+        with self.lock:
+            return {
+                'files': len(self.files),
+                'stored_bytes': sum(size for _, size in self.files.values()),
+                'mapped_files': len(self.mapped),
+                'mapped_bytes': self.mapped_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
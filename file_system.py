@@ -1,3 +1,12 @@
+import hashlib
+import heapq
+import os
+import threading
+import numpy as np
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
 class Block:
     def __init__(self, size=1024):
         self.size=size
@@ -6,175 +15,1341 @@ class Block:
         self.next=None
         self.fragments=[]
 
+class BlockArray:
+    # Compact block storage: one NumPy array per Block field, file names interned to ids.
+    def __init__(self, total_blocks, size=1024):
+        self.size=size
+        self.used=np.zeros(total_blocks, dtype=np.uint8)
+        self.next=np.full(total_blocks, -1, dtype=np.int32)
+        self.owner=np.full(total_blocks, -1, dtype=np.int32)
+        self.fragments={}
+        self.extra_owners={}
+        self.file_ids={}
+        self.file_names=[]
+        self.free_ids=[]
+
+    def __len__(self):
+        return len(self.used)
+
+    def intern(self, filename):
+        file_id=self.file_ids.get(filename)
+        if file_id is None:
+            if self.free_ids:
+                file_id=self.free_ids.pop()
+                self.file_names[file_id]=filename
+            else:
+                file_id=len(self.file_names)
+                self.file_names.append(filename)
+            self.file_ids[filename]=file_id
+        return file_id
+
+    def release(self, filename):
+        file_id=self.file_ids.pop(filename, None)
+        if file_id is not None:
+            self.file_names[file_id]=None
+            self.free_ids.append(file_id)
+
+    def nbytes(self):
+        return self.used.nbytes+self.next.nbytes+self.owner.nbytes
+
+class FreeExtentIndex:
+    # Free extents kept by start (dicts plus a max-length tree over 64-block buckets)
+    # and by length (sorted list), so finding a hole never scans the block table.
+    BUCKET=64
+
+    def __init__(self, total_blocks):
+        self.total_blocks=total_blocks
+        self.by_start={}
+        self.by_end={}
+        self.by_length=[]
+        self.bucket_starts={}
+        self.histogram={}
+        self.free_count=0
+        buckets=max(1, (total_blocks+self.BUCKET-1)//self.BUCKET)
+        self.leaves=1
+        while self.leaves<buckets:
+            self.leaves*=2
+        self.tree=[0]*(2*self.leaves)
+        if total_blocks>0:
+            self._insert(0, total_blocks)
+
+    def __len__(self):
+        return len(self.by_start)
+
+    def largest(self):
+        return self.by_length[-1][0] if self.by_length else 0
+
+    def _set_bucket(self, bucket, value):
+        i=bucket+self.leaves
+        self.tree[i]=value
+        i//=2
+        while i:
+            value=max(self.tree[2*i], self.tree[2*i+1])
+            if self.tree[i]==value:
+                break
+            self.tree[i]=value
+            i//=2
+
+    def _insert(self, start, length):
+        self.by_start[start]=length
+        self.by_end[start+length]=start
+        insort(self.by_length, (length, start))
+        self.histogram[length]=self.histogram.get(length, 0)+1
+        self.free_count+=length
+        bucket=start//self.BUCKET
+        self.bucket_starts.setdefault(bucket, set()).add(start)
+        if length>self.tree[bucket+self.leaves]:
+            self._set_bucket(bucket, length)
+
+    def _remove(self, start):
+        length=self.by_start.pop(start)
+        del self.by_end[start+length]
+        del self.by_length[bisect_left(self.by_length, (length, start))]
+        if self.histogram[length]==1:
+            del self.histogram[length]
+        else:
+            self.histogram[length]-=1
+        self.free_count-=length
+        bucket=start//self.BUCKET
+        starts=self.bucket_starts[bucket]
+        starts.discard(start)
+        if not starts:
+            del self.bucket_starts[bucket]
+            self._set_bucket(bucket, 0)
+        elif length==self.tree[bucket+self.leaves]:
+            self._set_bucket(bucket, max(self.by_start[s] for s in starts))
+        return length
+
+    def _first_bucket(self, lo, n):
+        # leftmost bucket >= lo holding an extent of at least n blocks
+        if lo>=self.leaves:
+            return -1
+        i=lo+self.leaves
+        if self.tree[i]>=n:
+            return lo
+        while i>1:
+            if i%2==0 and self.tree[i+1]>=n:
+                i+=1
+                break
+            i//=2
+        else:
+            return -1
+        while i<self.leaves:
+            i=2*i if self.tree[2*i]>=n else 2*i+1
+        return i-self.leaves
+
+    def _last_bucket(self, hi):
+        # rightmost bucket <= hi holding any extent
+        if hi<0:
+            return -1
+        i=hi+self.leaves
+        if self.tree[i]>0:
+            return hi
+        while i>1:
+            if i%2==1 and self.tree[i-1]>0:
+                i-=1
+                break
+            i//=2
+        else:
+            return -1
+        while i<self.leaves:
+            i=2*i+1 if self.tree[2*i+1]>0 else 2*i
+        return i-self.leaves
+
+    def find_from(self, pos, n):
+        # lowest extent start >= pos with room for n blocks
+        bucket=pos//self.BUCKET
+        while True:
+            bucket=self._first_bucket(bucket, n)
+            if bucket<0:
+                return None
+            fits=[s for s in self.bucket_starts[bucket] if s>=pos and self.by_start[s]>=n]
+            if fits:
+                return min(fits)
+            bucket+=1
+
+    def containing(self, pos):
+        # start of the free extent covering block pos, or None if pos is used
+        bucket=pos//self.BUCKET
+        before=[s for s in self.bucket_starts.get(bucket, ()) if s<=pos]
+        if before:
+            start=max(before)
+        else:
+            bucket=self._last_bucket(bucket-1)
+            if bucket<0:
+                return None
+            start=max(self.bucket_starts[bucket])
+        return start if start+self.by_start[start]>pos else None
+
+    def find(self, n, policy="first-fit", cursor=0):
+        # start of a free extent with room for n>0 blocks; zero-block requests never get here
+        if n<=0 or not self.by_length or self.by_length[-1][0]<n:
+            return None
+        if policy=="best-fit":
+            return self.by_length[bisect_left(self.by_length, (n, -1))][1]
+        if policy=="worst-fit":
+            return self.by_length[-1][1]
+        if policy=="next-fit":
+            start=self.find_from(cursor, n)
+            if start is not None:
+                return start
+        return self.find_from(0, n)
+
+    def take(self, start, length):
+        # mark [start, start+length) used; the range must lie inside one free extent
+        extent=self.containing(start)
+        if extent is None or extent+self.by_start[extent]<start+length:
+            raise Exception("Blocks "+str(start)+"-"+str(start+length-1)+" are not free")
+        extent_length=self._remove(extent)
+        if start>extent:
+            self._insert(extent, start-extent)
+        if start+length<extent+extent_length:
+            self._insert(start+length, extent+extent_length-start-length)
+
+    def release(self, start, length):
+        if start in self.by_end:
+            left=self.by_end[start]
+            length+=start-left
+            self._remove(left)
+            start=left
+        if start+length in self.by_start:
+            length+=self._remove(start+length)
+        self._insert(start, length)
+
+    def _runs_between(self, lo, hi):
+        # free (start, length) runs clipped to [lo, hi), in block order
+        pos=lo
+        extent=self.containing(lo) if 0<lo<hi else None
+        if extent is not None and extent<lo:
+            yield lo, min(extent+self.by_start[extent], hi)-lo
+            pos=extent+self.by_start[extent]
+        while pos<hi:
+            start=self.find_from(pos, 1)
+            if start is None or start>=hi:
+                return
+            yield start, min(start+self.by_start[start], hi)-start
+            pos=start+self.by_start[start]
+
+    def lowest_free(self, count, pos=0):
+        # (start, length) runs covering the lowest `count` free blocks from block pos on,
+        # wrapping around to block 0 when the blocks above pos are not enough
+        runs=[]
+        found=0
+        for lo, hi in ((pos, self.total_blocks), (0, pos)):
+            for start, length in self._runs_between(lo, hi):
+                if found==count:
+                    return runs
+                length=min(length, count-found)
+                runs.append((start, length))
+                found+=length
+        return runs
+
+def aligned_pieces(start, end):
+    # [start, end) as maximal power-of-two blocks aligned to their size: (start, order) pairs
+    while start<end:
+        order=(end-start).bit_length()-1
+        if start:
+            order=min(order, (start&-start).bit_length()-1)
+        yield start, order
+        start+=1<<order
+
+class BuddyIndex:
+    # Binary buddy view of the free space: one free set per order (with a heap for the lowest
+    # start), freed blocks merge with their free buddy. Takes and releases of arbitrary runs by
+    # the other methods split or coalesce blocks, so it always mirrors the free block flags.
+    def __init__(self, total_blocks, free_runs=()):
+        self.total_blocks=total_blocks
+        self.max_order=max(0, total_blocks.bit_length()-1)
+        self.free=[set() for _ in range(self.max_order+1)]
+        self.heaps=[[] for _ in range(self.max_order+1)]
+        for start, length in free_runs:
+            self.release(start, length)
+
+    def _add(self, start, order):
+        self.free[order].add(start)
+        heap=self.heaps[order]
+        if len(heap)>2*len(self.free[order])+64:
+            heap[:]=self.free[order]
+            heapq.heapify(heap)
+        else:
+            heapq.heappush(heap, start)
+
+    def _lowest(self, order):
+        # drops heap entries whose block has since been split or merged away
+        heap=self.heaps[order]
+        while heap and heap[0] not in self.free[order]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def _containing(self, block_num):
+        for order in range(self.max_order+1):
+            start=block_num&~((1<<order)-1)
+            if start in self.free[order]:
+                return start, order
+        raise Exception("Block "+str(block_num)+" is not free in the buddy index")
+
+    def find(self, order):
+        # lowest free block of the smallest order >= `order` that has one
+        for candidate in range(order, self.max_order+1):
+            start=self._lowest(candidate)
+            if start is not None:
+                return start
+        return None
+
+    def take(self, start, length):
+        end=start+length
+        pos=start
+        while pos<end:
+            block, order=self._containing(pos)
+            self.free[order].discard(block)
+            block_end=block+(1<<order)
+            for piece in aligned_pieces(block, pos):
+                self._add(*piece)
+            for piece in aligned_pieces(min(end, block_end), block_end):
+                self._add(*piece)
+            pos=block_end
+
+    def release(self, start, length):
+        for block, order in aligned_pieces(start, start+length):
+            while order<self.max_order:
+                buddy=block^(1<<order)
+                if buddy not in self.free[order]:
+                    break
+                self.free[order].discard(buddy)
+                block=min(block, buddy)
+                order+=1
+            self._add(block, order)
+
+    def free_count(self):
+        return sum(len(starts)<<order for order, starts in enumerate(self.free))
+
+def block_runs(block_nums):
+    # group block numbers into (start, length) runs of consecutive blocks
+    if not block_nums:
+        return []
+    low=min(block_nums)
+    if max(block_nums)-low+1==len(block_nums):
+        return [[low, len(block_nums)]]
+    runs=[]
+    for block_num in sorted(block_nums):
+        if runs and runs[-1][0]+runs[-1][1]==block_num:
+            runs[-1][1]+=1
+        else:
+            runs.append([block_num, 1])
+    return runs
+
+# inode-style allocation: direct pointers in the inode, then single/double/triple indirect blocks
+INODE_DIRECT=12
+# lock stripes per table; each covers total_blocks/LOCK_STRIPES consecutive blocks
+LOCK_STRIPES=64
+POINTER_SIZE=4
+INODE_LEVELS=['single', 'double', 'triple']
+
+def inode_index_blocks(data_blocks, pointers_per_block):
+    # indirect blocks needed to address data_blocks, or None past the triple-indirect limit
+    remaining=max(0, data_blocks-INODE_DIRECT)
+    blocks=0
+    for level in range(1, len(INODE_LEVELS)+1):
+        if remaining<=0:
+            return blocks
+        count=min(remaining, pointers_per_block**level)
+        blocks+=sum(-(-count//pointers_per_block**depth) for depth in range(1, level+1))
+        remaining-=count
+    return blocks if remaining<=0 else None
+
+class BlockExtents:
+    # A file's blocks in file order, stored as (start, length) runs. Iterating yields block
+    # numbers lazily; indexing finds the run with a binary search over the run offsets.
+    __slots__=('starts', 'lengths', 'offsets', 'count')
+
+    def __init__(self, runs=()):
+        self.starts=[]
+        self.lengths=[]
+        self.offsets=[]
+        self.count=0
+        for start, length in runs:
+            if self.starts and self.starts[-1]+self.lengths[-1]==start:
+                self.lengths[-1]+=length
+            elif length:
+                self.starts.append(start)
+                self.lengths.append(length)
+                self.offsets.append(self.count)
+            self.count+=length
+
+    @classmethod
+    def from_blocks(cls, block_nums):
+        blocks=np.asarray(block_nums, dtype=np.int64)
+        if not len(blocks):
+            return cls()
+        breaks=np.flatnonzero(np.diff(blocks)!=1)+1
+        starts=blocks[np.concatenate(([0], breaks))]
+        lengths=np.diff(np.concatenate(([0], breaks, [len(blocks)])))
+        return cls(zip(starts.tolist(), lengths.tolist()))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for start, length in zip(self.starts, self.lengths):
+            yield from range(start, start+length)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index<0:
+            index+=self.count
+        if not 0<=index<self.count:
+            raise IndexError("block index out of range")
+        run=bisect_right(self.offsets, index)-1
+        return self.starts[run]+index-self.offsets[run]
+
+    def __eq__(self, other):
+        if isinstance(other, BlockExtents):
+            return self.starts==other.starts and self.lengths==other.lengths
+        return list(self)==list(other)
+
+    __hash__=None
+
+    def runs(self):
+        return list(zip(self.starts, self.lengths))
+
+    def section(self, start, stop):
+        # blocks [start, stop) of the file as their own extents
+        start=max(0, start)
+        stop=min(self.count, stop)
+        if start>=stop:
+            return BlockExtents()
+        first=bisect_right(self.offsets, start)-1
+        last=bisect_right(self.offsets, stop-1)-1
+        runs=[]
+        for run in range(first, last+1):
+            low=max(start, self.offsets[run])
+            high=min(stop, self.offsets[run]+self.lengths[run])
+            runs.append((self.starts[run]+low-self.offsets[run], high-low))
+        return BlockExtents(runs)
+
+    def array(self):
+        lengths=np.array(self.lengths, dtype=np.int64)
+        return np.repeat(np.array(self.starts, dtype=np.int64)-np.array(self.offsets, dtype=np.int64), lengths)+np.arange(self.count)
+
+    def bounds(self):
+        # lowest and highest block number, or None when empty
+        if not self.count:
+            return None
+        return min(self.starts), max(start+length-1 for start, length in zip(self.starts, self.lengths))
+
+    def __str__(self):
+        return ", ".join(str(start) if length==1 else "{}-{}".format(start, start+length-1)
+                         for start, length in zip(self.starts, self.lengths))
+
+    def __repr__(self):
+        return "BlockExtents("+repr(self.runs())+")"
+
+class BlockHasher:
+    # content hash per fixed-size chunk, fed incrementally (whole buffers or streamed pieces)
+    def __init__(self, chunk_size):
+        self.chunk_size=chunk_size
+        self.pending=bytearray()
+        self.hashes=[]
+
+    def update(self, data):
+        view=memoryview(data)
+        if self.pending:
+            take=min(len(view), self.chunk_size-len(self.pending))
+            self.pending+=view[:take]
+            view=view[take:]
+            if len(self.pending)==self.chunk_size:
+                self.hashes.append(hashlib.blake2b(self.pending, digest_size=16).digest())
+                self.pending=bytearray()
+        full=len(view)-len(view)%self.chunk_size
+        for offset in range(0, full, self.chunk_size):
+            self.hashes.append(hashlib.blake2b(view[offset:offset+self.chunk_size], digest_size=16).digest())
+        self.pending+=view[full:]
+
+    def digests(self):
+        if self.pending:
+            return self.hashes+[hashlib.blake2b(self.pending, digest_size=16).digest()]
+        return list(self.hashes)
+
+def chunk_hashes(content, chunk_size):
+    hasher=BlockHasher(chunk_size)
+    hasher.update(content)
+    return hasher.digests()
+
 class FileAllocationTable:
-    def __init__(self, total_blocks=1024):
+    def __init__(self, total_blocks=1024, compact=False, verify=None, dedup=False):
         self.total_blocks=total_blocks
-        self.blocks=[Block() for _ in range(total_blocks)]
+        self.compact=compact
+        if compact:
+            self.blocks=BlockArray(total_blocks)
+        else:
+            self.blocks=[Block() for _ in range(total_blocks)]
+        self.block_size=1024
+        self.pointers_per_block=self.block_size//POINTER_SIZE
         self.file_table={}
         self.current_method="continuous"
-        
+        self.free_extents=FreeExtentIndex(total_blocks)
+        self.placement_policy="first-fit"
+        self.next_fit_cursor=0
+        # recompute all free-space statistics after every change (slow, for tests)
+        self.verify=os.environ.get("FAT_VERIFY")=="1" if verify is None else verify
+        # bumped on every block change; the log keeps the changed runs of recent versions
+        self.layout_version=0
+        self.layout_log=deque(maxlen=256)
+        # content-addressed sharing: hash -> block, block -> reference count / hash
+        self.dedup=dedup
+        self.block_index={}
+        self.block_refs={}
+        self.block_hash={}
+        self.logical_data_blocks=0
+        # built on first use of the buddy method, then kept in step with every take/release
+        self.buddy=None
+        # bytes allocated to file data vs bytes the files actually hold (internal fragmentation)
+        self.allocated_data_bytes=0
+        self.stored_bytes=0
+        # filename -> (file layout_version, fragments) for get_file_fragments
+        self.fragment_cache={}
+        # Locking, always taken in this order:
+        #   dedup_lock  the hash index, reference counts and logical block count
+        #   lock        the allocator: free extents, buddy lists, file_table, pending and totals;
+        #               held only to choose and claim blocks, or to publish or withdraw an entry
+        #   stripes     one per region of stripe_size blocks, ascending, over the block contents
+        #               (used/owner/next, fragments, extra owners)
+        #   log_lock, names_lock  leaves: the layout version and log, the interned file names
+        # Claimed blocks are written under their stripes only, and the stripes are taken before
+        # the allocator lock is dropped, so no one sees the index and the blocks disagree. Threads
+        # working in different regions only meet on the short allocator hold. exclusive() takes
+        # every lock, for moves and consistency checks. Names in flight are in pending.
+        self.stripe_size=max(1, -(-total_blocks//LOCK_STRIPES))
+        self._make_locks()
+        self.pending=set()
+
+    def _make_locks(self):
+        self.dedup_lock=threading.RLock()
+        self.lock=threading.RLock()
+        self.stripes=[threading.RLock() for _ in range(-(-self.total_blocks//self.stripe_size))]
+        self.log_lock=threading.Lock()
+        self.names_lock=threading.Lock()
+
+    def __getstate__(self):
+        # locks belong to one process; a pickled table (shared state, worker pools) gets new ones
+        state=dict(self.__dict__)
+        for name in ('dedup_lock', 'lock', 'stripes', 'log_lock', 'names_lock'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_locks()
+
+    def _lock_stripes(self, runs):
+        # acquires the stripes covering runs in ascending order and returns them
+        size=self.stripe_size
+        if len(runs)==1:
+            start, length=runs[0]
+            held=self.stripes[start//size:(start+length-1)//size+1] if length>0 else []
+        else:
+            indices=set()
+            for start, length in runs:
+                if length>0:
+                    indices.update(range(start//size, (start+length-1)//size+1))
+            held=[self.stripes[i] for i in sorted(indices)]
+        for stripe in held:
+            stripe.acquire()
+        return held
+
+    def _unlock_stripes(self, held):
+        for stripe in reversed(held):
+            stripe.release()
+
+    @contextmanager
+    def _striped(self, runs):
+        held=self._lock_stripes(runs)
+        try:
+            yield
+        finally:
+            self._unlock_stripes(held)
+
+    @contextmanager
+    def exclusive(self):
+        # the whole table at rest: no allocation, free or block write in progress
+        with self.dedup_lock, self.lock:
+            held=self._lock_stripes([(0, self.total_blocks)])
+            try:
+                yield
+            finally:
+                self._unlock_stripes(held)
+
     def set_allocation_method(self, method):
-        if method in ["continuous", "linked", "indexed"]:
+        if method in ["continuous", "linked", "indexed", "inode", "buddy"]:
             self.current_method = method
             return True
         return False
 
-    def get_free_blocks(self, size):
-        free_blocks=[]
-        for i, block in enumerate(self.blocks):
-            if block.used==0:
-                free_blocks.append(i)
-                if len(free_blocks)* block.size>=size:
-                    break
-        return free_blocks
-
-    def allocate_continuous(self, filename, size):
-        blocks_needed=(size + self.blocks[0].size-1)//self.blocks[0].size
-        free_blocks=[]
-        current_sequence=[]
-        for i, block in enumerate(self.blocks):
-            if block.used==0:
-                current_sequence.append(i)
-                if len(current_sequence)==blocks_needed:
-                    free_blocks=current_sequence
-                    break
+    def set_placement_policy(self, policy):
+        if policy in ["first-fit", "best-fit", "worst-fit", "next-fit"]:
+            self.placement_policy=policy
+            return True
+        return False
+
+    def set_dedup(self, enabled):
+        self.dedup=bool(enabled)
+        return True
+
+    def _blocks_needed(self, size):
+        return (size+self.block_size-1)//self.block_size
+
+    def _record_change(self, runs):
+        # called once the blocks hold their new state, with their stripes still held, so a reader
+        # (which takes the stripes after reading the version) never sees a version whose blocks
+        # are not written yet
+        with self.log_lock:
+            self.layout_version+=1
+            self.layout_log.append((self.layout_version, runs))
+
+    def _claim(self, runs):
+        # with the allocator lock held: take the runs out of the free space and lock their
+        # stripes, which the caller releases once the blocks are written
+        for start, length in runs:
+            self.free_extents.take(start, length)
+            if self.buddy:
+                self.buddy.take(start, length)
+        return self._lock_stripes(runs)
+
+    def _write_used(self, block_nums, runs, filename, size, held):
+        try:
+            if self.compact:
+                with self.names_lock:
+                    owner=self.blocks.intern(filename)
+                for start, length in runs:
+                    self.blocks.used[start:start+length]=1
+                    self.blocks.owner[start:start+length]=owner
+            else:
+                for block_num in block_nums:
+                    self.blocks[block_num].used=1
+                    self.blocks[block_num].files[filename]=size
+            self._record_change(runs)
+        finally:
+            self._unlock_stripes(held)
+        if self.verify:
+            self.check_consistency()
+
+    def _mark_used(self, block_nums, filename, size):
+        runs=block_nums.runs() if isinstance(block_nums, BlockExtents) else block_runs(block_nums)
+        with self.lock:
+            held=self._claim(runs)
+        self._write_used(block_nums, runs, filename, size, held)
+
+    def _mark_free(self, block_nums, filename):
+        # the stripes are taken before the blocks go back to the free space, so an allocation
+        # that claims them right away waits until they are cleared
+        runs=block_nums.runs() if isinstance(block_nums, BlockExtents) else block_runs(block_nums)
+        with self.lock:
+            held=self._lock_stripes(runs)
+            for start, length in runs:
+                self.free_extents.release(start, length)
+                if self.buddy:
+                    self.buddy.release(start, length)
+        try:
+            if self.compact:
+                for start, length in runs:
+                    self.blocks.used[start:start+length]=0
+                    self.blocks.owner[start:start+length]=-1
+                    self.blocks.next[start:start+length]=-1
             else:
-                current_sequence=[]
+                for block_num in block_nums:
+                    self.blocks[block_num].used=0
+                    self.blocks[block_num].files.pop(filename, None)
+                    self.blocks[block_num].next=None
+                    self.blocks[block_num].fragments=[]
+            self._record_change(runs)
+        finally:
+            self._unlock_stripes(held)
+        if self.verify:
+            self.check_consistency()
 
-        if len(free_blocks)==blocks_needed:
-            for block_num in free_blocks:
-                self.blocks[block_num].used=1
+    def _add_owner(self, block_num, filename, size):
+        with self._striped([(block_num, 1)]):
+            if self.compact:
+                self.blocks.extra_owners.setdefault(block_num, []).append(filename)
+            else:
                 self.blocks[block_num].files[filename]=size
-            self.file_table[filename]={
+            self._record_change([[block_num, 1]])
+
+    def _remove_owner(self, block_num, filename):
+        with self._striped([(block_num, 1)]):
+            if not self.compact:
+                self.blocks[block_num].files.pop(filename, None)
+            else:
+                extra=self.blocks.extra_owners.get(block_num, [])
+                if self.blocks.file_names[self.blocks.owner[block_num]]==filename:
+                    with self.names_lock:
+                        self.blocks.owner[block_num]=self.blocks.intern(extra.pop(0))
+                else:
+                    extra.remove(filename)
+                if not extra:
+                    self.blocks.extra_owners.pop(block_num, None)
+            self._record_change([[block_num, 1]])
+
+    def _link(self, block_nums):
+        if isinstance(block_nums, BlockExtents):
+            runs=block_nums.runs()
+            block_nums=block_nums.array()
+        else:
+            runs=block_runs(block_nums)
+        with self._striped(runs):
+            if self.compact:
+                if len(block_nums)>1:
+                    self.blocks.next[block_nums[:-1]]=block_nums[1:]
+            else:
+                for prev_block, block_num in zip(block_nums, block_nums[1:]):
+                    self.blocks[prev_block].next=int(block_num)
+            self._record_change(runs)
+
+    def _unlink(self, block_nums):
+        runs=block_runs(block_nums)
+        with self._striped(runs):
+            if self.compact:
+                self.blocks.next[block_nums]=-1
+            else:
+                for block_num in block_nums:
+                    self.blocks[block_num].next=None
+            self._record_change(runs)
+
+    def _set_fragments(self, index_block, data_blocks):
+        with self._striped([(index_block, 1)]):
+            if self.compact:
+                if data_blocks:
+                    self.blocks.fragments[index_block]=data_blocks
+                else:
+                    self.blocks.fragments.pop(index_block, None)
+            else:
+                self.blocks[index_block].fragments=data_blocks
+            self._record_change([[index_block, 1]])
+
+    def _get_fragments(self, block_num):
+        if self.compact:
+            return self.blocks.fragments.get(block_num, [])
+        return self.blocks[block_num].fragments
+
+    def _used_flags(self, start=0, end=None):
+        end=self.total_blocks if end is None else end
+        if self.compact:
+            return self.blocks.used[start:end]
+        return np.fromiter((block.used for block in self.blocks[start:end]), dtype=np.uint8, count=end-start)
+
+    def _linked_flags(self, start=0, end=None):
+        end=self.total_blocks if end is None else end
+        if self.compact:
+            return self.blocks.next[start:end]>=0
+        return np.fromiter((block.next is not None for block in self.blocks[start:end]), dtype=bool, count=end-start)
+
+    def _free_runs(self):
+        # (starts, lengths) of every maximal run of free blocks, in block order
+        edges=np.diff(np.concatenate(([0], (self._used_flags()==0).view(np.int8), [0])))
+        starts=np.flatnonzero(edges==1)
+        return starts, np.flatnonzero(edges==-1)-starts
+
+    def get_free_blocks(self, size):
+        return list(BlockExtents(self.free_extents.lowest_free(max(1, self._blocks_needed(size)))))
+
+    def _choose_blocks(self, method, count, policy=None, near=None):
+        # free blocks for `count` data blocks under `method` (indexed adds its index block first);
+        # near starts the search at that block instead of the policy's, wrapping around
+        if method=="continuous":
+            # an empty file takes no blocks, so it fits even when no free extent is left
+            if count==0:
+                return BlockExtents()
+            if near is not None:
+                start=self.free_extents.find(count, "next-fit", near)
+            else:
+                start=self.free_extents.find(count, policy or self.placement_policy, self.next_fit_cursor)
+                if start is not None:
+                    self.next_fit_cursor=(start+count)%max(1, self.total_blocks)
+            if start is None:
+                return None
+            return BlockExtents([(start, count)])
+        if method=="indexed":
+            count+=1
+        if count>self.free_extents.free_count:
+            return None
+        return BlockExtents(self.free_extents.lowest_free(count, near or 0))
+
+    def _reserve(self, method, count, filename, size, policy=None, near=None):
+        # choose and claim in one allocator hold, so no other allocation can take the same blocks;
+        # the blocks are written after it, under their stripes
+        with self.lock:
+            blocks=self._choose_blocks(method, count, policy, near)
+            if blocks is None:
+                return None
+            runs=blocks.runs()
+            held=self._claim(runs)
+        self._write_used(blocks, runs, filename, size, held)
+        return blocks
+
+    def _publish(self, filename, entry):
+        # the entry only becomes visible once its blocks are fully laid out
+        with self.lock:
+            entry['layout_version']=self.layout_version
+            self.file_table[filename]=entry
+            self.allocated_data_bytes+=self.allocated_blocks(filename)*self.block_size
+            self.stored_bytes+=entry['size']
+
+    def allocate_continuous(self, filename, size, policy=None, near=None):
+        free_blocks=self._reserve("continuous", self._blocks_needed(size), filename, size, policy, near)
+        if free_blocks is not None:
+            self._publish(filename, {
                 'blocks':free_blocks,
                 'size':size,
                 'method':'continuous'
-            }
+            })
             return True
         return False
 
-    def allocate_linked(self, filename, size):
-        blocks_needed=(size+self.blocks[0].size-1)//self.blocks[0].size
-        allocated_blocks=[]
-        prev_block=None
-
-        for i, block in enumerate(self.blocks):
-            if block.used==0:
-                block.used=1
-                block.files[filename]=size
-                allocated_blocks.append(i)
-                if prev_block is not None:
-                    self.blocks[prev_block].next=i
-                prev_block=i
-                if len(allocated_blocks)==blocks_needed:
-                    break
-
-        if len(allocated_blocks)==blocks_needed:
-            self.file_table[filename]={
+    def allocate_linked(self, filename, size, near=None):
+        allocated_blocks=self._reserve("linked", self._blocks_needed(size), filename, size, near=near)
+        if allocated_blocks is not None:
+            self._link(allocated_blocks)
+            self._publish(filename, {
                 'blocks':allocated_blocks,
                 'size':size,
                 'method':'linked'
-            }
+            })
             return True
-        
-        for block_num in allocated_blocks:
-            self.blocks[block_num].used=0
-            self.blocks[block_num].files.pop(filename,None)
-            self.blocks[block_num].next=None
         return False
 
-    def allocate_indexed(self, filename, size):
-        blocks_needed=(size+self.blocks[0].size-1)//self.blocks[0].size
-        free_blocks=self.get_free_blocks(size+self.blocks[0].size)
-        if len(free_blocks)>blocks_needed:
+    def allocate_indexed(self, filename, size, near=None):
+        free_blocks=self._reserve("indexed", self._blocks_needed(size), filename, size, near=near)
+        if free_blocks is not None:
             index_block=free_blocks[0]
-            data_blocks=free_blocks[1:blocks_needed+1]
-            self.blocks[index_block].used=1
-            self.blocks[index_block].files[filename]=size
-            self.blocks[index_block].fragments=data_blocks
-            for block_num in data_blocks:
-                self.blocks[block_num].used=1
-                self.blocks[block_num].files[filename]=size
-            self.file_table[filename]= {
+            data_blocks=free_blocks.section(1, len(free_blocks))
+            self._set_fragments(index_block, data_blocks)
+            self._publish(filename, {
                 'index_block': index_block,
                 'data_blocks': data_blocks,
                 'size': size,
                 'method': 'indexed'
-            }
+            })
             return True
         return False
 
-    def allocate_file(self, filename, size):
-        if filename in self.file_table:
-            return False, "File already exists"
-            
-        if self.current_method=="continuous":
-            success=self.allocate_continuous(filename,size)
-        elif self.current_method=="linked":
-            success=self.allocate_linked(filename,size)
+    def _build_indirect(self, data_blocks, start, stop, level, metadata):
+        # one index block per call; its fragments are the level-1 blocks (or data) below it
+        index_block=next(metadata)
+        if level==1:
+            children=data_blocks.section(start, stop)
         else:
-            success=self.allocate_indexed(filename,size)
-            
+            step=self.pointers_per_block**(level-1)
+            children=BlockExtents.from_blocks([
+                self._build_indirect(data_blocks, child, min(stop, child+step), level-1, metadata)
+                for child in range(start, stop, step)])
+        self._set_fragments(index_block, children)
+        return index_block
+
+    def _build_inode(self, data_blocks, metadata_blocks):
+        # lays the indirect tree over data_blocks, consuming metadata_blocks in depth-first order
+        metadata=iter(metadata_blocks)
+        inode={'direct': data_blocks.section(0, INODE_DIRECT)}
+        start=INODE_DIRECT
+        for level, name in enumerate(INODE_LEVELS, 1):
+            stop=min(len(data_blocks), start+self.pointers_per_block**level)
+            inode[name]=self._build_indirect(data_blocks, start, stop, level, metadata) if start<stop else None
+            start=stop
+        return inode
+
+    def allocate_inode(self, filename, size, near=None):
+        data_count=self._blocks_needed(size)
+        index_count=inode_index_blocks(data_count, self.pointers_per_block)
+        if index_count is None:
+            return False
+        free_blocks=self._reserve("inode", data_count+index_count, filename, size, near=near)
+        if free_blocks is not None:
+            metadata_blocks=free_blocks.section(0, index_count)
+            data_blocks=free_blocks.section(index_count, len(free_blocks))
+            self._publish(filename, {
+                'inode': self._build_inode(data_blocks, metadata_blocks),
+                'metadata_blocks': metadata_blocks,
+                'data_blocks': data_blocks,
+                'size': size,
+                'method': 'inode'
+            })
+            return True
+        return False
+
+    def buddy_index(self):
+        # built from the free extents rather than the block flags, which may trail a claim
+        with self.lock:
+            if self.buddy is None:
+                self.buddy=BuddyIndex(self.total_blocks, sorted(self.free_extents.by_start.items()))
+            return self.buddy
+
+    def allocate_buddy(self, filename, size):
+        # rounds the file up to a power-of-two block; the unused tail is internal fragmentation
+        data_count=self._blocks_needed(size)
+        if data_count==0:
+            self._publish(filename, {'blocks':BlockExtents(), 'buddy_block':None, 'order':0, 'size':size, 'method':'buddy'})
+            return True
+        order=(data_count-1).bit_length()
+        with self.lock:
+            start=self.buddy_index().find(order)
+            if start is None:
+                return False
+            runs=[(start, 1<<order)]
+            held=self._claim(runs)
+        self._write_used(BlockExtents(runs), runs, filename, size, held)
+        self._publish(filename, {
+            'blocks':BlockExtents([(start, data_count)]),
+            'buddy_block':start,
+            'order':order,
+            'size':size,
+            'method':'buddy'
+        })
+        return True
+
+    def allocated_blocks(self, filename):
+        # data blocks a file holds, including a buddy block's unused tail
+        info=self.file_table[filename]
+        if info['method']=='buddy':
+            return 1<<info['order'] if info['buddy_block'] is not None else 0
+        return len(self.file_blocks(filename))
+
+    def allocate_deduplicated(self, filename, size, block_hashes, method=None, policy=None, near=None):
+        # the hash index and reference counts are shared by every file, so this runs under dedup_lock
+        with self.dedup_lock:
+            return self._allocate_deduplicated(filename, size, block_hashes, method or self.current_method, policy, near)
+
+    def _allocate_deduplicated(self, filename, size, block_hashes, method, policy=None, near=None):
+        # chunks whose hash is already stored point at the existing block; only new content takes space.
+        # Linked files never share: a shared block can only carry one next pointer.
+        physical=[None]*len(block_hashes)
+        first_seen={}
+        new_chunks=[]
+        for i, digest in enumerate(block_hashes):
+            if method!="linked" and digest in self.block_index:
+                physical[i]=self.block_index[digest]
+            elif method!="linked" and digest in first_seen:
+                continue
+            else:
+                first_seen.setdefault(digest, i)
+                new_chunks.append(i)
+        with self.lock:
+            chosen=self._choose_blocks(method, len(new_chunks), policy, near)
+            if chosen is None:
+                return False
+            runs=chosen.runs()
+            held=self._claim(runs)
+        self._write_used(chosen, runs, filename, size, held)
+        chosen=list(chosen)
+        index_block=chosen.pop(0) if method=="indexed" else None
+        for i, block_num in zip(new_chunks, chosen):
+            physical[i]=block_num
+            self.block_refs[block_num]=0
+            if block_hashes[i] not in self.block_index:
+                self.block_index[block_hashes[i]]=block_num
+                self.block_hash[block_num]=block_hashes[i]
+        for i, digest in enumerate(block_hashes):
+            if physical[i] is None:
+                physical[i]=physical[first_seen[digest]]
+        new_blocks=set(chosen)
+        for block_num in set(physical):
+            if block_num not in new_blocks:
+                self._add_owner(block_num, filename, size)
+            self.block_refs[block_num]+=1
+        self.logical_data_blocks+=len(physical)
+        shared=sum(1 for block_num in physical if block_num not in new_blocks)
+        physical=BlockExtents.from_blocks(physical)
+        if method=="indexed":
+            self._set_fragments(index_block, physical)
+            self._publish(filename, {
+                'index_block': index_block,
+                'data_blocks': physical,
+                'size': size,
+                'method': 'indexed',
+                'dedup': True,
+                'shared_blocks': shared
+            })
+        else:
+            if method=="linked":
+                self._link(physical)
+            self._publish(filename, {
+                'blocks': physical,
+                'size': size,
+                'method': method,
+                'dedup': True,
+                'shared_blocks': shared
+            })
+        return True
+
+    def allocate_file(self, filename, size, content=None, block_hashes=None, method=None, policy=None, dedup=None, near=None):
+        # method, policy and dedup override the table-wide settings for this call only, so
+        # concurrent uploads with different settings do not race on set_allocation_method.
+        # near (a block number) keeps the search for free blocks in one part of the disk;
+        # buddy blocks ignore it
+        method=method or self.current_method
+        dedup=self.dedup if dedup is None else dedup
+        with self.lock:
+            if filename in self.file_table or filename in self.pending:
+                return False, "File already exists"
+            self.pending.add(filename)
+        try:
+            # inode trees and buddy blocks are laid out whole, so only the classic methods deduplicate
+            if dedup and method in ("continuous", "linked", "indexed") and (content is not None or block_hashes is not None):
+                if block_hashes is None:
+                    block_hashes=chunk_hashes(content, self.block_size)
+                success=self.allocate_deduplicated(filename, size, block_hashes, method, policy, near)
+            elif method=="continuous":
+                success=self.allocate_continuous(filename, size, policy, near)
+            elif method=="linked":
+                success=self.allocate_linked(filename, size, near)
+            elif method=="inode":
+                success=self.allocate_inode(filename, size, near)
+            elif method=="buddy":
+                success=self.allocate_buddy(filename,size)
+            else:
+                success=self.allocate_indexed(filename, size, near)
+        finally:
+            with self.lock:
+                self.pending.discard(filename)
+
         if success:
             return True, "File allocated successfully"
         return False, "Not enough space"
 
     def deallocate_file(self, filename):
-        if filename not in self.file_table:
-            return False
-        file_info=self.file_table[filename]
-        if file_info['method'] in ['continuous', 'linked']:
-            for block_num in file_info['blocks']:
-                self.blocks[block_num].used=0
-                self.blocks[block_num].files.pop(filename, None)
-                self.blocks[block_num].next=None
-        else:
-            index_block=file_info['index_block']
-            self.blocks[index_block].used =0
-            self.blocks[index_block].files.pop(filename, None)
-            self.blocks[index_block].fragments=[]
-            
-            for block_num in file_info['data_blocks']:
-                self.blocks[block_num].used=0
-                self.blocks[block_num].files.pop(filename, None)
-        
-        del self.file_table[filename]
+        # the entry is withdrawn first, so no reader finds a file whose blocks are being freed
+        with self.lock:
+            if filename not in self.file_table:
+                return False
+            file_info=self.file_table[filename]
+            self.allocated_data_bytes-=self.allocated_blocks(filename)*self.block_size
+            self.stored_bytes-=file_info['size']
+            del self.file_table[filename]
+            self.fragment_cache.pop(filename, None)
+            self.pending.add(filename)
+        try:
+            if file_info['method'] in ['continuous', 'linked']:
+                data_blocks=file_info['blocks']
+                metadata_runs=[]
+            elif file_info['method']=='buddy':
+                data_blocks=BlockExtents()
+                metadata_runs=[(file_info['buddy_block'], 1<<file_info['order'])] if file_info['buddy_block'] is not None else []
+            elif file_info['method']=='inode':
+                data_blocks=file_info['data_blocks']
+                metadata_runs=file_info['metadata_blocks'].runs()
+                for index_block in file_info['metadata_blocks']:
+                    self._set_fragments(index_block, [])
+            else:
+                data_blocks=file_info['data_blocks']
+                metadata_runs=[(file_info['index_block'], 1)]
+                self._set_fragments(file_info['index_block'], [])
+            with self.dedup_lock if file_info.get('dedup') else nullcontext():
+                if file_info.get('dedup'):
+                    # shared blocks lose one reference and are only freed with their last one
+                    released=[]
+                    kept=[]
+                    for block_num in set(data_blocks):
+                        self.block_refs[block_num]-=1
+                        if self.block_refs[block_num]==0:
+                            del self.block_refs[block_num]
+                            digest=self.block_hash.pop(block_num, None)
+                            if digest is not None:
+                                del self.block_index[digest]
+                            released.append(block_num)
+                        else:
+                            self._remove_owner(block_num, filename)
+                            kept.append(block_num)
+                    if file_info['method']=='linked' and kept:
+                        self._unlink(kept)
+                    self.logical_data_blocks-=len(data_blocks)
+                    data_blocks=BlockExtents.from_blocks(sorted(released))
+                self._mark_free(BlockExtents(metadata_runs+data_blocks.runs()), filename)
+            if self.compact:
+                with self.names_lock:
+                    self.blocks.release(filename)
+        finally:
+            with self.lock:
+                self.pending.discard(filename)
         return True
 
+    def block_for_offset(self, filename, byte_offset):
+        # physical block holding a byte of the file, or None past its end
+        info=self.file_table.get(filename)
+        if info is None or not 0<=byte_offset<info['size']:
+            return None
+        index=byte_offset//self.block_size
+        if info['method']=='inode':
+            return self._inode_lookup(info['inode'], index)
+        blocks=self.file_blocks(filename)
+        return blocks[index] if index<len(blocks) else None
+
+    def _inode_lookup(self, inode, index):
+        # walks direct pointers, then one index block per indirect level
+        if index<len(inode['direct']):
+            return inode['direct'][index]
+        index-=INODE_DIRECT
+        for level, name in enumerate(INODE_LEVELS, 1):
+            span=self.pointers_per_block**level
+            if index<span:
+                block_num=inode[name]
+                for depth in range(level-1, -1, -1):
+                    step=self.pointers_per_block**depth
+                    children=self._get_fragments(block_num)
+                    if index//step>=len(children):
+                        return None
+                    block_num=children[index//step]
+                    index%=step
+                return block_num
+            index-=span
+        return None
+
+    def file_blocks(self, filename):
+        # data blocks of a file in file order
+        info=self.file_table[filename]
+        return info['blocks'] if 'blocks' in info else info['data_blocks']
+
+    def get_file_fragments(self, filename):
+        # the file's real data runs as arrays; cached until the file's own layout changes
+        info=self.file_table.get(filename)
+        if info is None:
+            return None
+        cached=self.fragment_cache.get(filename)
+        if cached is not None and cached[0]==info['layout_version']:
+            return cached[1]
+        extents=info['blocks'] if 'blocks' in info else info['data_blocks']
+        blocks=np.array(extents.lengths, dtype=np.int64)
+        offsets=np.array(extents.offsets, dtype=np.int64)*self.block_size
+        num_blocks=len(extents)
+        base_fragmentation=(len(blocks)-1)/num_blocks*100 if num_blocks else 0
+        size_factor=min(info['size']/(10*1024*1024), 1)
+        fragments={
+            'disk_start': np.array(extents.starts, dtype=np.int64),
+            'blocks': blocks,
+            'offset': offsets,
+            'size': np.minimum(blocks*self.block_size, info['size']-offsets),
+            'num_blocks': num_blocks,
+            'fragmentation_score': min(base_fragmentation*(1+size_factor), 100)
+        }
+        self.fragment_cache[filename]=(info['layout_version'], fragments)
+        return fragments
+
+    def block_owners(self, block_num):
+        if self.compact:
+            owner=int(self.blocks.owner[block_num])
+            return ([self.blocks.file_names[owner]] if owner>=0 else [])+self.blocks.extra_owners.get(block_num, [])
+        return list(self.blocks[block_num].files)
+
+    def move_blocks(self, moves):
+        with self.exclusive():
+            return self._move_blocks(moves)
+
+    def _move_blocks(self, moves):
+        # relocate used blocks to free ones ([(src, dst), ...]) and rewrite every reference:
+        # file_table block lists, index blocks and their fragments, linked next pointers, dedup maps.
+        # Blocks of files still being allocated or freed (not in file_table) cannot move.
+        mapping={}
+        origins={}
+        touched=[]
+        affected=set()
+        for src, dst in moves:
+            owners=self.block_owners(src)
+            if (not owners or self.free_extents.containing(dst) is None or any(name not in self.file_table for name in owners)
+                    or self.file_table[owners[0]]['method']=='buddy'):
+                raise Exception("Cannot move block "+str(src)+" to "+str(dst))
+            self.free_extents.take(dst, 1)
+            self.free_extents.release(src, 1)
+            if self.buddy:
+                self.buddy.take(dst, 1)
+                self.buddy.release(src, 1)
+            if self.compact:
+                b=self.blocks
+                b.used[dst]=1
+                b.owner[dst]=b.owner[src]
+                b.used[src]=0
+                b.owner[src]=-1
+                b.next[src]=-1
+                if src in b.fragments:
+                    b.fragments[dst]=b.fragments.pop(src)
+                if src in b.extra_owners:
+                    b.extra_owners[dst]=b.extra_owners.pop(src)
+            else:
+                old=self.blocks[src]
+                new=self.blocks[dst]
+                new.used, new.files, new.fragments=1, old.files, old.fragments
+                old.used, old.files, old.next, old.fragments=0, {}, None, []
+            if src in self.block_refs:
+                self.block_refs[dst]=self.block_refs.pop(src)
+            digest=self.block_hash.pop(src, None)
+            if digest is not None:
+                self.block_hash[dst]=digest
+                self.block_index[digest]=dst
+            origin=origins.pop(src, src)
+            mapping[origin]=dst
+            origins[dst]=origin
+            touched+=[src, dst]
+            affected.update(owners)
+        self._record_change(block_runs(set(touched)))
+        for filename in affected:
+            info=self.file_table[filename]
+            if info['method']=='inode':
+                info['metadata_blocks']=BlockExtents.from_blocks([mapping.get(b, b) for b in info['metadata_blocks']])
+                info['data_blocks']=BlockExtents.from_blocks([mapping.get(b, b) for b in info['data_blocks']])
+                info['inode']=self._build_inode(info['data_blocks'], info['metadata_blocks'])
+            elif info['method']=='indexed':
+                info['index_block']=mapping.get(info['index_block'], info['index_block'])
+                info['data_blocks']=BlockExtents.from_blocks([mapping.get(b, b) for b in info['data_blocks']])
+                self._set_fragments(info['index_block'], info['data_blocks'])
+            else:
+                info['blocks']=BlockExtents.from_blocks([mapping.get(b, b) for b in info['blocks']])
+                if info['method']=='linked':
+                    self._link(info['blocks'])
+            info['layout_version']=self.layout_version
+        if self.verify:
+            self.check_consistency()
+        return len(touched)//2
+
+    def get_dedup_info(self):
+        physical=len(self.block_refs)
+        return {
+            'logical_blocks': self.logical_data_blocks,
+            'physical_blocks': physical,
+            'saved_blocks': self.logical_data_blocks-physical,
+            'dedup_ratio': self.logical_data_blocks/physical if physical else 1.0
+        }
+
     def get_fragmentation_info(self):
-        total_free_blocks=sum(1 for block in self.blocks if block.used==0)
-        free_segments=[]
-        current_segment=0
-        
-        for block in self.blocks:
-            if block.used==0:
-                current_segment+=1
-            elif current_segment>0:
-                free_segments.append(current_segment)
-                current_segment=0
-                
-        if current_segment>0:
-            free_segments.append(current_segment)
-            
+        total_free_blocks=self.free_extents.free_count
+        free_segments=len(self.free_extents)
+        largest=self.free_extents.largest()
+
         return {
             'total_blocks': self.total_blocks,
             'free_blocks': total_free_blocks,
             'used_blocks': self.total_blocks - total_free_blocks,
-            'free_segments': len(free_segments),
-            'largest_free_segment': max(free_segments) if free_segments else 0,
-            'average_free_segment': sum(free_segments) / len(free_segments) if free_segments else 0,
-            'fragmentation_percentage': (1 - (max(free_segments) if free_segments else 0) / total_free_blocks) * 100 if total_free_blocks > 0 else 0
+            'free_segments': free_segments,
+            'largest_free_segment': largest,
+            'average_free_segment': total_free_blocks / free_segments if free_segments else 0,
+            'fragmentation_percentage': (1 - largest / total_free_blocks) * 100 if total_free_blocks > 0 else 0,
+            # external fragmentation is the free space split above; internal is allocated but unused space
+            'external_fragmentation_percentage': (1 - largest / total_free_blocks) * 100 if total_free_blocks > 0 else 0,
+            'internal_fragmentation_bytes': self.allocated_data_bytes-self.stored_bytes,
+            'internal_fragmentation_percentage': (1 - self.stored_bytes / self.allocated_data_bytes) * 100 if self.allocated_data_bytes else 0
         }
 
-    def get_file_layout(self):
-        layout=[]
-        for i, block in enumerate(self.blocks):
-            block_info = {
+    def get_free_segment_histogram(self):
+        return dict(sorted(self.free_extents.histogram.items()))
+
+    def check_consistency(self):
+        with self.exclusive():
+            return self._check_consistency()
+
+    def _check_consistency(self):
+        # rebuild the free-space statistics from the block flags and compare
+        starts, lengths=self._free_runs()
+        expected=dict(zip(starts.tolist(), lengths.tolist()))
+        histogram={}
+        for length in expected.values():
+            histogram[length]=histogram.get(length, 0)+1
+        index=self.free_extents
+        problems=[]
+        if index.by_start!=expected:
+            problems.append("free extents differ from block flags")
+        if index.free_count!=int(lengths.sum()):
+            problems.append("free_blocks "+str(index.free_count)+" != "+str(int(lengths.sum())))
+        if index.histogram!=histogram:
+            problems.append("free segment histogram differs")
+        if index.largest()!=(int(lengths.max()) if len(lengths) else 0):
+            problems.append("largest free segment differs")
+        if index.by_length!=sorted((length, start) for start, length in expected.items()):
+            problems.append("length order differs")
+        if self.buddy and self.buddy.free_count()!=index.free_count:
+            problems.append("buddy free lists differ")
+        if problems:
+            raise Exception("Fragmentation statistics out of sync: "+"; ".join(problems))
+        return True
+
+    def _block_info(self, i):
+        if self.compact:
+            owner=int(self.blocks.owner[i])
+            nxt=int(self.blocks.next[i])
+            return {
                 'block_num': i,
-                'used': block.used,
-                'files': list(block.files.keys()),
-                'next': block.next,
-                'fragments': block.fragments
+                'used': int(self.blocks.used[i]),
+                'files': ([self.blocks.file_names[owner]] if owner>=0 else [])+self.blocks.extra_owners.get(i, []),
+                'next': nxt if nxt>=0 else None,
+                'fragments': self.blocks.fragments.get(i, [])
             }
-            layout.append(block_info)
-        return layout
\ No newline at end of file
+        block=self.blocks[i]
+        return {
+            'block_num': i,
+            'used': block.used,
+            'files': list(block.files.keys()),
+            'next': block.next,
+            'fragments': block.fragments
+        }
+
+    def get_layout_range(self, start, end):
+        with self._striped([(max(0, start), min(self.total_blocks, end)-max(0, start))]):
+            return self._get_layout_range(start, end)
+
+    def _get_layout_range(self, start, end):
+        start=max(0, start)
+        end=min(self.total_blocks, end)
+        if not self.compact:
+            return [self._block_info(i) for i in range(start, end)]
+        names=self.blocks.file_names
+        fragments=self.blocks.fragments
+        extra_owners=self.blocks.extra_owners
+        return [
+            {
+                'block_num': i,
+                'used': used,
+                'files': ([names[owner]] if owner>=0 else [])+extra_owners.get(i, []),
+                'next': nxt if nxt>=0 else None,
+                'fragments': fragments.get(i, [])
+            }
+            for i, used, nxt, owner in zip(
+                range(start, end),
+                self.blocks.used[start:end].tolist(),
+                self.blocks.next[start:end].tolist(),
+                self.blocks.owner[start:end].tolist())
+        ]
+
+    def get_block_summary(self, start=0, end=None, max_points=1000):
+        # used/linked block counts per bucket; buckets widen so a view never exceeds max_points
+        end=self.total_blocks if end is None else min(self.total_blocks, end)
+        start=max(0, min(start, end))
+        width=max(1, -(-(end-start)//max(1, max_points)))
+        starts=np.arange(start, end, width)
+        if not len(starts):
+            empty=np.zeros(0, dtype=np.int64)
+            return {'start': empty, 'width': empty, 'used': empty, 'linked': empty, 'bucket_size': width}
+        offsets=starts-start
+        return {
+            'start': starts,
+            'width': np.minimum(width, end-starts),
+            'used': np.add.reduceat(self._used_flags(start, end), offsets, dtype=np.int64),
+            'linked': np.add.reduceat(self._linked_flags(start, end), offsets, dtype=np.int64),
+            'bucket_size': width
+        }
+
+    def get_layout_changes(self, since_version):
+        # blocks changed after since_version; a full layout once the log no longer reaches back.
+        # The blocks are read after the version, under their stripes, so they are at least as
+        # new as the version: a change still being written shows up again under its own version.
+        with self.log_lock:
+            version=self.layout_version
+            if since_version>=version:
+                return {'version': version, 'full': False, 'blocks': []}
+            full=not self.layout_log or since_version<self.layout_log[0][0]-1
+            runs=[] if full else [run for logged, changes in self.layout_log if logged>since_version for run in changes]
+        if full:
+            return {'version': version, 'full': True, 'blocks': self.get_file_layout()}
+        changed=set()
+        for start, length in runs:
+            changed.update(range(start, start+length))
+        with self._striped(block_runs(changed)):
+            blocks=[self._block_info(i) for i in sorted(changed)]
+        return {'version': version, 'full': False, 'blocks': blocks}
+
+    def get_file_layout(self):
+        return self.get_layout_range(0, self.total_blocks)
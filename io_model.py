@@ -0,0 +1,88 @@
+import numpy as np
+
+class DeviceModel:
+    # Simulated block device. Moving between non-adjacent blocks costs a seek that grows with the
+    # square root of the distance plus half a rotation; flash devices use a flat access latency instead.
+    def __init__(self, name, min_seek_ms=0.0, max_seek_ms=0.0, rpm=0, access_ms=0.0, transfer_mb_s=150.0):
+        self.name=name
+        self.min_seek_ms=min_seek_ms
+        self.max_seek_ms=max_seek_ms
+        self.rpm=rpm
+        self.access_ms=access_ms
+        self.transfer_mb_s=transfer_mb_s
+
+    def rotation_ms(self):
+        return 30000.0/self.rpm if self.rpm else 0.0
+
+    def positioning_ms(self, distance, total_blocks):
+        distance=np.asarray(distance, dtype=np.float64)
+        seek=self.min_seek_ms+(self.max_seek_ms-self.min_seek_ms)*np.sqrt(np.minimum(distance/max(1, total_blocks), 1.0))
+        return seek+self.rotation_ms()+self.access_ms
+
+    def transfer_ms(self, blocks, block_size):
+        return np.asarray(blocks, dtype=np.float64)*block_size*1000/(self.transfer_mb_s*1024*1024)
+
+HDD=DeviceModel("HDD (7200 rpm)", min_seek_ms=0.8, max_seek_ms=15.0, rpm=7200, transfer_mb_s=160.0)
+SSD=DeviceModel("SSD", access_ms=0.08, transfer_mb_s=520.0)
+DEVICES=[HDD, SSD]
+
+def read_order_runs(fat, filename):
+    # runs in the order a read touches them: index/indirect blocks first, then data in file order
+    info=fat.file_table[filename]
+    if info['method']=='indexed':
+        metadata=[(info['index_block'], 1)]
+    elif info['method']=='inode':
+        metadata=info['metadata_blocks'].runs()
+    else:
+        metadata=[]
+    return metadata+fat.file_blocks(filename).runs()
+
+def io_costs(fat, device, names=None):
+    # sequential and random single-block read cost for every file in one vectorized pass
+    names=list(fat.file_table) if names is None else list(names)
+    starts=[]
+    lengths=[]
+    ids=[]
+    for file_id, filename in enumerate(names):
+        runs=read_order_runs(fat, filename)
+        starts.extend(start for start, _ in runs)
+        lengths.extend(length for _, length in runs)
+        ids.extend([file_id]*len(runs))
+    starts=np.array(starts, dtype=np.int64)
+    lengths=np.array(lengths, dtype=np.int64)
+    ids=np.array(ids, dtype=np.int64)
+    count=len(names)
+    total=fat.total_blocks
+
+    blocks=np.bincount(ids, weights=lengths, minlength=count)
+    extents=np.bincount(ids, minlength=count)
+    # a reposition happens wherever the next run of the same file does not follow the previous one
+    distance=np.abs(starts[1:]-(starts[:-1]+lengths[:-1]))
+    jumps=(ids[1:]==ids[:-1])&(distance>0)
+    jump_ms=np.bincount(ids[1:][jumps], weights=device.positioning_ms(distance[jumps], total), minlength=count)
+    seeks=np.bincount(ids[1:][jumps], minlength=count)
+    has_data=blocks>0
+    # the first access comes from a random head position: a third of the disk away on average
+    first_ms=np.where(has_data, device.positioning_ms(total/3, total), 0.0)
+    sequential_ms=first_ms+jump_ms+device.transfer_ms(blocks, fat.block_size)
+    megabytes=blocks*fat.block_size/(1024*1024)
+
+    # random reads jump between blocks of the file, a third of its span apart on average
+    span=np.zeros(count)
+    if len(starts):
+        first_run=np.flatnonzero(np.concatenate(([True], ids[1:]!=ids[:-1])))
+        low=np.minimum.reduceat(starts, first_run)
+        high=np.maximum.reduceat(starts+lengths, first_run)
+        span[ids[first_run]]=high-low
+    random_ms=np.where(has_data, device.positioning_ms(span/3, total)+device.transfer_ms(1, fat.block_size), 0.0)
+    return {
+        'device': device.name,
+        'file_name': names,
+        'blocks': blocks.astype(np.int64),
+        'extents': extents,
+        'seeks': seeks,
+        'sequential_ms': sequential_ms,
+        'sequential_mb_s': np.divide(megabytes*1000, sequential_ms, out=np.zeros(count), where=sequential_ms>0),
+        'random_ms': random_ms,
+        'random_iops': np.divide(1000.0, random_ms, out=np.zeros(count), where=random_ms>0)
+    }
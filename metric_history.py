@@ -0,0 +1,146 @@
+import mmap
+import os
+import threading
+import numpy as np
+from shared_state import FileLock
+
+# (seconds per bucket, buckets kept): 1s for 10 minutes, 1 min for a day, 1 h for 30 days
+DEFAULT_LEVELS=((1, 600), (60, 1440), (3600, 720))
+
+class RollupRing:
+    # Fixed-size ring of min/sum/max rollups at one resolution, updated in place per sample.
+    # All arrays, including head/bucket/filled, are views over one buffer so the ring can live
+    # in a file mapping that several processes share.
+    def __init__(self, resolution, capacity, num_series, buffer=None, offset=0):
+        self.resolution=resolution
+        self.capacity=capacity
+        if buffer is None:
+            buffer=bytearray(self.nbytes(capacity, num_series))
+        shapes=[('state', 3, np.int64), ('time', capacity, np.float64), ('count', capacity, np.int64),
+                ('min', (capacity, num_series), np.float64), ('sum', (capacity, num_series), np.float64),
+                ('max', (capacity, num_series), np.float64)]
+        for name, shape, dtype in shapes:
+            array=np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+            setattr(self, name, array)
+            offset+=array.nbytes
+        if self.state[0]==0 and self.state[2]==0:
+            # fresh zeroed buffer: head=-1, no bucket yet
+            self.state[:]=(-1, -1, 0)
+
+    @staticmethod
+    def nbytes(capacity, num_series):
+        return 8*(3+2*capacity+3*capacity*num_series)
+
+    @property
+    def head(self):
+        return int(self.state[0])
+
+    @property
+    def bucket(self):
+        return int(self.state[1])
+
+    @property
+    def filled(self):
+        return int(self.state[2])
+
+    def add(self, timestamp, values):
+        bucket=int(timestamp//self.resolution)
+        if bucket>self.bucket:
+            i=(self.head+1)%self.capacity
+            self.state[:]=(i, bucket, min(self.filled+1, self.capacity))
+            self.time[i]=bucket*self.resolution
+            self.count[i]=0
+            self.min[i]=values
+            self.max[i]=values
+            self.sum[i]=0
+        i=self.head
+        np.minimum(self.min[i], values, out=self.min[i])
+        np.maximum(self.max[i], values, out=self.max[i])
+        self.sum[i]+=values
+        self.count[i]+=1
+
+    def covers(self, start):
+        # True while the ring still holds everything back to `start`
+        if self.filled<self.capacity:
+            return True
+        return self.time[(self.head+1)%self.capacity]<=start
+
+    def rows(self, start, end):
+        order=(np.arange(self.filled)+self.head+1-self.filled)%self.capacity
+        times=self.time[order]
+        keep=order[(times+self.resolution>start)&(times<=end)]
+        return self.time[keep], self.count[keep], self.min[keep], self.sum[keep], self.max[keep]
+
+class MetricHistory:
+    # With a path the rings live in a file mapping guarded by a FileLock, so worker processes
+    # read one history that a single sampler process writes.
+    def __init__(self, series, levels=DEFAULT_LEVELS, path=None):
+        self.series=list(series)
+        sizes=[RollupRing.nbytes(capacity, len(self.series)) for _, capacity in levels]
+        if path is None:
+            self._lock=threading.Lock()
+            self.buffer=bytearray(sum(sizes))
+        else:
+            self._lock=FileLock(path+".lock")
+            with self._lock:
+                fd=os.open(path, os.O_RDWR|os.O_CREAT, 0o644)
+                if os.fstat(fd).st_size!=sum(sizes):
+                    # new file, or one laid out for other levels: start from an empty history
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, sum(sizes))
+                self.buffer=mmap.mmap(fd, sum(sizes))
+                os.close(fd)
+        offsets=np.cumsum([0]+sizes[:-1])
+        with self._lock:
+            self.levels=[RollupRing(resolution, capacity, len(self.series), self.buffer, int(offset))
+                         for (resolution, capacity), offset in zip(levels, offsets)]
+
+    def add(self, timestamp, *values):
+        values=np.asarray(values, dtype=np.float64)
+        with self._lock:
+            for ring in self.levels:
+                ring.add(timestamp, values)
+
+    def pick_level(self, start):
+        # finest resolution that still reaches back to `start`, give or take the bucket on the left
+        # edge (a full 1s ring spans 599 s, not the 600 of "last 10 minutes"); query() regroups
+        # its rows down to max_points, so a coarser ring is only used once the finer ones wrapped
+        for ring in self.levels:
+            if ring.covers(start+ring.resolution):
+                return ring
+        return self.levels[-1]
+
+    def query(self, start, end, max_points=300):
+        with self._lock:
+            ring=self.pick_level(start)
+            times, count, low, total, high=ring.rows(start, end)
+        resolution=ring.resolution
+        if len(times)>max_points:
+            group=-(-len(times)//max_points)
+            edges=np.arange(0, len(times), group)
+            times=times[edges]
+            count=np.add.reduceat(count, edges)
+            low=np.minimum.reduceat(low, edges)
+            total=np.add.reduceat(total, edges)
+            high=np.maximum.reduceat(high, edges)
+            resolution*=group
+        average=total/np.maximum(count, 1)[:, None]
+        result={'resolution': resolution, 'time': times}
+        for i, name in enumerate(self.series):
+            result[name]={'min': low[:, i], 'avg': average[:, i], 'max': high[:, i]}
+        return result
+
+    def since(self, cursor, limit=None):
+        # Finest-resolution rows newer than the bucket time `cursor`, at most `limit` of them.
+        # gap=True when there is no cursor or the ring no longer reaches back to it.
+        with self._lock:
+            ring=self.levels[0]
+            gap=cursor is None or not ring.covers(cursor)
+            times, count, low, total, high=ring.rows(-np.inf if gap else cursor+ring.resolution, np.inf)
+        if limit is not None:
+            times, count, total=times[-limit:], count[-limit:], total[-limit:]
+        average=total/np.maximum(count, 1)[:, None]
+        result={'gap': gap, 'time': times, 'cursor': float(times[-1]) if len(times) else cursor}
+        for i, name in enumerate(self.series):
+            result[name]=average[:, i]
+        return result
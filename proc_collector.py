@@ -0,0 +1,87 @@
+import os
+import numpy as np
+
+class ProcCollector:
+    # Linux-only process collector: reads /proc/[pid]/stat and statm directly into columns
+    # and derives CPU % from jiffy deltas between scans, without a psutil.Process per pid.
+    def __init__(self, proc_root='/proc'):
+        self.proc_root=proc_root
+        self.page_size=os.sysconf('SC_PAGE_SIZE')
+        self._buffer=bytearray(4096)
+        self._view=memoryview(self._buffer)
+        self._prev_pids=np.zeros(0, dtype=np.int64)
+        self._prev_jiffies=np.zeros(0, dtype=np.int64)
+        self._prev_total=None
+        self.num_cpus, _=self._read_cpu_totals()
+        self.mem_total=self._read_mem_total()
+
+    @staticmethod
+    def available(proc_root='/proc'):
+        return os.path.isfile(os.path.join(proc_root, 'stat'))
+
+    def _read(self, path):
+        fd=os.open(path, os.O_RDONLY)
+        try:
+            size=os.readv(fd, [self._buffer])
+        finally:
+            os.close(fd)
+        return bytes(self._view[:size])
+
+    def _read_cpu_totals(self):
+        num_cpus=0
+        total=0
+        with open(os.path.join(self.proc_root, 'stat'), 'rb') as f:
+            for line in f:
+                if line.startswith(b'cpu '):
+                    total=sum(int(v) for v in line.split()[1:])
+                elif line.startswith(b'cpu'):
+                    num_cpus+=1
+                else:
+                    break
+        return max(1, num_cpus), total
+
+    def _read_mem_total(self):
+        with open(os.path.join(self.proc_root, 'meminfo'), 'rb') as f:
+            for line in f:
+                if line.startswith(b'MemTotal:'):
+                    return int(line.split()[1])*1024
+        return 0
+
+    def scan(self):
+        # returns (pids, names, cpu_percent, memory_percent) as NumPy columns
+        pids=[]
+        names=[]
+        jiffies=[]
+        rss=[]
+        root=self.proc_root
+        for entry in os.scandir(root):
+            if not entry.name.isdigit():
+                continue
+            try:
+                stat=self._read(root+'/'+entry.name+'/stat')
+                statm=self._read(root+'/'+entry.name+'/statm')
+            except OSError:
+                continue
+            close=stat.rfind(b')')
+            fields=stat[close+2:].split()
+            pids.append(int(entry.name))
+            names.append(stat[stat.find(b'(')+1:close].decode('utf-8', 'replace'))
+            jiffies.append(int(fields[11])+int(fields[12]))
+            rss.append(int(statm.split()[1]))
+
+        _, total=self._read_cpu_totals()
+        pids=np.array(pids, dtype=np.int64)
+        jiffies=np.array(jiffies, dtype=np.int64)
+        cpu=np.zeros(len(pids))
+        if self._prev_total is not None and total>self._prev_total and len(self._prev_pids):
+            pos=np.minimum(np.searchsorted(self._prev_pids, pids), len(self._prev_pids)-1)
+            known=self._prev_pids[pos]==pids
+            delta=np.maximum(jiffies-np.where(known, self._prev_jiffies[pos], jiffies), 0)
+            cpu=np.round(delta*100.0*self.num_cpus/(total-self._prev_total), 1)
+        order=np.argsort(pids)
+        self._prev_pids=pids[order]
+        self._prev_jiffies=jiffies[order]
+        self._prev_total=total
+
+        memory=np.round(np.array(rss, dtype=np.float64)*self.page_size*100/max(1, self.mem_total), 2)
+        return pids, names, cpu, memory
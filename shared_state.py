@@ -0,0 +1,219 @@
+import functools
+import mmap
+import os
+import pickle
+import struct
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # no flock() on Windows: only the single-process, path-less mode is available
+    fcntl=None
+
+# state file header: version, payload length
+HEADER=struct.Struct('<QQ')
+
+class FileLock:
+    # flock() between processes plus a readers-writer lock inside one, since flock does not
+    # exclude threads sharing the descriptor. Shared holders run side by side: the first one
+    # takes LOCK_SH for the process and the last one drops it. Writers wait for the readers
+    # to drain and hold new ones off. Re-entrant per thread; a nested hold keeps the outer mode.
+    def __init__(self, path=None):
+        if path and fcntl is None:
+            raise Exception("Sharing state between processes needs fcntl.flock, which this platform lacks")
+        self.fd=os.open(path, os.O_RDWR|os.O_CREAT, 0o644) if path else None
+        self.cond=threading.Condition()
+        self.readers=0
+        self.writing=False
+        self.waiting_writers=0
+        self.holds=threading.local()
+
+    @property
+    def depth(self):
+        # this thread's nesting depth
+        return getattr(self.holds, 'depth', 0)
+
+    def acquire(self, exclusive=True):
+        if self.depth:
+            self.holds.depth+=1
+            return
+        with self.cond:
+            if exclusive:
+                self.waiting_writers+=1
+                while self.writing or self.readers:
+                    self.cond.wait()
+                self.waiting_writers-=1
+                self.writing=True
+                if self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_EX)
+            else:
+                while self.writing or self.waiting_writers:
+                    self.cond.wait()
+                if self.readers==0 and self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_SH)
+                self.readers+=1
+        self.holds.exclusive=exclusive
+        self.holds.depth=1
+
+    def release(self):
+        self.holds.depth-=1
+        if self.holds.depth:
+            return
+        with self.cond:
+            if self.holds.exclusive:
+                self.writing=False
+                if self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+            else:
+                self.readers-=1
+                if self.readers==0 and self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.cond.notify_all()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd=None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def claim(self):
+        # non-blocking exclusive lock kept until the process exits: at most one process holds it
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+class SharedState:
+    # One lock and one versioned snapshot for objects that several worker processes serve.
+    # Every process keeps live copies of the registered objects; writes pickle their shared
+    # fields into an mmap'd file and bump the version, reads reload them only when the version
+    # moved. Without a path read() and write() do nothing: in one process the registered
+    # objects do their own thread locking, so parallel requests are not serialized here.
+    def __init__(self, path=None):
+        self.path=path
+        self.lock=FileLock(path+".lock" if path else None)
+        self.fd=os.open(path, os.O_RDWR|os.O_CREAT, 0o644) if path else None
+        self.map=None
+        # shared holders may reload side by side; only one of them maps and unpickles at a time
+        self.load_lock=threading.Lock()
+        self.objects={}
+        self.version=0
+        self.loads=0
+        self.saves=0
+
+    def register(self, name, obj, fields=None):
+        # fields=None shares every attribute the object pickles, so per-process locks stay out
+        if fields is None:
+            getstate=getattr(obj, '__getstate__', None)
+            fields=getstate() if getstate else vars(obj)
+        self.objects[name]=(obj, list(fields))
+
+    def open(self):
+        # the first process to open the file publishes its objects, later ones load them
+        if self.fd is None:
+            return self
+        with self.lock:
+            if self._header()[0]==0:
+                self._save()
+            else:
+                self._load()
+        return self
+
+    def _remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map=mmap.mmap(self.fd, os.fstat(self.fd).st_size)
+
+    def _header(self):
+        if self.map is None:
+            if os.fstat(self.fd).st_size<HEADER.size:
+                return 0, 0
+            self._remap()
+        return HEADER.unpack_from(self.map, 0)
+
+    def _load(self):
+        version, length=self._header()
+        if version==self.version or version==0:
+            return False
+        if HEADER.size+length>len(self.map):
+            self._remap()
+        with memoryview(self.map)[HEADER.size:HEADER.size+length] as payload:
+            state=pickle.loads(payload)
+        for name, values in state.items():
+            obj=self.objects[name][0]
+            for field, value in values.items():
+                setattr(obj, field, value)
+        self.version=version
+        self.loads+=1
+        return True
+
+    def _save(self):
+        payload=pickle.dumps({name: {field: getattr(obj, field) for field in fields}
+                              for name, (obj, fields) in self.objects.items()}, pickle.HIGHEST_PROTOCOL)
+        size=HEADER.size+len(payload)
+        if self.map is None or size>len(self.map):
+            current=os.fstat(self.fd).st_size
+            if current<size:
+                os.ftruncate(self.fd, max(size, 2*current, mmap.PAGESIZE))
+            self._remap()
+        version=self._header()[0]+1
+        self.map[HEADER.size:size]=payload
+        HEADER.pack_into(self.map, 0, version, len(payload))
+        self.version=version
+        self.saves+=1
+
+    @contextmanager
+    def _hold(self, exclusive):
+        if self.fd is None:
+            yield self
+            return
+        self.lock.acquire(exclusive)
+        try:
+            outer=self.lock.depth==1
+            if outer:
+                with self.load_lock:
+                    self._load()
+            try:
+                yield self
+            except BaseException:
+                if outer and exclusive:
+                    # throw away half-applied changes by reloading the last published state
+                    self.version=0
+                    self._load()
+                raise
+            if outer and exclusive:
+                self._save()
+        finally:
+            self.lock.release()
+
+    def read(self):
+        return self._hold(False)
+
+    def write(self):
+        return self._hold(True)
+
+    def reading(self, func):
+        # decorator form of read() for callbacks
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.read():
+                return func(*args, **kwargs)
+        return wrapper
+
+    def writing(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.write():
+                return func(*args, **kwargs)
+        return wrapper
+
+    def stats(self):
+        return {'version': self.version, 'loads': self.loads, 'saves': self.saves}
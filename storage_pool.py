@@ -0,0 +1,245 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from file_system import FileAllocationTable
+
+# A placement policy gets the pool, the file name and one get_fragmentation_info() dict per
+# volume, and returns volume indices in order of preference.
+def round_robin(pool, filename, stats):
+    start=pool.next_volume
+    pool.next_volume=(start+1)%len(stats)
+    return [(start+i)%len(stats) for i in range(len(stats))]
+
+def most_free(pool, filename, stats):
+    return sorted(range(len(stats)), key=lambda i: -stats[i]['free_blocks'])
+
+def least_fragmented(pool, filename, stats):
+    # lowest external fragmentation first, more free space breaking ties
+    return sorted(range(len(stats)), key=lambda i: (stats[i]['fragmentation_percentage'], -stats[i]['free_blocks']))
+
+def hash_placement(pool, filename, stats):
+    # a name always prefers the same volume, then the ones after it
+    start=int.from_bytes(hashlib.sha256(filename.encode()).digest()[:8], 'big')%len(stats)
+    return [(start+i)%len(stats) for i in range(len(stats))]
+
+PLACEMENTS={
+    'round-robin': round_robin,
+    'most-free': most_free,
+    'least-fragmented': least_fragmented,
+    'hash': hash_placement
+}
+
+def allocate_many(fat, requests, method=None):
+    # one volume's share of a bulk load; returns the volume too, since a process worker
+    # allocates on its own copy
+    return fat, [fat.allocate_file(name, size, method=method)[0] for name, size in requests]
+
+class StoragePool:
+    # One namespace over several FileAllocationTable volumes. The placement policy orders the
+    # volumes for each file; a striped file is dealt in stripe units of stripe_blocks blocks
+    # round-robin over stripe_width volumes, each volume holding its share as one part file.
+    def __init__(self, volumes=4, blocks_per_volume=1024, placement="round-robin", stripe_blocks=16, stripe_width=1, compact=True):
+        if isinstance(volumes, int):
+            volumes=[FileAllocationTable(blocks_per_volume, compact=compact) for _ in range(volumes)]
+        self.volumes=list(volumes)
+        self.block_size=self.volumes[0].block_size
+        self.stripe_blocks=stripe_blocks
+        # used when a call does not pass its own stripe_width
+        self.stripe_width=stripe_width
+        # filename -> {'size', 'stripe_blocks', 'parts': [(volume, part name, part size), ...]}
+        self.files={}
+        self.next_volume=0
+        self.placement="round-robin"
+        self.set_placement_policy(placement)
+        self.lock=threading.RLock()
+
+    def __getstate__(self):
+        state=dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock=threading.RLock()
+
+    @property
+    def total_blocks(self):
+        return sum(fat.total_blocks for fat in self.volumes)
+
+    def set_placement_policy(self, policy):
+        # a name from PLACEMENTS or a callable with the same signature
+        if callable(policy) or policy in PLACEMENTS:
+            self.placement=policy
+            return True
+        return False
+
+    def volume_stats(self):
+        return [fat.get_fragmentation_info() for fat in self.volumes]
+
+    def _order(self, filename, stats):
+        policy=self.placement if callable(self.placement) else PLACEMENTS[self.placement]
+        return policy(self, filename, stats)
+
+    def _part_sizes(self, size, width):
+        # bytes per part when the file is dealt in stripe units; the last unit may be partial
+        unit=self.stripe_blocks*self.block_size
+        units, tail=divmod(size, unit)
+        sizes=[(units//width+(1 if i<units%width else 0))*unit for i in range(width)]
+        if tail:
+            sizes[units%width]+=tail
+        return [part for part in sizes if part] or [0]
+
+    def _part_name(self, filename, index, count):
+        return filename if count==1 else "{}#{}".format(filename, index)
+
+    def _width(self, stripe_width):
+        return max(1, min(stripe_width or self.stripe_width, len(self.volumes)))
+
+    def _allocate(self, filename, size, stripe_width, method):
+        # each part goes to the next volume in preference order that takes it, one part per volume
+        width=self._width(stripe_width)
+        sizes=self._part_sizes(size, width)
+        candidates=iter(self._order(filename, self.volume_stats()))
+        parts=[]
+        for index, part_size in enumerate(sizes):
+            name=self._part_name(filename, index, len(sizes))
+            for volume in candidates:
+                if self.volumes[volume].allocate_file(name, part_size, method=method)[0]:
+                    parts.append((volume, name, part_size))
+                    break
+            else:
+                for volume, name, _ in parts:
+                    self.volumes[volume].deallocate_file(name)
+                return False
+        self.files[filename]={'size': size, 'stripe_blocks': self.stripe_blocks, 'parts': parts}
+        return True
+
+    def allocate_file(self, filename, size, stripe_width=None, method=None):
+        with self.lock:
+            if filename in self.files:
+                return False, "File already exists"
+            if self._allocate(filename, size, stripe_width, method):
+                return True, "File allocated successfully"
+            return False, "Not enough space"
+
+    def bulk_allocate(self, files, stripe_width=None, method=None, workers=None, executor="thread"):
+        # Placement for every file is decided up front against projected free space; then each
+        # volume's queue is allocated by its own worker, so the volumes fill in parallel. With
+        # executor="process" the volumes are shipped to worker processes and replaced by the
+        # copies they return. Files with a failed part are rolled back and retried one by one.
+        files=list(files)
+        requested=dict(files)
+        with self.lock:
+            stats=self.volume_stats()
+            queues=[[] for _ in self.volumes]
+            plans={}
+            results={}
+            width=self._width(stripe_width)
+            for filename, size in files:
+                if filename in self.files or filename in plans:
+                    results[filename]=(False, "File already exists")
+                    continue
+                sizes=self._part_sizes(size, width)
+                order=iter(self._order(filename, stats))
+                parts=[]
+                for index, part_size in enumerate(sizes):
+                    blocks=(part_size+self.block_size-1)//self.block_size
+                    volume=next((v for v in order if stats[v]['free_blocks']>=blocks), None)
+                    if volume is None:
+                        break
+                    parts.append((volume, self._part_name(filename, index, len(sizes)), part_size))
+                if len(parts)<len(sizes):
+                    plans[filename]=None
+                    continue
+                for volume, name, part_size in parts:
+                    stats[volume]['free_blocks']-=(part_size+self.block_size-1)//self.block_size
+                    queues[volume].append((name, part_size))
+                plans[filename]=(size, parts)
+
+            busy=[volume for volume in range(len(self.volumes)) if queues[volume]]
+            pool_class=ProcessPoolExecutor if executor=="process" else ThreadPoolExecutor
+            with pool_class(max_workers=workers or len(busy) or 1) as pool:
+                outcomes=list(pool.map(allocate_many, [self.volumes[v] for v in busy], [queues[v] for v in busy],
+                                       [method]*len(busy)))
+            placed=set()
+            for volume, (fat, done) in zip(busy, outcomes):
+                self.volumes[volume]=fat
+                placed.update((volume, name) for (name, _), ok in zip(queues[volume], done) if ok)
+
+            for filename, plan in plans.items():
+                if plan is not None and all((volume, name) in placed for volume, name, _ in plan[1]):
+                    self.files[filename]={'size': plan[0], 'stripe_blocks': self.stripe_blocks, 'parts': plan[1]}
+                    results[filename]=(True, "File allocated successfully")
+                    continue
+                if plan is not None:
+                    for volume, name, _ in plan[1]:
+                        if (volume, name) in placed:
+                            self.volumes[volume].deallocate_file(name)
+                ok=self._allocate(filename, requested[filename], stripe_width, method)
+                results[filename]=(True, "File allocated successfully") if ok else (False, "Not enough space")
+            return results
+
+    def deallocate_file(self, filename):
+        with self.lock:
+            info=self.files.pop(filename, None)
+            if info is None:
+                return False
+            for volume, name, _ in info['parts']:
+                self.volumes[volume].deallocate_file(name)
+            return True
+
+    def locate(self, filename, byte_offset):
+        # (volume, block) holding a byte of the file, following the stripe layout
+        info=self.files.get(filename)
+        if info is None or not 0<=byte_offset<info['size']:
+            return None
+        parts=info['parts']
+        unit=info['stripe_blocks']*self.block_size
+        stripe, within=divmod(byte_offset, unit)
+        volume, name, _=parts[stripe%len(parts)]
+        return volume, self.volumes[volume].block_for_offset(name, (stripe//len(parts))*unit+within)
+
+    def volume_info(self):
+        info=[]
+        for volume, (fat, stats) in enumerate(zip(self.volumes, self.volume_stats())):
+            info.append({
+                'volume': volume,
+                'files': len(fat.file_table),
+                'total_blocks': stats['total_blocks'],
+                'used_blocks': stats['used_blocks'],
+                'free_blocks': stats['free_blocks'],
+                'utilization': stats['used_blocks']*100/stats['total_blocks'] if stats['total_blocks'] else 0,
+                'largest_free_segment': stats['largest_free_segment'],
+                'fragmentation_percentage': stats['fragmentation_percentage'],
+                'internal_fragmentation_bytes': stats['internal_fragmentation_bytes']
+            })
+        return info
+
+    def get_fragmentation_info(self):
+        # pool-wide totals; a file can only use one volume's largest run unless it is striped
+        volumes=self.volume_info()
+        total=sum(v['total_blocks'] for v in volumes)
+        free=sum(v['free_blocks'] for v in volumes)
+        largest=max(v['largest_free_segment'] for v in volumes)
+        utilization=[v['utilization'] for v in volumes]
+        return {
+            'volumes': len(volumes),
+            'files': len(self.files),
+            'total_blocks': total,
+            'free_blocks': free,
+            'used_blocks': total-free,
+            'largest_free_segment': largest,
+            'fragmentation_percentage': (1-largest/free)*100 if free else 0,
+            'mean_volume_fragmentation': sum(v['fragmentation_percentage'] for v in volumes)/len(volumes),
+            'utilization_spread': max(utilization)-min(utilization),
+            'internal_fragmentation_bytes': sum(v['internal_fragmentation_bytes'] for v in volumes)
+        }
+
+    def check_consistency(self):
+        for fat in self.volumes:
+            fat.check_consistency()
+        parts=sum(len(info['parts']) for info in self.files.values())
+        held=sum(len(fat.file_table) for fat in self.volumes)
+        if parts!=held:
+            raise Exception("Pool lists "+str(parts)+" parts but the volumes hold "+str(held)+" files")
+        return True
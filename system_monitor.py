@@ -1,36 +1,295 @@
 import psutil
-import random
-from collections import deque
-import pandas as pd
+import os
+import re
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from metric_history import MetricHistory
+from proc_collector import ProcCollector
+from content_store import ContentStore
+from shared_state import FileLock
+
+PROCESS_COLUMNS=['pid','name','cpu','memory']
+FILTER_TERM=re.compile(r"^\{(\w+)\}\s+[si]?(contains|eq|ne|gt|ge|lt|le|=|!=|>=|<=|>|<)\s+(.+)$")
+FILTER_OPS={'eq':'=','ne':'!=','gt':'>','ge':'>=','lt':'<','le':'<='}
+
+def parse_filter_query(filter_query):
+    # Dash DataTable filter_query ("{cpu} > 5 && {name} contains py") -> [(column, op, value)]
+    terms=[]
+    for part in (filter_query or '').split(' && '):
+        match=FILTER_TERM.match(part.strip())
+        if not match or match.group(1) not in PROCESS_COLUMNS:
+            continue
+        column, op, value=match.groups()
+        value=value.strip()
+        if len(value)>1 and value[0]==value[-1] and value[0] in '"\'`':
+            value=value[1:-1]
+        terms.append((column, FILTER_OPS.get(op, op), value))
+    return terms
+
+class ProcessSnapshot:
+    # One process scan stored column-wise; rows are only built for what a caller asks for.
+    def __init__(self, pids, names, cpu, memory):
+        self.columns={
+            'pid':np.asarray(pids, dtype=np.int64),
+            'name':np.asarray(names, dtype=str),
+            'cpu':np.asarray(cpu, dtype=np.float64),
+            'memory':np.asarray(memory, dtype=np.float64)
+        }
+        self._rows=None
+
+    def __len__(self):
+        return len(self.columns['pid'])
+
+    def rows(self, order=None):
+        columns=self.columns
+        if order is None:
+            order=np.arange(len(self))
+        return [
+            {'pid':pid,'name':name,'cpu':cpu,'memory':memory}
+            for pid, name, cpu, memory in zip(
+                columns['pid'][order].tolist(), columns['name'][order].tolist(),
+                columns['cpu'][order].tolist(), columns['memory'][order].tolist())
+        ]
+
+    def sorted_rows(self):
+        if self._rows is None:
+            self._rows=self.rows(np.argsort(-self.columns['cpu'], kind='stable'))
+        return self._rows
+
+    def filter_mask(self, filter_query):
+        mask=np.ones(len(self), dtype=bool)
+        for column, op, value in parse_filter_query(filter_query):
+            data=self.columns[column]
+            if column=='name':
+                if op=='contains':
+                    mask&=np.char.find(np.char.lower(data), value.lower())>=0
+                elif op in ('=','!='):
+                    mask&=(data==value) if op=='=' else (data!=value)
+                continue
+            try:
+                number=float(value)
+            except ValueError:
+                continue
+            if op in ('=','contains'):
+                mask&=data==number
+            elif op=='!=':
+                mask&=data!=number
+            elif op=='>':
+                mask&=data>number
+            elif op=='>=':
+                mask&=data>=number
+            elif op=='<':
+                mask&=data<number
+            elif op=='<=':
+                mask&=data<=number
+        return mask
+
+    def top(self, n, key='cpu', indices=None, descending=True):
+        # partial selection: argpartition finds the n-th best value, then only rows up to it are sorted
+        if indices is None:
+            indices=np.arange(len(self))
+        n=min(n, len(indices))
+        if n<=0:
+            return indices[:0]
+        values=self.columns[key][indices]
+        if key=='name':
+            order=np.argsort(values, kind='stable')
+            return indices[(order[::-1] if descending else order)[:n]]
+        if descending:
+            values=-values
+        if n<len(indices):
+            threshold=values[np.argpartition(values, n-1)[n-1]]
+            candidates=np.flatnonzero(values<=threshold)
+        else:
+            candidates=np.arange(len(indices))
+        order=np.lexsort((self.columns['pid'][indices[candidates]], values[candidates]))
+        return indices[candidates[order[:n]]]
+
+    def query(self, page=0, page_size=25, sort_by=None, filter_query=''):
+        # one page of rows for DataTable's custom paging/sorting/filtering, plus the match count
+        indices=np.flatnonzero(self.filter_mask(filter_query))
+        sort=(sort_by or [{'column_id':'cpu','direction':'desc'}])[0]
+        key=sort.get('column_id','cpu') if sort.get('column_id') in PROCESS_COLUMNS else 'cpu'
+        end=(page+1)*page_size
+        order=self.top(end, key, indices, descending=sort.get('direction')=='desc')
+        return self.rows(order[page*page_size:end]), len(indices)
 
 class SystemProcessMonitor:
-    def __init__(self):
-        self.cpu_history=deque(maxlen=60)
-        self.mem_history=deque(maxlen=60)
-        self.time_history=deque(maxlen=60)
+    def __init__(self, sample_interval=1.0, process_ttl=1.0, collector="psutil", state_dir=None):
+        self.sample_interval=sample_interval
+        # with a state_dir all worker processes share one history file and one of them samples
+        self.state_dir=state_dir
+        self.history=self._new_history()
+        self._sampler_lock=FileLock(os.path.join(state_dir, "sampler.lock")) if state_dir else None
+        self.is_sampler=state_dir is None
+        self.process_cpu={}
+        self.process_ttl=process_ttl
+        self._process_snapshot=None
+        self._snapshot_time=0.0
+        self._scan_lock=threading.Lock()
+        self._stats_lock=threading.Lock()
+        self.cache_stats={'hits':0,'misses':0,'last_scan_seconds':0.0,'total_scan_seconds':0.0}
+        self.collector="psutil"
+        self._proc_collector=None
+        self.set_collector(collector)
+        self._sampler=None
+        self._stop_sampler=threading.Event()
+        psutil.cpu_percent(interval=None)
 
-    def get_live_cpu_mem(self):
-        cpu=psutil.cpu_percent(interval=0.1)
+    def _new_history(self):
+        if self.state_dir is None:
+            return MetricHistory(['cpu','mem'])
+        return MetricHistory(['cpu','mem'], path=os.path.join(self.state_dir, "metrics.bin"))
+
+    def sample(self):
+        # cpu_percent(None) reports usage since the previous call, so this never blocks
+        cpu=psutil.cpu_percent(interval=None)
         mem=psutil.virtual_memory().percent
-        timestamp=pd.Timestamp.now()
-        self.cpu_history.append(cpu)
-        self.mem_history.append(mem)
-        self.time_history.append(timestamp)
-        return list(self.time_history), list(self.cpu_history), list(self.mem_history)
-        
-    def get_all_processes(self):
-        process_list=[]
+        self.history.add(time.time(), cpu, mem)
+
+    def _sample_loop(self):
+        while not self._stop_sampler.is_set():
+            # a shared history is written only by the process holding the sampler lock; the
+            # others keep trying so sampling resumes if that process exits
+            if not self.is_sampler:
+                self.is_sampler=self._sampler_lock.claim()
+            if self.is_sampler:
+                try:
+                    self.sample()
+                except Exception as e:
+                    print("Metric sampling failed: "+str(e))
+            self._stop_sampler.wait(self.sample_interval)
+
+    def start_sampler(self, sample_interval=None):
+        # the history is created once in __init__ and kept across stop/start cycles
+        if self.sampler_running():
+            return False
+        if sample_interval is not None:
+            self.sample_interval=sample_interval
+        self._stop_sampler.clear()
+        self._sampler=threading.Thread(target=self._sample_loop, name="metric-sampler", daemon=True)
+        self._sampler.start()
+        return True
+
+    def stop_sampler(self):
+        if not self.sampler_running():
+            return False
+        self._stop_sampler.set()
+        self._sampler.join()
+        self._sampler=None
+        return True
+
+    def sampler_running(self):
+        return self._sampler is not None and self._sampler.is_alive()
+
+    def get_live_cpu_mem(self):
+        # the last minute of 1s samples; with the sampler running callbacks only read the history
+        if not self.sampler_running():
+            self.sample()
+        samples=self.history.since(None, 60)
+        return [datetime.fromtimestamp(t) for t in samples['time']], samples['cpu'].tolist(), samples['mem'].tolist()
+
+    def get_samples_since(self, cursor):
+        # 1s samples newer than `cursor` (the time of the last sample a client has), so each
+        # client only fetches what it has not seen. Cursors are times rather than counters so
+        # they stay valid whichever worker answers; a missing or expired one gets gap=True.
+        if not self.sampler_running():
+            self.sample()
+        samples=self.history.since(cursor, self.history.levels[0].capacity)
+        return {
+            'cursor': samples['cursor'],
+            'gap': samples['gap'],
+            'time': samples['time'].tolist(),
+            'cpu': samples['cpu'].tolist(),
+            'mem': samples['mem'].tolist()
+        }
+
+    def get_cpu_mem_history(self, seconds, max_points=300):
+        # rollups from the finest ring that covers the range, regrouped to max_points
+        end=time.time()
+        return self.history.query(end-seconds, end, max_points)
+
+    def set_collector(self, collector):
+        # "psutil" works everywhere; "proc" reads /proc in bulk on Linux
+        if collector=="psutil":
+            self.collector=collector
+            return True
+        if collector=="proc" and ProcCollector.available():
+            if self._proc_collector is None:
+                self._proc_collector=ProcCollector()
+            self.collector=collector
+            return True
+        return False
+
+    def _scan_processes(self):
+        if self.collector=="proc":
+            pids, names, cpu, memory=self._proc_collector.scan()
+            self.process_cpu=dict(zip(pids.tolist(), cpu.tolist()))
+            return ProcessSnapshot(pids, names, cpu, memory)
+        pids=[]
+        names=[]
+        cpu=[]
+        memory=[]
         for proc in psutil.process_iter(['pid','name','cpu_percent','memory_percent']):
             try:
-                process_list.append({
-                    'pid':proc.info['pid'],
-                    'name':proc.info['name'],
-                    'cpu':proc.info['cpu_percent'],
-                    'memory':round(proc.info['memory_percent'],2)
-                })
+                info=proc.info
+                row=(info['pid'], info['name'] or '', info['cpu_percent'] or 0.0, round(info['memory_percent'],2))
             except: continue
-        return sorted(process_list,key=lambda x:x['cpu'],reverse=True)
-    
+            pids.append(row[0])
+            names.append(row[1])
+            cpu.append(row[2])
+            memory.append(row[3])
+        self.process_cpu=dict(zip(pids, cpu))
+        return ProcessSnapshot(pids, names, cpu, memory)
+
+    def _snapshot_fresh(self):
+        return self._process_snapshot is not None and time.monotonic()-self._snapshot_time<self.process_ttl
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.cache_stats[key]+=1
+
+    def get_process_snapshot(self):
+        # one scan per TTL window is shared by every caller
+        if self._snapshot_fresh():
+            self._count('hits')
+            return self._process_snapshot
+        with self._scan_lock:
+            if self._snapshot_fresh():
+                self._count('hits')
+                return self._process_snapshot
+            self._count('misses')
+            start=time.perf_counter()
+            snapshot=self._scan_processes()
+            elapsed=time.perf_counter()-start
+            self._process_snapshot=snapshot
+            self._snapshot_time=time.monotonic()
+            with self._stats_lock:
+                self.cache_stats['last_scan_seconds']=elapsed
+                self.cache_stats['total_scan_seconds']+=elapsed
+            return snapshot
+
+    def get_all_processes(self):
+        # shared between callers; the returned list must not be modified
+        return self.get_process_snapshot().sorted_rows()
+
+    def get_process_page(self, page=0, page_size=25, sort_by=None, filter_query=''):
+        return self.get_process_snapshot().query(page, page_size, sort_by, filter_query)
+
+    def get_top_processes(self, n=10, key='cpu'):
+        snapshot=self.get_process_snapshot()
+        return snapshot.rows(snapshot.top(n, key))
+
+    def get_cache_stats(self):
+        with self._stats_lock:
+            stats=dict(self.cache_stats)
+        lookups=stats['hits']+stats['misses']
+        stats['hit_rate']=stats['hits']/lookups if lookups else 0.0
+        stats['average_scan_seconds']=stats['total_scan_seconds']/stats['misses'] if stats['misses'] else 0.0
+        return stats
+
     def get_process_details(self,pid):
             try:
                 proc=psutil.Process(pid)
@@ -41,21 +300,25 @@ class SystemProcessMonitor:
                     "\nStatus: "+proc.status() +
                     "\nUser: "+proc.username() +
                     "\nCreated: "+str(pd.to_datetime(proc.create_time(), unit='s')) +
-                    "\nCPU Usage: "+str(proc.cpu_percent(interval=0.1)) + " %" +
+                    "\nCPU Usage: "+str(self.process_cpu.get(pid, 0.0)) + " %" +
                     "\nMemory Usage: "+"{:.2f}".format(proc.memory_percent()) + " %" +
                     "\nThreads: "+str(proc.num_threads())
                 )
             except: return "Process terminated or access denied."
 
 class RealFileManager:
-    def __init__(self):
+    # uploaded_files holds metadata only; payload bytes go to the content store
+    def __init__(self, content_store=None):
         self.uploaded_files={}
+        self.content_store=content_store or ContentStore()
         self.block_size=4096
         print("\n=== Initializing RealFileManager ===")
         print("Block size: "+str(self.block_size)+" bytes")
         memory=psutil.virtual_memory()
         self.total_disk_size=int(memory.total*0.8)
         self.used_space=0
+        # space accounting is check-then-update, so concurrent uploads go through this lock
+        self.lock=threading.Lock()
         
     def get_available_space(self):
         return self.total_disk_size-self.used_space
@@ -64,6 +327,7 @@ class RealFileManager:
         return file_size<=self.get_available_space()
     
     def analyze_file(self, filename, content):
+        # validates an upload and returns its size; register_file books the space once it is allocated
         print("\nAnalyzing file: "+str(filename))
         print("Content type: "+str(type(content)))
         print("Content length: "+str(len(content) if content else 0)+" bytes")
@@ -76,74 +340,55 @@ class RealFileManager:
                 "Invalid content type: "+str(type(content))+". Expected string or bytes."
             )
 
-        file_size=len(content)
-        print("File size: "+"{:.2f}".format(file_size/1024)+" KB")
+        return len(content)
 
-        if not self.can_accommodate_file(file_size):
-            free_space_mb=self.get_available_space()/(1024*1024)
-            raise Exception("Not enough space. Available space: "+"{:.2f}".format(free_space_mb)+" MB")
+    def register_file(self, filename, file_size):
+        print("File size: "+"{:.2f}".format(file_size/1024)+" KB")
 
+        # fragments come from where FileAllocationTable actually places the file (get_file_fragments)
         num_blocks=(file_size+self.block_size-1)//self.block_size
-        fragments=[]
-        remaining_size=file_size
-        current_pos=0
-        max_fragment_size=min(
-            remaining_size,
-            self.block_size*(16 if file_size<1024*1024 else 8))
-        
-        while remaining_size > 0:
-            if len(fragments)==0:
-                max_blocks=min(remaining_size//self.block_size + 1, 16)
-                fragment_blocks=random.randint(max_blocks // 2, max_blocks)
-            else:
-                max_blocks=min(remaining_size // self.block_size + 1, 8)
-                fragment_blocks=random.randint(1, max_blocks)
-            
-            fragment_size=min(fragment_blocks * self.block_size, remaining_size)
-            gap=random.randint(0,2) * self.block_size
-            current_pos+=gap
-            fragments.append({
-                'start':current_pos,
-                'size':fragment_size,
-                'blocks':fragment_blocks
-            })
-            current_pos+=fragment_size
-            remaining_size-=fragment_size
-        base_fragmentation=(len(fragments)-1)/num_blocks*100
-        size_factor=min(file_size/(10*1024*1024), 1) 
-        fragmentation_score=base_fragmentation*(1+size_factor)
-        
         file_info={
             'name':filename,
             'size':file_size,
             'num_blocks':num_blocks,
-            'fragments':fragments,
-            'fragmentation_score':min(fragmentation_score,100), 
-            'allocated_space':current_pos
+            'allocated_space':num_blocks*self.block_size
         }
-        self.used_space+=file_info['allocated_space']
-        self.uploaded_files[filename]=file_info
+        with self.lock:
+            if not self.can_accommodate_file(file_size):
+                free_space_mb=self.get_available_space()/(1024*1024)
+                raise Exception("Not enough space. Available space: "+"{:.2f}".format(free_space_mb)+" MB")
+            self.used_space+=file_info['allocated_space']
+            self.uploaded_files[filename]=file_info
         return file_info
     
     def add_file(self, filename, content):
         file_size=len(content)
-        self.uploaded_files[filename]={
-            'content':content,
-            'size':file_size,
-            'num_blocks':(file_size + self.block_size - 1) // self.block_size,
-            'fragments':[],
-            'fragmentation_score':0,
-            'allocated_space': file_size
-        }
-        self.used_space+=file_size
+        self.content_store.put(filename, content)
+        with self.lock:
+            self.uploaded_files[filename]={
+                'size':file_size,
+                'num_blocks':(file_size + self.block_size - 1) // self.block_size,
+                'fragments':[],
+                'fragmentation_score':0,
+                'allocated_space': file_size
+            }
+            self.used_space+=file_size
 
     def remove_file(self, filename):
-        if filename in self.uploaded_files:
-            file_info=self.uploaded_files[filename]
+        with self.lock:
+            file_info=self.uploaded_files.pop(filename, None)
+            if file_info is None:
+                return False
             self.used_space-=file_info['allocated_space']
-            del self.uploaded_files[filename]
-            return True
-        return False
+        self.content_store.remove(filename)
+        return True
+
+    def store_content(self, filename, content):
+        return self.content_store.put(filename, content)
+
+    def get_content(self, filename):
+        # zero-copy memoryview of the stored bytes, or None
+        return self.content_store.get(filename)
     
     def get_file_info(self, filename):
         return self.uploaded_files.get(filename)
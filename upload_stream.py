@@ -0,0 +1,371 @@
+import base64
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from flask import request, jsonify
+from shared_state import FileLock
+
+CHUNK_SIZE=256*1024
+# an upload session that has not received anything for this long is dropped with its spill
+SESSION_IDLE_TIMEOUT=3600
+SUPPORTED_EXTENSIONS=['.csv','.txt','.pdf','.doc','.docx','.xls','.xlsx']
+DOC_SIGNATURES=[b'\xD0\xCF\x11\xE0', b'PK\x03\x04']
+SNIFF_BYTES=8
+
+def validate_file_header(filename, head):
+    # extension and magic-byte checks; only the first bytes of the file are needed
+    file_ext=os.path.splitext(filename.lower())[1]
+    if file_ext not in SUPPORTED_EXTENSIONS:
+        raise Exception("Unsupported file type: {}. Supported types are: {}".format(file_ext, ", ".join(SUPPORTED_EXTENSIONS)))
+    if file_ext=='.pdf' and not head.startswith(b'%PDF-'):
+        raise Exception("Invalid PDF file format")
+    if file_ext in ('.doc','.docx') and not any(head.startswith(sig) for sig in DOC_SIGNATURES):
+        raise Exception("Invalid Word document format")
+    return file_ext
+
+class Base64Decoder:
+    # decodes base64 text that arrives in arbitrary pieces, carrying partial quads over
+    def __init__(self):
+        self.pending=b''
+        self.started=False
+
+    def feed(self, data):
+        data=bytes(data)
+        if not self.started:
+            self.started=True
+            if data.startswith(b'data:') and b',' in data:
+                data=data.split(b',', 1)[1]
+        data=self.pending+data.translate(None, b' \t\r\n')
+        usable=len(data)-len(data)%4
+        self.pending=data[usable:]
+        try:
+            return base64.b64decode(data[:usable], validate=True)
+        except Exception as e:
+            raise Exception("Failed to decode file content: "+str(e))
+
+    def finish(self):
+        if self.pending:
+            raise Exception("Failed to decode file content: truncated base64 data")
+        return b''
+
+class UploadSession:
+    # Runs every stage on each chunk as it arrives: decode, sniff, size, hash.
+    # Nothing but the sniff prefix is kept, so memory stays bounded by the chunk size.
+    def __init__(self, filename, method="continuous", declared_size=None, encoding=None):
+        if not filename:
+            raise Exception("No filename provided")
+        self.filename=filename
+        self.method=method
+        self.declared_size=declared_size
+        self.decoder=Base64Decoder() if encoding=="base64" else None
+        self.head=b''
+        self.sniffed=False
+        self.size=0
+        self.hash=hashlib.sha256()
+        self.lock=threading.Lock()
+        self.sinks=[]
+        # picklable details the callbacks need to resume the session in another worker
+        self.context={}
+        self.touched=time.time()
+
+    def checkpoint(self):
+        # what another worker needs to carry on: the settings, how much arrived and any base64
+        # characters still waiting for the rest of their quad
+        return {
+            'filename':self.filename,
+            'method':self.method,
+            'declared_size':self.declared_size,
+            'encoding':'base64' if self.decoder else None,
+            'started':self.decoder.started if self.decoder else False,
+            'pending':self.decoder.pending.decode('ascii') if self.decoder else '',
+            'size':self.size,
+            'context':self.context,
+            'touched':self.touched
+        }
+
+    @classmethod
+    def from_checkpoint(cls, state):
+        # an empty copy; resume_upload replays the bytes received so far into it
+        session=cls(state['filename'], state['method'], state['declared_size'], state['encoding'])
+        if session.decoder:
+            session.decoder.started=state['started']
+            session.decoder.pending=state['pending'].encode('ascii')
+        session.context=state['context']
+        session.touched=state['touched']
+        return session
+
+    def replay(self, data):
+        # bytes a previous copy of this session already took: counted and hashed, not sunk again
+        with self.lock:
+            self._sniff(data)
+            self.size+=len(data)
+            self.hash.update(data)
+
+    def _sniff(self, data, final=False):
+        if self.sniffed:
+            return
+        self.head+=data[:SNIFF_BYTES-len(self.head)]
+        if len(self.head)>=SNIFF_BYTES or final:
+            validate_file_header(self.filename, self.head)
+            self.sniffed=True
+
+    def _consume(self, data, final=False):
+        self._sniff(data, final)
+        if not data:
+            return
+        self.size+=len(data)
+        if self.declared_size is not None and self.size>self.declared_size:
+            raise Exception("Upload is larger than its declared size of "+str(self.declared_size)+" bytes")
+        self.hash.update(data)
+        for sink in self.sinks:
+            sink(data)
+
+    def feed(self, chunk):
+        with self.lock:
+            self._consume(self.decoder.feed(chunk) if self.decoder else chunk)
+
+    def finish(self):
+        with self.lock:
+            self._consume(self.decoder.finish() if self.decoder else b'', final=True)
+            if self.size==0:
+                raise Exception("File content is empty")
+            return {'filename':self.filename, 'size':self.size, 'sha256':self.hash.hexdigest(), 'method':self.method}
+
+def feed_request_body(session, stream, chunk_size=CHUNK_SIZE):
+    while True:
+        chunk=stream.read(chunk_size)
+        if not chunk:
+            break
+        session.feed(chunk)
+
+class SessionStore:
+    # Chunked upload sessions by upload id. Without a directory they live in this process. With
+    # one (under DASHBOARD_STATE_DIR), each session's checkpoint is kept in <id>.json and guarded
+    # by a flock on that file. Any worker can then take the next chunk. A worker with no copy of
+    # the session, or a stale one, rebuilds it through resume(session). A failed session is
+    # dropped and handed to abort(session).
+    def __init__(self, resume=None, abort=None, directory=None, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.resume=resume
+        self.abort=abort
+        self.directory=directory
+        self.idle_timeout=idle_timeout
+        self.sessions={}
+        self.locks={}
+        self.users={}
+        self.lock=threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, upload_id):
+        return os.path.join(self.directory, upload_id+".json")
+
+    def _acquire(self, upload_id):
+        # one FileLock per session and process; its descriptor closes with the last user
+        with self.lock:
+            lock=self.locks.get(upload_id)
+            if lock is None:
+                lock=self.locks[upload_id]=FileLock(self._path(upload_id))
+            self.users[lock]=self.users.get(lock, 0)+1
+        lock.acquire()
+        return lock
+
+    def _release(self, upload_id, lock):
+        lock.release()
+        with self.lock:
+            self.users[lock]-=1
+            if self.users[lock]==0:
+                del self.users[lock]
+                if self.locks.get(upload_id) is not lock:
+                    lock.close()
+
+    def _read(self, lock):
+        data=os.pread(lock.fd, os.fstat(lock.fd).st_size, 0)
+        return json.loads(data) if data else None
+
+    def _write(self, lock, session):
+        payload=json.dumps(session.checkpoint()).encode()
+        os.ftruncate(lock.fd, 0)
+        os.pwrite(lock.fd, payload, 0)
+
+    def _forget(self, upload_id, lock=None):
+        # with the session's lock held; emptying the file first tells workers that still have
+        # it open that the session is gone
+        with self.lock:
+            self.sessions.pop(upload_id, None)
+            self.locks.pop(upload_id, None)
+        if lock is not None:
+            os.ftruncate(lock.fd, 0)
+            try:
+                os.remove(self._path(upload_id))
+            except FileNotFoundError:
+                pass
+
+    def _fail(self, upload_id, session, lock=None):
+        self._forget(upload_id, lock)
+        if session is not None:
+            self.abort(session)
+
+    def add(self, upload_id, session):
+        with self.lock:
+            self.sessions[upload_id]=session
+        if self.directory:
+            lock=self._acquire(upload_id)
+            try:
+                self._write(lock, session)
+            finally:
+                self._release(upload_id, lock)
+
+    def run(self, upload_id, action, finish=False):
+        # action(session) with the session held against other requests for it; returns
+        # (found, result). The session is dropped after a finish or when it fails.
+        if not self.directory:
+            with self.lock:
+                session=self.sessions.pop(upload_id, None) if finish else self.sessions.get(upload_id)
+            if session is None:
+                return False, None
+            try:
+                session.touched=time.time()
+                return True, action(session)
+            except Exception:
+                self._fail(upload_id, session)
+                raise
+        if upload_id not in self.locks and not os.path.exists(self._path(upload_id)):
+            return False, None
+        lock=self._acquire(upload_id)
+        session=None
+        try:
+            state=self._read(lock)
+            if state is None:
+                # finished or dropped by another worker
+                self._forget(upload_id)
+                return False, None
+            session=self.sessions.get(upload_id)
+            if session is None or session.size!=state['size']:
+                # started elsewhere, or fed elsewhere since this worker last saw it
+                session=UploadSession.from_checkpoint(state)
+                self.resume(session)
+                if session.size!=state['size']:
+                    raise Exception("Upload "+upload_id+" lost data: "+str(session.size)+" of "+str(state['size'])+" bytes left")
+                with self.lock:
+                    self.sessions[upload_id]=session
+            session.touched=time.time()
+            result=action(session)
+            if finish:
+                self._forget(upload_id, lock)
+            else:
+                self._write(lock, session)
+            return True, result
+        except Exception:
+            self._fail(upload_id, session, lock)
+            raise
+        finally:
+            self._release(upload_id, lock)
+
+    def sweep(self):
+        # drops sessions idle for longer than idle_timeout; returns how many
+        cutoff=time.time()-self.idle_timeout
+        if not self.directory:
+            with self.lock:
+                idle=[upload_id for upload_id, session in self.sessions.items() if session.touched<cutoff]
+            for upload_id in idle:
+                self._fail(upload_id, self.sessions.get(upload_id))
+            return len(idle)
+        dropped=0
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            if os.path.getmtime(path)>=cutoff:
+                continue
+            upload_id=os.path.basename(path)[:-len(".json")]
+            lock=self._acquire(upload_id)
+            try:
+                state=self._read(lock)
+                if state is None:
+                    self._forget(upload_id, lock)
+                elif state['touched']<cutoff:
+                    self._fail(upload_id, self.sessions.get(upload_id) or UploadSession.from_checkpoint(state), lock)
+                    dropped+=1
+            finally:
+                self._release(upload_id, lock)
+        with self.lock:
+            # copies of sessions that another worker finished or took over
+            for upload_id in [upload_id for upload_id, session in self.sessions.items()
+                              if session.touched<cutoff and not os.path.exists(self._path(upload_id))]:
+                del self.sessions[upload_id]
+        return dropped
+
+def register_upload_routes(server, start_upload, complete_upload, abort_upload=None, resume_upload=None,
+                           session_dir=None, idle_timeout=SESSION_IDLE_TIMEOUT):
+    # start_upload(session) may reject an upload early (e.g. by declared size) and attach sinks;
+    # complete_upload(session, result) performs the allocation and returns the response dict;
+    # abort_upload(session) lets sinks clean up when a started upload fails. With session_dir,
+    # chunked sessions are shared between workers: resume_upload(session) rebuilds one that
+    # another worker started from session.context, reattaching the sinks and replaying the
+    # bytes received so far through session.replay().
+    def abort(session):
+        if abort_upload is not None:
+            abort_upload(session)
+
+    sessions=SessionStore(resume_upload, abort, session_dir, idle_timeout)
+
+    def new_session(params):
+        declared=params.get('size')
+        session=UploadSession(
+            params.get('filename'),
+            params.get('method') or "continuous",
+            int(declared) if declared not in (None, '') else None,
+            params.get('encoding'))
+        start_upload(session)
+        return session
+
+    def error(e, status=400):
+        print("Error in streamed upload: "+str(e))
+        return jsonify({'error':str(e)}), status
+
+    @server.route('/upload/stream', methods=['POST'])
+    def upload_stream():
+        try:
+            session=new_session(request.args)
+        except Exception as e:
+            return error(e)
+        try:
+            feed_request_body(session, request.stream)
+            return jsonify(complete_upload(session, session.finish()))
+        except Exception as e:
+            abort(session)
+            return error(e)
+
+    def continue_session(upload_id, action, finish=False):
+        try:
+            found, result=sessions.run(upload_id, action, finish)
+        except Exception as e:
+            return error(e)
+        if not found:
+            return error("Unknown upload "+upload_id, 404)
+        return jsonify(result)
+
+    @server.route('/upload/session', methods=['POST'])
+    def upload_session_start():
+        sessions.sweep()
+        try:
+            session=new_session(request.get_json(silent=True) or request.args)
+        except Exception as e:
+            return error(e)
+        upload_id=uuid.uuid4().hex
+        sessions.add(upload_id, session)
+        return jsonify({'upload_id':upload_id, 'chunk_size':CHUNK_SIZE})
+
+    @server.route('/upload/session/<upload_id>', methods=['PUT'])
+    def upload_session_chunk(upload_id):
+        def feed(session):
+            feed_request_body(session, request.stream)
+            return {'upload_id':upload_id, 'received':session.size}
+        return continue_session(upload_id, feed)
+
+    @server.route('/upload/session/<upload_id>/finish', methods=['POST'])
+    def upload_session_finish(upload_id):
+        return continue_session(upload_id, lambda session: complete_upload(session, session.finish()), finish=True)
+
+    return sessions
@@ -0,0 +1,148 @@
+import argparse
+import heapq
+import time
+import tracemalloc
+import numpy as np
+from file_system import FileAllocationTable
+
+SIZE_DISTRIBUTIONS=['uniform', 'zipf', 'lognormal']
+METHODS=['continuous', 'linked', 'indexed', 'inode', 'buddy']
+POLICIES=['first-fit', 'best-fit', 'worst-fit', 'next-fit']
+
+def block_counts(distribution, count, rng, max_blocks=256, zipf_a=1.5, sigma=1.0):
+    # file sizes in blocks, clipped to 1..max_blocks
+    if distribution=='uniform':
+        blocks=rng.integers(1, max_blocks+1, count)
+    elif distribution=='zipf':
+        blocks=rng.zipf(zipf_a, count)
+    elif distribution=='lognormal':
+        blocks=np.ceil(rng.lognormal(np.log(max_blocks)/2, sigma, count))
+    else:
+        raise Exception("Unknown size distribution: {}. Supported are: {}".format(distribution, ", ".join(SIZE_DISTRIBUTIONS)))
+    return np.clip(blocks, 1, max_blocks).astype(np.int64)
+
+def generate_trace(operations, distribution='uniform', seed=1, block_size=1024, max_blocks=256,
+                   arrival_rate=1.0, mean_lifetime=100.0):
+    # Poisson arrivals with exponential lifetimes: yields ('alloc', name, size) and ('free', name, 0)
+    # in time order until `operations` events have been produced
+    rng=np.random.default_rng(seed)
+    sizes=block_counts(distribution, operations, rng, max_blocks)
+    arrivals=np.cumsum(rng.exponential(1/arrival_rate, operations))
+    lifetimes=rng.exponential(mean_lifetime, operations)
+    expiring=[]
+    created=0
+    for _ in range(operations):
+        if expiring and expiring[0][0]<=arrivals[created]:
+            yield ('free', heapq.heappop(expiring)[1], 0)
+            continue
+        name="file"+str(created)
+        yield ('alloc', name, int(sizes[created])*block_size)
+        heapq.heappush(expiring, (arrivals[created]+lifetimes[created], name))
+        created+=1
+
+def read_trace(path):
+    # one operation per line: "alloc <name> <size in bytes>" or "free <name>"; '#' starts a comment
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            fields=line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            if fields[0]=='alloc' and len(fields)==3:
+                yield ('alloc', fields[1], int(fields[2]))
+            elif fields[0]=='free' and len(fields)==2:
+                yield ('free', fields[1], 0)
+            else:
+                raise Exception("Invalid trace line {}: {}".format(line_number, line.strip()))
+
+def write_trace(path, trace):
+    with open(path, 'w') as f:
+        for op, name, size in trace:
+            f.write("alloc {} {}\n".format(name, size) if op=='alloc' else "free {}\n".format(name))
+
+def replay(fat, trace, sample_every=1000):
+    # frees of files whose allocation failed are skipped; fragmentation is sampled every sample_every operations
+    live=set()
+    allocations=0
+    failures=0
+    operations=0
+    timeline=[]
+    start=time.perf_counter()
+    for op, name, size in trace:
+        operations+=1
+        if op=='alloc':
+            allocations+=1
+            if fat.allocate_file(name, size)[0]:
+                live.add(name)
+            else:
+                failures+=1
+        elif name in live:
+            live.remove(name)
+            fat.deallocate_file(name)
+        if operations%sample_every==0:
+            info=fat.get_fragmentation_info()
+            timeline.append((operations, info['fragmentation_percentage'], info['free_segments'], info['used_blocks']))
+    elapsed=time.perf_counter()-start
+    return {
+        'operations': operations,
+        'elapsed': elapsed,
+        'ops_per_sec': operations/elapsed if elapsed else 0.0,
+        'allocations': allocations,
+        'failures': failures,
+        'failure_rate': failures*100/max(1, allocations),
+        'timeline': timeline
+    }
+
+def run_workload(trace, method, total_blocks, compact=True, policy='first-fit', sample_every=1000, track_memory=False):
+    # builds a fresh table for one method and replays the trace on it; peak_memory covers both
+    if track_memory:
+        tracemalloc.start()
+    try:
+        fat=FileAllocationTable(total_blocks, compact=compact)
+        if not fat.set_allocation_method(method):
+            raise Exception("Unknown allocation method: {}. Supported are: {}".format(method, ", ".join(METHODS)))
+        if not fat.set_placement_policy(policy):
+            raise Exception("Unknown placement policy: {}. Supported are: {}".format(policy, ", ".join(POLICIES)))
+        result=replay(fat, trace, sample_every)
+        if track_memory:
+            result['peak_memory']=tracemalloc.get_traced_memory()[1]
+    finally:
+        if track_memory:
+            tracemalloc.stop()
+    return result
+
+def main():
+    parser=argparse.ArgumentParser(description="Replay an allocate/free workload against the FileAllocationTable")
+    parser.add_argument("--trace", help="trace file to replay instead of a generated workload")
+    parser.add_argument("--write-trace", help="save the generated workload to this file and exit")
+    parser.add_argument("--distribution", choices=SIZE_DISTRIBUTIONS, default='uniform')
+    parser.add_argument("--operations", type=int, default=100000)
+    parser.add_argument("--max-file-blocks", type=int, default=256)
+    parser.add_argument("--arrival-rate", type=float, default=1.0)
+    parser.add_argument("--mean-lifetime", type=float, default=100.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--blocks", type=int, default=2**14)
+    parser.add_argument("--methods", nargs="+", choices=METHODS, default=METHODS)
+    parser.add_argument("--policy", choices=POLICIES, default='first-fit')
+    parser.add_argument("--sample-every", type=int, default=10000)
+    parser.add_argument("--track-memory", action="store_true", help="trace allocations and report peak memory (slows the replay)")
+    args=parser.parse_args()
+
+    if args.trace:
+        trace=list(read_trace(args.trace))
+    else:
+        trace=list(generate_trace(args.operations, args.distribution, args.seed, max_blocks=args.max_file_blocks,
+                                  arrival_rate=args.arrival_rate, mean_lifetime=args.mean_lifetime))
+    if args.write_trace:
+        write_trace(args.write_trace, trace)
+        return
+    for method in args.methods:
+        result=run_workload(trace, method, args.blocks, policy=args.policy, sample_every=args.sample_every,
+                            track_memory=args.track_memory)
+        print("{}: {:.0f} ops/s, {:.2f}% of {} allocations failed".format(
+            method, result['ops_per_sec'], result['failure_rate'], result['allocations'])
+              +(", peak memory {:.1f} MB".format(result['peak_memory']/(1024*1024)) if args.track_memory else ""))
+        for operations, fragmentation, segments, used in result['timeline']:
+            print("  {:>10} ops  frag {:>5.1f}%  segments {:>6}  used {:>8}".format(operations, fragmentation, segments, used))
+
+if __name__=='__main__':
+    main()